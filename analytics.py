@@ -0,0 +1,138 @@
+"""
+Analyse de la trajectoire sur le chemin GPS : distance au point de départ,
+distance parcourue, vitesse sol, temps estimé de retour, et zones (geofences).
+
+Les calculs sont incrémentaux (un point GPS à la fois). Les zones sont testées
+toutes ensemble : les arêtes de tous les polygones sont rangées dans des
+tableaux NumPy, et un seul lancer de rayon vectorisé donne, pour chaque zone,
+si le point est dedans.
+
+Les zones sont lues dans le fichier JSON GEOFENCES_FILE :
+    [{"name": "stade", "type": "keep_out", "polygon": [[lat, lon], [lat, lon], ...]}, ...]
+"keep_in" : le drone doit rester dedans ; "keep_out" : il ne doit pas y entrer.
+"""
+import json
+import math
+import os
+
+import numpy as np
+
+EARTH_RADIUS = 6371000.0  # mètres
+
+# Vitesse de retour utilisée pour estimer le temps de retour au point de départ (m/s).
+RETURN_HOME_SPEED = float(os.environ.get("RETURN_HOME_SPEED", 8.0))
+# Lissage de la vitesse sol calculée entre deux points (0 < alpha <= 1).
+SPEED_SMOOTHING = 0.3
+GEOFENCES_FILE = os.environ.get("GEOFENCES_FILE", "geofences.json")
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance en mètres entre deux points (degrés)."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+
+class FlightTrack:
+    """
+    Calculs incrémentaux d'un drone. Les cumuls sont gardés dans les statistiques
+    du drone (total_distance_m...) : ils sont donc journalisés et survivent à un
+    redémarrage ; seul le dernier point est gardé ici.
+
+    Les heures (t, last_event) sont l'heure de mesure du point, en secondes depuis
+    l'epoch dans l'horloge du serveur (voir core.sample_ns).
+    """
+
+    def __init__(self):
+        self.last = None  # (lat, lon, t)
+        self.inside = None  # zones contenant le dernier point (tableau de booléens)
+        self.last_event = float("-inf")  # dernier événement "track" envoyé à Flutter
+
+    def update(self, stats, lat, lon, t):
+        """Met à jour les statistiques avec un nouveau point GPS mesuré à `t`."""
+        if self.last is not None:
+            last_lat, last_lon, last_t = self.last
+            step = haversine(last_lat, last_lon, lat, lon)
+            stats["total_distance_m"] = round((stats.get("total_distance_m") or 0) + step, 1)
+            if t > last_t:
+                speed = step / (t - last_t)
+                previous = stats.get("ground_speed_mps")
+                if previous is not None:
+                    speed = previous + SPEED_SMOOTHING * (speed - previous)
+                stats["ground_speed_mps"] = round(speed, 2)
+        self.last = (lat, lon, t)
+        home_lat = stats.get("start_latitude")
+        home_lon = stats.get("start_longitude")
+        if home_lat is not None and home_lon is not None:
+            distance = haversine(home_lat, home_lon, lat, lon)
+            stats["distance_home_m"] = round(distance, 1)
+            stats["return_home_eta_s"] = round(distance / RETURN_HOME_SPEED, 1)
+
+
+class Geofences:
+    """Ensemble de polygones, testés en une seule opération vectorisée."""
+
+    def __init__(self, fences=()):
+        self.names = []
+        self.types = []
+        x1, y1, x2, y2, owner = [], [], [], [], []
+        for index, fence in enumerate(fences):
+            points = fence["polygon"]
+            self.names.append(fence.get("name", f"zone-{index}"))
+            self.types.append(fence.get("type", "keep_out"))
+            for i, (lat, lon) in enumerate(points):
+                next_lat, next_lon = points[(i + 1) % len(points)]
+                x1.append(lon)
+                y1.append(lat)
+                x2.append(next_lon)
+                y2.append(next_lat)
+                owner.append(index)
+        self.x1 = np.array(x1, dtype=float)
+        self.y1 = np.array(y1, dtype=float)
+        self.y2 = np.array(y2, dtype=float)
+        dy = self.y2 - self.y1
+        # Pente inverse de chaque arête (0 pour les arêtes horizontales, jamais croisées).
+        self.slope = np.divide(np.array(x2, dtype=float) - self.x1, dy, out=np.zeros_like(dy), where=dy != 0)
+        self.owner = np.array(owner, dtype=np.intp)
+        # État attendu de chaque zone : dedans pour "keep_in", dehors pour "keep_out".
+        self.safe = np.array([fence_type == "keep_in" for fence_type in self.types], dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    def contains(self, lat, lon):
+        """Tableau de booléens : le point est-il dans chaque zone ?"""
+        straddles = (self.y1 > lat) != (self.y2 > lat)
+        crossings = straddles & (lon < self.x1 + (lat - self.y1) * self.slope)
+        return (np.bincount(self.owner[crossings], minlength=len(self.names)) & 1).astype(bool)
+
+    def transitions(self, before, after):
+        """
+        Événements d'entrée/sortie entre deux résultats de contains(). Pour le
+        premier point (before=None), seules les zones déjà violées sont signalées.
+        """
+        events = []
+        if before is None:
+            before = self.safe
+        for index in np.flatnonzero(before != after):
+            entered = bool(after[index])
+            fence_type = self.types[index]
+            events.append({
+                "fence": self.names[index],
+                "type": fence_type,
+                "event": "enter" if entered else "exit",
+                "breach": entered if fence_type == "keep_out" else not entered,
+            })
+        return events
+
+
+def load_geofences(path=GEOFENCES_FILE):
+    """Zones du fichier `path` ; aucune si le fichier n'existe pas."""
+    try:
+        with open(path, "r") as f:
+            return Geofences(json.load(f))
+    except FileNotFoundError:
+        return Geofences()
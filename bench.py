@@ -0,0 +1,353 @@
+"""
+Banc de charge des deux serveurs : ws_server.py et server_fusion.py.
+
+Le serveur est lancé en local (dans un dossier temporaire, pour ne pas toucher
+stats.json ni le journal), puis N drones sont simulés : une Raspberry qui envoie
+battery/gps/altitude/speed à `--rate` Hz et une application Flutter qui envoie
+des commandes à `--command-rate` Hz. Chaque message porte l'heure d'envoi
+("bench_t"), ce qui donne la latence de relais à la réception.
+
+Le résultat (débit, latences p50/p95/p99, trames perdues ou en erreur, CPU et
+mémoire du serveur) est affiché et écrit en JSON pour comparer les exécutions :
+
+    python bench.py --server both --drones 10 --rate 20 --duration 30 --output bench.json
+    python bench.py --server ws --baseline bench.json   # échoue si les performances régressent
+    python bench.py --server ws --batch 10              # mesures groupées par 10 envois dans une trame "batch"
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+SERVERS = {"ws": "ws_server.py", "fusion": "server_fusion.py"}
+TELEMETRY = (
+    {"action": "battery", "value": 80},
+    {"action": "gps", "latitude": 48.8566, "longitude": 2.3522},
+    {"action": "altitude", "value": 120.5},
+    {"action": "speed", "value": 12.0},
+)
+COMMANDS = ("pause", "resume", "hover")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+class WsClient:
+    """Client du protocole JSON de ws_server.py."""
+
+    def __init__(self, port):
+        self.url = f"ws://127.0.0.1:{port}"
+        self.websocket = None
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.url, max_size=None)
+
+    async def identify(self, payload):
+        await self.websocket.send(json.dumps(payload))
+        reply = json.loads(await self.websocket.recv())
+        if reply.get("status") != "ok":
+            raise RuntimeError(f"identify refusé: {reply}")
+
+    async def send(self, data):
+        await self.websocket.send(json.dumps(data))
+
+    async def events(self):
+        """Itère sur les messages reçus : (événement, données)."""
+        async for message in self.websocket:
+            data = json.loads(message)
+            yield ("error" if data.get("status") == "error" else "message"), data
+
+    async def close(self):
+        await self.websocket.close()
+
+
+class SioClient:
+    """
+    Client Socket.IO minimal pour server_fusion.py (Engine.IO 4, transport
+    websocket, messages JSON seulement) : pas de dépendance en plus de websockets.
+    """
+
+    def __init__(self, port):
+        self.url = f"ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket"
+        self.websocket = None
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.url, max_size=None)
+        await self.websocket.recv()  # paquet "open" d'Engine.IO
+        await self.websocket.send("40")
+        await self.websocket.recv()  # connexion au namespace par défaut
+
+    async def identify(self, payload):
+        await self._emit("identify", payload)
+        async for event, data in self.events():
+            if event == "registered":
+                return
+            if event == "error":
+                raise RuntimeError(f"identify refusé: {data}")
+
+    async def send(self, data):
+        await self._emit("message", data)
+
+    async def _emit(self, event, data):
+        await self.websocket.send("42" + json.dumps([event, data]))
+
+    async def events(self):
+        while True:
+            packet = await self.websocket.recv()
+            if packet == "2":
+                await self.websocket.send("3")  # ping -> pong
+            elif packet.startswith("42"):
+                event, *args = json.loads(packet[2:])
+                yield event, args[0] if args else None
+
+    async def close(self):
+        await self.websocket.close()
+
+
+class Results:
+    """Compteurs et latences d'une exécution."""
+
+    def __init__(self):
+        self.sent = {"telemetry": 0, "command": 0}
+        self.received = {"telemetry": 0, "command": 0}
+        self.latencies = {"telemetry": [], "command": []}
+        self.errors = 0
+
+    def receive(self, kind, data):
+        if isinstance(data, dict) and data.get("action") == "batch":
+            for sample in data.get("samples", ()):
+                self.receive(kind, sample)
+            return
+        sent_at = data.get("bench_t") if isinstance(data, dict) else None
+        if sent_at is None:
+            return
+        self.received[kind] += 1
+        self.latencies[kind].append((time.perf_counter() - sent_at) * 1000)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))], 3)
+
+
+class ProcessSampler:
+    """Temps CPU et mémoire d'un processus, lus dans /proc (Linux)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+
+    def memory_kb(self):
+        memory = {}
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    memory[key] = int(value.split()[0])
+        return memory.get("VmRSS"), memory.get("VmHWM")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port, process, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"le serveur s'est arrêté (code {process.returncode})")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"le serveur n'écoute pas sur le port {port}")
+
+
+async def receive(client, kind, results):
+    try:
+        async for event, data in client.events():
+            if event == "error":
+                results.errors += 1
+            elif event == "message":
+                results.receive(kind, data)
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def run_raspberry(client, rate, stop_at, results, batch=1):
+    """Télémétrie à `rate` Hz ; avec batch > 1, les mesures de `batch` envois partent dans une trame "batch"."""
+    interval = 1 / rate
+    next_time = time.perf_counter()
+    samples = []
+    while next_time < stop_at:
+        for message in TELEMETRY:
+            data = dict(message)
+            data["bench_t"] = time.perf_counter()
+            if batch > 1:
+                data["t"] = time.time()
+                samples.append(data)
+            else:
+                await client.send(data)
+            results.sent["telemetry"] += 1
+        if len(samples) >= batch * len(TELEMETRY):
+            await client.send({"action": "batch", "samples": samples})
+            samples = []
+        next_time += interval
+        await asyncio.sleep(max(0, next_time - time.perf_counter()))
+    if samples:
+        await client.send({"action": "batch", "samples": samples})
+
+
+async def run_flutter(client, rate, stop_at, results):
+    interval = 1 / rate
+    next_time = time.perf_counter()
+    i = 0
+    while next_time < stop_at:
+        await client.send({"action": "command", "command": COMMANDS[i % len(COMMANDS)], "bench_t": time.perf_counter()})
+        results.sent["command"] += 1
+        i += 1
+        next_time += interval
+        await asyncio.sleep(max(0, next_time - time.perf_counter()))
+
+
+async def bench_server(name, args):
+    """Lance un serveur, le met sous charge et retourne ses résultats."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SERVERS[name])
+    client_class = WsClient if name == "ws" else SioClient
+    port = args.port or free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, PORT=str(port), JOURNAL_DIR=os.path.join(workdir, "journal"))
+        process = subprocess.Popen([sys.executable, script], cwd=workdir, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await wait_for_port(port, process)
+            results = Results()
+            clients = []
+            # Flutter d'abord : la télémétrie de la Raspberry a tout de suite un destinataire.
+            for client_type in ("flutter", "raspberry"):
+                for i in range(args.drones):
+                    client = client_class(port)
+                    await client.connect()
+                    await client.identify({"type": client_type, "drone_id": f"bench-{i}"})
+                    clients.append((client_type, client))
+            receivers = [asyncio.create_task(receive(client, "telemetry" if client_type == "flutter" else "command", results))
+                         for client_type, client in clients]
+            sampler = ProcessSampler(process.pid)
+            cpu_start = sampler.cpu_seconds()
+            started = time.perf_counter()
+            stop_at = started + args.duration
+            senders = [run_raspberry(client, args.rate, stop_at, results, args.batch) if client_type == "raspberry"
+                       else run_flutter(client, args.command_rate, stop_at, results)
+                       for client_type, client in clients]
+            await asyncio.gather(*senders)
+            elapsed = time.perf_counter() - started
+            await asyncio.sleep(args.drain)  # laisse arriver les dernières trames
+            cpu = sampler.cpu_seconds() - cpu_start
+            rss, peak_rss = sampler.memory_kb()
+            for task in receivers:
+                task.cancel()
+            for _, client in clients:
+                await client.close()
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {"script": SERVERS[name], "elapsed_s": round(elapsed, 3), "errors": results.errors,
+              "cpu_percent": round(100 * cpu / (elapsed + args.drain), 1), "rss_kb": rss, "peak_rss_kb": peak_rss}
+    for kind in ("telemetry", "command"):
+        latencies = sorted(results.latencies[kind])
+        report[kind] = {
+            "sent": results.sent[kind],
+            "received": results.received[kind],
+            "dropped": results.sent[kind] - results.received[kind],
+            "throughput_per_s": round(results.received[kind] / elapsed, 1),
+            "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                           "p99": percentile(latencies, 99), "max": round(latencies[-1], 3) if latencies else None},
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{report['script']}: CPU {report['cpu_percent']}%, RSS {report['rss_kb']} ko "
+          f"(pic {report['peak_rss_kb']} ko), erreurs {report['errors']}")
+    for kind in ("telemetry", "command"):
+        r = report[kind]
+        latency = r["latency_ms"]
+        print(f"  {kind:9} {r['throughput_per_s']:>9}/s  envoyés {r['sent']}  perdus {r['dropped']}  "
+              f"p50 {latency['p50']} ms  p95 {latency['p95']} ms  p99 {latency['p99']} ms")
+
+
+def compare(results, baseline, tolerance):
+    """Compare à une exécution précédente ; retourne la liste des régressions."""
+    regressions = []
+    for name, report in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for kind in ("telemetry", "command"):
+            now, before = report[kind], previous[kind]
+            if before["throughput_per_s"] and now["throughput_per_s"] < before["throughput_per_s"] * (1 - tolerance):
+                regressions.append(f"{name} {kind}: débit {before['throughput_per_s']} -> {now['throughput_per_s']}/s")
+            p99, p99_before = now["latency_ms"]["p99"], before["latency_ms"]["p99"]
+            if p99 is not None and p99_before and p99 > p99_before * (1 + tolerance):
+                regressions.append(f"{name} {kind}: p99 {p99_before} -> {p99} ms")
+            if now["dropped"] > before["dropped"]:
+                regressions.append(f"{name} {kind}: perdus {before['dropped']} -> {now['dropped']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc de charge de ws_server.py et server_fusion.py")
+    parser.add_argument("--server", choices=["ws", "fusion", "both"], default="both")
+    parser.add_argument("--drones", type=int, default=5, help="nombre de paires Raspberry/Flutter")
+    parser.add_argument("--rate", type=float, default=10, help="télémétrie : envois par seconde de chaque action, par Raspberry")
+    parser.add_argument("--batch", type=int, default=1, help="envois de télémétrie groupés par trame \"batch\" (1 : une trame par mesure)")
+    parser.add_argument("--command-rate", type=float, default=1, help="commandes par seconde, par Flutter")
+    parser.add_argument("--duration", type=float, default=10, help="durée de la charge en secondes")
+    parser.add_argument("--drain", type=float, default=1, help="attente des dernières trames après la charge")
+    parser.add_argument("--port", type=int, default=0, help="port du serveur (libre au hasard par défaut)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="résultats précédents à comparer")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="écart toléré avec --baseline (0.2 = 20 %%)")
+    args = parser.parse_args()
+
+    names = ["ws", "fusion"] if args.server == "both" else [args.server]
+    results = {}
+    for name in names:
+        results[name] = asyncio.run(bench_server(name, args))
+        print_report(results[name])
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+    with open(args.output, "w") as f:
+        json.dump({"date": datetime.datetime.now().isoformat(), "config": config, "results": results}, f, indent=4)
+    print(f"Résultats écrits dans {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Régression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
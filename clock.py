@@ -0,0 +1,96 @@
+"""
+Horloges des clients et latence de chaque saut d'un message.
+
+Toutes les heures de traçage sont des entiers en nanosecondes depuis l'epoch
+(time.time_ns()), chacune prise dans l'horloge de celui qui la note. Elles ne
+sont mises en forme que par les dashboards (voir live.py).
+
+Un client qui s'identifie avec {"trace": true} reçoit régulièrement
+    {"action": "ping", "server_ns": T1}
+et répond
+    {"action": "pong", "server_ns": T1, "client_ns": T2}
+Le serveur, qui reçoit la réponse à T3, en déduit le décalage de l'horloge du
+client : T2 - (T1 + T3) / 2, à un demi-aller-retour près. Parmi les derniers
+échanges, celui dont l'aller-retour est le plus court (le moins retardé par les
+files d'attente) est retenu, comme le fait NTP.
+
+Un message qui porte "sent_ns" (heure d'envoi, horloge de l'émetteur) est relayé
+avec les heures de chaque saut, dans l'horloge du serveur :
+    "hops": {"sent_ns": ..., "origin_ns": ..., "rx_ns": ..., "fwd_ns": ...}
+origin_ns est sent_ns ramené à l'horloge du serveur (null si le décalage de
+l'émetteur n'est pas encore connu). Le destinataire renvoie
+    {"action": "trace", "hops": {...}, "recv_ns": T}
+avec son heure de réception, ce qui donne la latence serveur -> destinataire et
+la latence de bout en bout. Les latences sont exposées sur /metrics par drone.
+Les trames binaires (voir codec.py) n'ont pas de place pour ces heures : le
+traçage se fait en JSON.
+"""
+import os
+import time
+from collections import deque
+
+import metrics
+
+# Intervalle entre deux pings d'un client tracé, en secondes.
+CLOCK_PING_INTERVAL = float(os.environ.get("CLOCK_PING_INTERVAL", 5))
+# Nombre d'échanges ping/pong gardés pour choisir le meilleur.
+CLOCK_WINDOW = 8
+# Nombre maximum de drones distingués dans les latences de /metrics ; les suivants sont comptés sous "other".
+LATENCY_MAX_DRONES = int(os.environ.get("LATENCY_MAX_DRONES", 100))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LATENCY = metrics.histogram("one_way_latency_seconds", "Latence d'un saut de message, par drone",
+                            ("drone", "hop"), LATENCY_BUCKETS)
+CLOCK_RTT = metrics.histogram("clock_ping_rtt_seconds", "Aller-retour des pings d'horloge", ("client_type",),
+                              LATENCY_BUCKETS)
+_labelled = set()  # drones qui ont leur propre série de latence
+
+
+class ClockOffset:
+    """Décalage estimé de l'horloge d'un client par rapport à celle du serveur."""
+
+    def __init__(self, window=CLOCK_WINDOW):
+        self.samples = deque(maxlen=window)  # (aller-retour, décalage) en ns
+        self.offset = None
+        self.rtt = None
+
+    def add(self, sent_ns, client_ns, received_ns):
+        """Ajoute un échange ping/pong ; retourne False s'il est incohérent."""
+        rtt = received_ns - sent_ns
+        if rtt < 0:
+            return False
+        self.samples.append((rtt, client_ns - (sent_ns + received_ns) // 2))
+        self.rtt, self.offset = min(self.samples)
+        return True
+
+    def to_server(self, client_ns):
+        """Heure du client ramenée à l'horloge du serveur (None tant qu'aucun ping n'a abouti)."""
+        if self.offset is None:
+            return None
+        return client_ns - self.offset
+
+
+def ping():
+    return {"action": "ping", "server_ns": time.time_ns()}
+
+
+def observe(drone_id, hop, latency_ns):
+    """`drone_id` a été validé par identify (voir fleet.check_drone_id)."""
+    if drone_id not in _labelled:
+        if len(_labelled) >= LATENCY_MAX_DRONES:
+            drone_id = "other"
+        else:
+            _labelled.add(drone_id)
+    # Une latence négative ne vient que de l'incertitude sur le décalage.
+    LATENCY.observe(max(0, latency_ns) / 1e9, drone_id, hop)
+
+
+def stamp_forward(messages):
+    """Heure de sortie du serveur, juste avant l'envoi au pair, pour les messages tracés."""
+    fwd_ns = None
+    for data in messages:
+        hops = data.get("hops")
+        if isinstance(hops, dict):
+            if fwd_ns is None:
+                fwd_ns = time.time_ns()
+            hops["fwd_ns"] = fwd_ns
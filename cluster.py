@@ -0,0 +1,344 @@
+"""
+Mode multi-worker de ws_server.py : plusieurs processus partagent le port
+d'écoute (SO_REUSEPORT), et un bus local relie les workers entre eux.
+
+Chaque drone appartient à un seul worker, choisi par owner() à partir de son
+drone_id : c'est le seul qui lit et modifie son état (statistiques, commandes,
+journal), sans verrou entre processus. Quand le noyau confie la connexion d'un
+client à un autre worker, celui-ci ne garde que la socket : les trames reçues
+partent par le bus vers le propriétaire du drone, qui les traite avec le
+handler habituel (le client y est vu comme une RemoteConnection), et les
+trames à envoyer reviennent par le même chemin.
+
+Le bus a deux implémentations interchangeables :
+- UnixBus : une socket UNIX par worker (BUS_DIR/worker-<n>.sock), trames
+  préfixées par leur longueur ;
+- LocalBus : dans le même processus, pour les tests.
+
+Une trame à envoyer (SEND) garde sa clé de fusion et sa priorité : la file du
+worker qui tient la socket (outbound.PeerSender) applique la même limite, la
+même fusion de la télémétrie et la même voie prioritaire qu'en mono-worker.
+"""
+import asyncio
+import json
+import os
+import struct
+import zlib
+
+import websockets
+
+import metrics
+from fleet import DEFAULT_DRONE_ID
+from outbound import DEFAULT_MAX_QUEUE, PeerSender
+
+# Types de messages du bus.
+# Worker de la connexion -> propriétaire du drone : ouverture (trame identify), trame reçue,
+# fermeture (code de fermeture de la socket).
+OPEN, FRAME, CLOSE = 1, 2, 3
+# Propriétaire du drone -> worker de la connexion : trame à envoyer, fermeture demandée.
+SEND, SHUT = 4, 5
+
+KIND_NAMES = {OPEN: "open", FRAME: "frame", CLOSE: "close", SEND: "send", SHUT: "shut"}
+
+# kind, worker d'origine, identifiant de connexion (propre au worker de la socket), type de contenu,
+# drapeaux, longueur de la clé de fusion, longueur du contenu ; puis la clé, puis le contenu.
+_HEADER = struct.Struct("!BHIBBHI")
+_NONE, _TEXT, _BINARY = 0, 1, 2
+_PRIORITY = 0x01
+
+# Au-delà de ce nombre d'octets en attente vers un worker, l'envoi attend que la socket se vide.
+HIGH_WATER = 1 << 20
+
+BUS_MESSAGES = metrics.counter("bus_messages_total", "Messages envoyés aux autres workers", ("kind",))
+
+
+def owner(drone_id, workers):
+    """Worker propriétaire d'un drone (même règle de drone_id par défaut que Fleet.register)."""
+    key = str(drone_id) if drone_id else DEFAULT_DRONE_ID
+    return zlib.crc32(key.encode("utf-8")) % workers
+
+
+def encode(kind, origin, conn, payload, key=None, priority=False):
+    if payload is None:
+        payload_type, data = _NONE, b""
+    elif isinstance(payload, str):
+        payload_type, data = _TEXT, payload.encode("utf-8")
+    else:
+        payload_type, data = _BINARY, bytes(payload)
+    key_data = key.encode("utf-8") if key is not None else b""
+    flags = _PRIORITY if priority else 0
+    return _HEADER.pack(kind, origin, conn, payload_type, flags, len(key_data), len(data)) + key_data + data
+
+
+async def read_message(reader):
+    """
+    Lit un message du bus : (kind, origin, conn, payload, key, priority).
+    Lève IncompleteReadError en fin de flux.
+    """
+    kind, origin, conn, payload_type, flags, key_length, length = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    key = (await reader.readexactly(key_length)).decode("utf-8") if key_length else None
+    data = await reader.readexactly(length) if length else b""
+    if payload_type == _NONE:
+        payload = None
+    elif payload_type == _TEXT:
+        payload = data.decode("utf-8")
+    else:
+        payload = data
+    return kind, origin, conn, payload, key, bool(flags & _PRIORITY)
+
+
+class UnixBus:
+    """Bus entre processus : chaque worker écoute sur sa socket UNIX et se connecte aux autres à la demande."""
+
+    def __init__(self, worker, workers, directory):
+        self.worker = worker
+        self.workers = workers
+        self.directory = directory
+        self.on_message = None
+        self.server = None
+        self.writers = {}  # worker -> StreamWriter (une connexion par sens : l'ordre des messages est gardé)
+        self.locks = {}
+        self.incoming = {}  # tâche de lecture -> StreamWriter, connexions ouvertes par les autres workers
+
+    def path(self, worker):
+        return os.path.join(self.directory, f"worker-{worker}.sock")
+
+    async def start(self, on_message):
+        self.on_message = on_message
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(self.worker)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = await asyncio.start_unix_server(self._serve, path)
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        self.incoming[task] = writer
+        try:
+            while True:
+                kind, origin, conn, payload, key, priority = await read_message(reader)
+                self.on_message(origin, kind, conn, payload, key, priority)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.incoming.pop(task, None)
+            writer.close()
+
+    async def _writer(self, worker):
+        writer = self.writers.get(worker)
+        if writer is not None and not writer.is_closing():
+            return writer
+        lock = self.locks.setdefault(worker, asyncio.Lock())
+        async with lock:
+            writer = self.writers.get(worker)
+            if writer is not None and not writer.is_closing():
+                return writer
+            # Au démarrage, l'autre worker n'écoute peut-être pas encore.
+            for _ in range(50):
+                try:
+                    _, writer = await asyncio.open_unix_connection(self.path(worker))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    await asyncio.sleep(0.1)
+            else:
+                raise ConnectionError(f"worker {worker} injoignable")
+            self.writers[worker] = writer
+            return writer
+
+    async def send(self, worker, kind, conn, payload=None, key=None, priority=False):
+        writer = await self._writer(worker)
+        writer.write(encode(kind, self.worker, conn, payload, key, priority))
+        BUS_MESSAGES.inc(KIND_NAMES[kind])
+        if writer.transport.get_write_buffer_size() > HIGH_WATER:
+            await writer.drain()
+
+    async def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        # Fermer les connexions entrantes termine leurs tâches de lecture (fin de flux) ; on
+        # les attend pour qu'aucune ne soit annulée à la fermeture de la boucle.
+        tasks = list(self.incoming)
+        for writer in self.incoming.values():
+            writer.close()
+        if tasks:
+            await asyncio.wait(tasks, timeout=1.0)
+        try:
+            os.unlink(self.path(self.worker))
+        except FileNotFoundError:
+            pass
+
+
+class LocalBus:
+    """
+    Bus dans un seul processus : les workers partagent le dict `hub`. Les
+    messages sont livrés par la boucle asyncio (call_soon), dans l'ordre d'envoi.
+    """
+
+    def __init__(self, worker, workers, hub):
+        self.worker = worker
+        self.workers = workers
+        self.hub = hub  # worker -> callback on_message
+
+    async def start(self, on_message):
+        self.hub[self.worker] = on_message
+
+    async def send(self, worker, kind, conn, payload=None, key=None, priority=False):
+        on_message = self.hub.get(worker)
+        if on_message is None:
+            raise ConnectionError(f"worker {worker} injoignable")
+        BUS_MESSAGES.inc(KIND_NAMES[kind])
+        asyncio.get_running_loop().call_soon(on_message, self.worker, kind, conn, payload, key, priority)
+
+    async def close(self):
+        self.hub.pop(self.worker, None)
+
+
+class RemoteConnection:
+    """
+    Chez le propriétaire du drone : un client connecté à un autre worker, avec
+    l'interface de websocket utilisée par le handler (itération, send).
+    """
+
+    def __init__(self, bus, worker, conn):
+        self.bus = bus
+        self.worker = worker  # worker qui tient la socket
+        self.conn = conn
+        self.frames = asyncio.Queue()  # trames reçues ; None quand la socket est fermée
+        self.closed = False
+        self.close_code = None  # code de fermeture de la socket, comme websocket.close_code
+
+    def __aiter__(self):
+        return self._frames()
+
+    async def _frames(self):
+        while True:
+            frame = await self.frames.get()
+            if frame is None:
+                self.closed = True
+                return
+            yield frame
+
+    async def recv(self):
+        frame = await self.frames.get()
+        if frame is None:
+            self.closed = True
+            raise ConnectionError("connexion fermée")
+        return frame
+
+    async def send(self, frame, key=None, priority=False):
+        if self.closed:
+            raise ConnectionError("connexion fermée")
+        await self.bus.send(self.worker, SEND, self.conn, frame, key, priority)
+
+    def sender(self, max_queue=DEFAULT_MAX_QUEUE):
+        return RemoteSender(self, max_queue)
+
+
+class RemoteSender(PeerSender):
+    """File d'envoi d'une RemoteConnection : chaque trame part sur le bus avec sa clé de fusion et sa priorité."""
+
+    async def write(self, frame, key, priority):
+        await self.websocket.send(frame, key, priority)
+
+
+class Cluster:
+    """
+    Un worker du cluster. `handler(websocket, ident_msg)` est le handler de
+    connexion du serveur, appelé ici pour les clients des drones de ce worker,
+    qu'ils soient connectés à ce worker ou à un autre.
+    """
+
+    def __init__(self, bus, handler, max_queue=DEFAULT_MAX_QUEUE):
+        self.bus = bus
+        self.max_queue = max_queue  # limite des files d'envoi des clients connectés ici (outbound.PeerSender)
+        self.worker = bus.worker
+        self.workers = bus.workers
+        self.handler = handler
+        self.remote = {}  # (worker, conn) -> RemoteConnection : nos drones, clients connectés ailleurs
+        self.local = {}   # conn -> (websocket, PeerSender) : clients connectés ici, drones d'un autre worker
+        self.next_conn = 0
+
+    async def start(self):
+        await self.bus.start(self.on_message)
+
+    async def close(self):
+        await self.bus.close()
+
+    async def accept(self, websocket):
+        """Nouvelle connexion : traitée ici si le drone est à ce worker, relayée à son propriétaire sinon."""
+        ident_msg = await websocket.recv()
+        try:
+            ident_data = json.loads(ident_msg)
+            drone_id = ident_data.get("drone_id") if isinstance(ident_data, dict) else None
+        except ValueError:
+            drone_id = None  # le handler répondra l'erreur
+        target = owner(drone_id, self.workers)
+        if target == self.worker:
+            await self.handler(websocket, ident_msg)
+        else:
+            await self.proxy(websocket, target, ident_msg)
+
+    async def proxy(self, websocket, target, ident_msg):
+        self.next_conn = (self.next_conn + 1) & 0xFFFFFFFF
+        conn = self.next_conn
+        sender = PeerSender(websocket, self.max_queue)
+        sender.start()
+        self.local[conn] = (websocket, sender)
+        try:
+            await self.bus.send(target, OPEN, conn, ident_msg)
+            async for message in websocket:
+                await self.bus.send(target, FRAME, conn, message)
+        except (websockets.ConnectionClosed, ConnectionError):
+            pass
+        finally:
+            self.local.pop(conn, None)
+            await sender.close()
+            code = websocket.close_code
+            try:
+                await self.bus.send(target, CLOSE, conn, str(code) if code is not None else None)
+            except ConnectionError:
+                pass
+
+    def on_message(self, origin, kind, conn, payload, key=None, priority=False):
+        if kind == OPEN:
+            connection = RemoteConnection(self.bus, origin, conn)
+            self.remote[(origin, conn)] = connection
+            asyncio.ensure_future(self._serve_remote(connection, payload))
+        elif kind in (FRAME, CLOSE):
+            connection = self.remote.get((origin, conn))
+            if connection is not None:
+                if kind == CLOSE and payload is not None:
+                    connection.close_code = int(payload)
+                connection.frames.put_nowait(payload if kind == FRAME else None)
+        elif kind == SEND:
+            entry = self.local.get(conn)
+            if entry is not None:
+                entry[1].send(payload, key, priority)
+        elif kind == SHUT:
+            entry = self.local.get(conn)
+            if entry is not None:
+                asyncio.ensure_future(self._shut(*entry))
+
+    async def _serve_remote(self, connection, ident_msg):
+        try:
+            await self.handler(connection, ident_msg)
+        finally:
+            self.remote.pop((connection.worker, connection.conn), None)
+            if not connection.closed:
+                connection.closed = True
+                try:
+                    await self.bus.send(connection.worker, SHUT, connection.conn)
+                except ConnectionError:
+                    pass
+
+    async def _shut(self, websocket, sender):
+        """Le propriétaire a fermé la connexion : envoie ce qui reste en file, puis ferme la socket."""
+        for _ in range(100):
+            if not sender.depth() or sender.closed:
+                break
+            await asyncio.sleep(0.01)
+        await websocket.close()
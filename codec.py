@@ -0,0 +1,113 @@
+"""
+Encodage binaire compact de la télémétrie, négocié pendant `identify` avec
+{"encoding": "binary"}. Une trame binaire contient un ou plusieurs enregistrements :
+
+    en-tête  : magic (1 octet) | version (1 octet) | nombre d'enregistrements (uint16)
+    record   : tag de l'action (1 octet) | champs à taille fixe (little-endian)
+
+Les commandes et les autres messages restent en JSON (trames texte).
+"""
+
+import math
+import struct
+
+MAGIC = 0xD7
+VERSION = 1
+ENCODINGS = ("json", "binary")
+
+_HEADER = struct.Struct("<BBH")
+_TAG = struct.Struct("<B")
+_LENGTH = struct.Struct("<B")
+
+# action -> (tag, format des champs, noms des champs)
+_LAYOUTS = {
+    "battery": (1, struct.Struct("<d"), ("value",)),
+    "gps": (2, struct.Struct("<dd"), ("latitude", "longitude")),
+    "altitude": (3, struct.Struct("<d"), ("value",)),
+    "speed": (4, struct.Struct("<d"), ("value",)),
+}
+# flight_mode est une chaîne : tag 5, longueur (1 octet), texte UTF-8
+_FLIGHT_MODE_TAG = 5
+_BY_TAG = {tag: (action, layout, fields) for action, (tag, layout, fields) in _LAYOUTS.items()}
+
+MAX_RECORDS = 0xFFFF
+
+
+def _number(value):
+    if value is None:
+        return math.nan  # NaN = valeur absente
+    return float(value)
+
+
+def _json_number(value):
+    if math.isnan(value):
+        return None
+    return int(value) if value.is_integer() else value
+
+
+def can_encode(data):
+    """True si le message peut être transmis dans une trame binaire."""
+    action = data.get("action")
+    if action == "flight_mode":
+        value = data.get("value")
+        return isinstance(value, str) and len(value.encode("utf-8")) <= 0xFF
+    layout = _LAYOUTS.get(action)
+    if layout is None:
+        return False
+    for field in layout[2]:
+        value = data.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            return False
+    return True
+
+
+def encode_batch(messages):
+    """Encode une liste de messages (dicts acceptés par can_encode) en une seule trame binaire."""
+    if len(messages) > MAX_RECORDS:
+        raise ValueError("Too many records in one frame")
+    parts = [_HEADER.pack(MAGIC, VERSION, len(messages))]
+    for data in messages:
+        action = data["action"]
+        if action == "flight_mode":
+            text = data["value"].encode("utf-8")
+            parts.append(_TAG.pack(_FLIGHT_MODE_TAG) + _LENGTH.pack(len(text)) + text)
+            continue
+        tag, layout, fields = _LAYOUTS[action]
+        parts.append(_TAG.pack(tag) + layout.pack(*[_number(data.get(field)) for field in fields]))
+    return b"".join(parts)
+
+
+def decode_batch(frame):
+    """Décode une trame binaire en liste de messages JSON. Lève ValueError si la trame est invalide."""
+    try:
+        magic, version, count = _HEADER.unpack_from(frame, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Unknown binary frame")
+        offset = _HEADER.size
+        messages = []
+        for _ in range(count):
+            (tag,) = _TAG.unpack_from(frame, offset)
+            offset += _TAG.size
+            if tag == _FLIGHT_MODE_TAG:
+                (length,) = _LENGTH.unpack_from(frame, offset)
+                offset += _LENGTH.size
+                text = bytes(frame[offset:offset + length])
+                if len(text) != length:
+                    raise ValueError("Truncated binary frame")
+                offset += length
+                messages.append({"action": "flight_mode", "value": text.decode("utf-8")})
+                continue
+            if tag not in _BY_TAG:
+                raise ValueError(f"Unknown record tag {tag}")
+            action, layout, fields = _BY_TAG[tag]
+            values = layout.unpack_from(frame, offset)
+            offset += layout.size
+            data = {"action": action}
+            for field, value in zip(fields, values):
+                data[field] = _json_number(value)
+            messages.append(data)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid binary frame: {e}") from e
+    if offset != len(frame):
+        raise ValueError("Trailing bytes in binary frame")
+    return messages
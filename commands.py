@@ -0,0 +1,69 @@
+import json
+import os
+
+# Délai avant de renvoyer une commande non acquittée, et nombre de renvois autorisés.
+ACK_TIMEOUT = float(os.environ.get("COMMAND_ACK_TIMEOUT", 0.5))
+MAX_RETRIES = int(os.environ.get("COMMAND_MAX_RETRIES", 3))
+
+
+class PendingCommand:
+    """Commande envoyée à la Raspberry et pas encore acquittée."""
+
+    def __init__(self, seq, data, frame, now):
+        self.seq = seq
+        self.data = data
+        self.frame = frame
+        self.received_at = now  # réception de la commande Flutter par le serveur
+        self.sent_at = now      # dernier envoi à la Raspberry
+        self.attempts = 1
+
+
+class CommandScheduler:
+    """
+    Numérotation et acquittement des commandes Flutter -> Raspberry d'un drone.
+
+    Chaque commande reçoit un numéro de séquence ("seq"). Si la Raspberry a annoncé
+    qu'elle acquitte les commandes ({"ack": true} dans identify), elle répond
+    {"action": "ack", "seq": N} ; sans réponse après `timeout` secondes, la
+    commande est renvoyée, au plus `max_retries` fois, puis déclarée en échec.
+    Les temps sont ceux de time.monotonic().
+    """
+
+    def __init__(self, timeout=ACK_TIMEOUT, max_retries=MAX_RETRIES):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.next_seq = 1
+        self.pending = {}  # seq -> PendingCommand
+
+    def submit(self, data, now, track=True):
+        """Numérote une commande et retourne la trame JSON à envoyer."""
+        seq = self.next_seq
+        self.next_seq += 1
+        data["seq"] = seq
+        frame = json.dumps(data)
+        if track:
+            self.pending[seq] = PendingCommand(seq, data, frame, now)
+        return frame
+
+    def ack(self, seq, now):
+        """Acquittement reçu : retourne (commande, latence en secondes), ou None si seq est inconnu."""
+        command = self.pending.pop(seq, None)
+        if command is None:
+            return None
+        return command, now - command.received_at
+
+    def due(self, now):
+        """Retourne (commandes à renvoyer, commandes en échec) ; met à jour les compteurs d'envoi."""
+        retry = []
+        failed = []
+        for seq, command in list(self.pending.items()):
+            if now - command.sent_at < self.timeout:
+                continue
+            if command.attempts > self.max_retries:
+                del self.pending[seq]
+                failed.append(command)
+                continue
+            command.attempts += 1
+            command.sent_at = now
+            retry.append(command)
+        return retry, failed
@@ -0,0 +1,547 @@
+"""
+Traitement des messages commun aux deux serveurs.
+
+Chaque couple (type de client, action) a son handler dans un registre : le
+dispatch est une seule recherche dans un dict, suivie de la validation des
+champs, compilée une fois à l'enregistrement. ws_server.py et server_fusion.py
+ne font que décoder les trames, appeler Dispatcher.dispatch() et relayer.
+
+Un handler retourne DROP (ne pas relayer), RELAY (relayer la trame d'origine)
+ou REWRITTEN (relayer le message modifié, la trame d'origine n'est plus valable).
+Un message refusé lève Rejected, dont le texte est renvoyé au client.
+
+La Raspberry peut grouper ses mesures dans une trame "batch" :
+    {"action": "batch", "samples": [{"action": "battery", "value": 80, "t": 1718000000.25},
+                                    {"action": "gps", "latitude": 48.85, "longitude": 2.35, "t": 1718000000.5}]}
+"t" est l'heure de la mesure (secondes depuis l'epoch, facultative), accepté
+aussi hors lot ; il est ramené à l'horloge du serveur (voir sample_ns). Le lot est
+validé en entier puis appliqué en une passe, et relayé tel quel en une trame.
+
+Les heures enregistrées dans les statistiques (`now`, heure de réception de la
+trame) sont des entiers en nanosecondes (time.time_ns()), mis en forme seulement
+par les dashboards. Le traçage des messages ("sent_ns", ping/pong) est décrit
+dans clock.py.
+"""
+import math
+import os
+import time
+
+import clock
+import logs
+import metrics
+from analytics import load_geofences
+from fanout import RateLimiter
+from liveness import LivenessTracker
+
+DROP, RELAY, REWRITTEN = 0, 1, 2
+
+# Actions de télémétrie : vers un client en retard, seule la plus récente de chaque action est gardée.
+TELEMETRY_ACTIONS = {"battery", "gps", "altitude", "speed", "flight_mode"}
+
+# Nouvel état de mission pour chaque commande Flutter.
+COMMAND_STATES = {
+    "pause": "paused",
+    "resume": "running",
+    "stop": "stopped",
+    "return_home": "returning_home",
+    "hover": "hovering",
+}
+
+NUMBER = (int, float)
+
+# Actions permises à une application spectatrice (voir fanout.py) ; les autres
+# sont réservées à celle qui contrôle le drone.
+VIEWER_ACTIONS = {"pong", "trace", "delta_ack", "subscribe"}
+
+# Silence (en secondes) au-delà duquel le signal d'un drone est considéré perdu,
+# et celui de l'application Flutter (0 : pas de détection, les applications
+# actuelles n'envoient rien quand l'utilisateur ne fait rien).
+SIGNAL_LOSS_TIMEOUT = float(os.environ.get("SIGNAL_LOSS_TIMEOUT", 10))
+APP_SIGNAL_LOSS_TIMEOUT = float(os.environ.get("APP_SIGNAL_LOSS_TIMEOUT", 0))
+LIVENESS_TICK = 0.25
+
+# Actions acceptées dans un lot "batch", et nombre maximum de mesures par lot.
+BATCH_ACTIONS = ("battery", "altitude", "speed", "gps", "flight_mode")
+MAX_BATCH_SAMPLES = int(os.environ.get("MAX_BATCH_SAMPLES", 500))
+
+# Intervalle minimum entre deux événements "track" (distance, vitesse...) envoyés à Flutter.
+TRACK_EVENT_INTERVAL = float(os.environ.get("TRACK_EVENT_INTERVAL", 1.0))
+
+MESSAGES = metrics.counter("messages_total", "Messages reçus, par type de client et action", ("client_type", "action"))
+REJECTED = metrics.counter("messages_rejected_total", "Messages refusés, par type de client", ("client_type",))
+SIGNAL_LOST = metrics.counter("signal_lost_total", "Pertes de signal détectées, par type de client", ("client_type",))
+
+log_telemetry = logs.get("telemetry")
+log_command = logs.get("command")
+log_connection = logs.get("connection")
+
+
+class Rejected(ValueError):
+    """Message refusé : action inconnue ou interdite, champ manquant ou invalide."""
+
+
+def finite(value):
+    """Nombre représentable en float et fini."""
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+
+def compile_fields(fields):
+    """
+    Prépare la validation d'un message : `fields` est {nom: (types, obligatoire)}.
+    Un champ absent (ou null) n'est refusé que s'il est obligatoire. Un nombre
+    doit être fini : NaN, Infinity et les entiers trop grands pour un float sont refusés.
+    """
+    checks = tuple((name, types, required) for name, (types, required) in fields.items())
+    if not checks:
+        return None
+
+    def validate(data):
+        for name, types, required in checks:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise Rejected(f"Missing field: {name}")
+            elif not isinstance(value, types) or (types is NUMBER and not finite(value)):
+                raise Rejected(f"Invalid field: {name}")
+
+    return validate
+
+
+def conflation_key(messages):
+    """Clé de fusion d'une trame : None (jamais supprimée) si elle contient autre chose que de la télémétrie."""
+    actions = {data.get("action") for data in messages}
+    if actions <= TELEMETRY_ACTIONS:
+        return "+".join(sorted(actions))
+    return None
+
+
+def parse_rates(rates):
+    """Limites de débit demandées par un abonné : {action: messages par seconde} (voir fanout.py)."""
+    if not isinstance(rates, dict):
+        raise Rejected("Invalid field: rates")
+    parsed = {}
+    for action, rate in rates.items():
+        if action not in TELEMETRY_ACTIONS:
+            raise Rejected(f"Unknown telemetry action: {action}")
+        if rate is None or rate == 0:
+            continue
+        if isinstance(rate, bool) or not isinstance(rate, NUMBER) or not finite(rate) or rate < 0:
+            raise Rejected(f"Invalid rate for {action}")
+        parsed[action] = rate
+    return parsed
+
+
+class Dispatcher:
+    """
+    Registre (type de client, action) -> (handler, validation).
+
+    `notify(record, payload, priority=False)` envoie un message de contrôle à un
+    client (ex: command_ack vers Flutter) ; `changed()` signale que les
+    statistiques ont changé (persistence.mark_dirty). Ce sont les deux seuls
+    liens avec le transport.
+    """
+
+    def __init__(self, notify, changed):
+        self.notify = notify
+        self.changed = changed
+        self.handlers = {}
+        self.actions = set()
+        self.monitor = None  # SignalMonitor, prévenu de chaque message accepté
+        self.geofences = load_geofences()
+
+    def register(self, client_type, action, **fields):
+        def decorator(handler):
+            self.handlers[(client_type, action)] = (handler, compile_fields(fields))
+            self.actions.add(action)
+            return handler
+        return decorator
+
+    def dispatch(self, record, data, now):
+        """Applique un message aux statistiques du drone. Retourne DROP, RELAY ou REWRITTEN."""
+        client_type = record.client_type
+        action = data.get("action")
+        entry = self.handlers.get((client_type, action))
+        if entry is None:
+            MESSAGES.inc(client_type, "other")
+            REJECTED.inc(client_type)
+            if action in self.actions:
+                raise Rejected(f"Action not allowed for {client_type}")
+            raise Rejected("Unknown action")
+        if record.viewer and action not in VIEWER_ACTIONS:
+            REJECTED.inc(client_type)
+            raise Rejected("Action reserved to the controlling client")
+        MESSAGES.inc(client_type, action)
+        (log_command if action == "command" else log_telemetry).info("Message reçu", extra={"fields": {
+            "drone": record.drone.drone_id, "client_type": client_type, "data": data}})
+        record.drone.stats[client_type + "_messages"] += 1
+        handler, validate = entry
+        if validate is not None:
+            try:
+                validate(data)
+            except Rejected:
+                REJECTED.inc(client_type)
+                raise
+        if self.monitor is not None:
+            self.monitor.seen(record, time.monotonic())
+        sent_ns = data.get("sent_ns")
+        traced = type(sent_ns) is int
+        if traced:
+            trace_received(record, data, sent_ns, now)
+        try:
+            result = handler(self, record, data, now)
+        except Rejected:
+            REJECTED.inc(client_type)
+            raise
+        self.changed()
+        if traced and result == RELAY:
+            return REWRITTEN  # "hops" ajouté : la trame d'origine n'est plus à jour
+        return result
+
+
+def trace_received(record, data, sent_ns, now):
+    """Message tracé (voir clock.py) : latence émetteur -> serveur, et heures des sauts pour le destinataire."""
+    origin_ns = record.clock.to_server(sent_ns)
+    if origin_ns is not None:
+        clock.observe(record.drone.drone_id, f"{record.client_type}_to_server", now - origin_ns)
+    data["hops"] = {"sent_ns": sent_ns, "origin_ns": origin_ns, "rx_ns": now}
+
+
+class SignalMonitor:
+    """
+    Détection de perte de signal, par drone (Raspberry) et par application (Flutter).
+
+    Chaque message accepté compte comme un signe de vie (voir liveness.py). Quand
+    la Raspberry d'un drone se tait plus de SIGNAL_LOSS_TIMEOUT secondes,
+    l'action choisie par "set_signal_loss_mode" lui est envoyée en commande
+    prioritaire si elle est encore connectée (jamais gardée pour sa reconnexion)
+    et Flutter reçoit "signal_lost".
+    Quand la Raspberry reparle, Flutter reçoit "signal_restored". Un silence de
+    l'application est signalé à la Raspberry ("app_signal_lost"). Un client qui
+se déconnecte proprement n'est plus suivi (voir disconnected()).
+
+    tick() est appelé régulièrement par le serveur et retourne les drones dont
+    l'état a changé (à enregistrer dans le journal).
+    """
+
+    def __init__(self, dispatcher, fleet, drone_timeout=SIGNAL_LOSS_TIMEOUT, app_timeout=APP_SIGNAL_LOSS_TIMEOUT,
+                 tick=LIVENESS_TICK):
+        self.dispatcher = dispatcher
+        self.fleet = fleet
+        self.trackers = {}
+        now = time.monotonic()
+        if drone_timeout > 0:
+            self.trackers["raspberry"] = LivenessTracker(drone_timeout, tick, now=now)
+        if app_timeout > 0:
+            self.trackers["flutter"] = LivenessTracker(app_timeout, tick, now=now)
+        dispatcher.monitor = self
+
+    def seen(self, record, now):
+        tracker = self.trackers.get(record.client_type)
+        if tracker is None or record.viewer:
+            return
+        drone = record.drone
+        # signal_lost peut aussi venir du journal, rechargé au redémarrage du serveur.
+        if tracker.touch(drone.drone_id, now) or (record.client_type == "raspberry" and drone.stats.get("signal_lost")):
+            self.restored(drone, record.client_type)
+
+    def disconnected(self, record, clean):
+        """
+        Appelé après Fleet.unregister. Après une fermeture propre, le client n'est
+        plus suivi : pas de perte de signal à signaler. Sinon, la perte sera
+        constatée après le délai habituel (le client peut revenir avant).
+        """
+        tracker = self.trackers.get(record.client_type)
+        if tracker is None or record.viewer or not clean:
+            return
+        drone = record.drone
+        if drone.peers[record.client_type] is None:  # pas déjà remplacé par une nouvelle session
+            tracker.forget(drone.drone_id)
+
+    def tick(self, now):
+        changed = []
+        for client_type, tracker in self.trackers.items():
+            for drone_id in tracker.tick(now):
+                drone = self.fleet.drones.get(drone_id)
+                if drone is not None:
+                    self.lost(drone, client_type, now)
+                    changed.append(drone)
+        if changed:
+            self.dispatcher.changed()
+        return changed
+
+    def _send(self, drone, client_type, payload, now, priority=False, keep=True):
+        """
+        Envoie au client (et aux spectateurs), ou garde le message pour sa reconnexion
+        (voir outbox.py). Avec keep=False, le message est abandonné si le client est absent.
+        """
+        record = drone.peers[client_type]
+        if client_type == "flutter":
+            for viewer in list(drone.viewers.values()):
+                self.dispatcher.notify(viewer, payload, priority)
+        if record is None:
+            if keep:
+                drone.outboxes[client_type].add(payload, now)
+            return
+        if payload.get("action") == "command":
+            drone.commands.submit(payload, now, track=record.acks)
+        self.dispatcher.notify(record, payload, priority)
+
+    def lost(self, drone, client_type, now):
+        SIGNAL_LOST.inc(client_type)
+        stats = drone.stats
+        if client_type == "flutter":
+            log_connection.warning("Signal de l'application perdu", extra={"fields": {"drone": drone.drone_id}})
+            self._send(drone, "raspberry", {"action": "app_signal_lost", "drone_id": drone.drone_id}, now)
+            return
+        mode = stats.get("signal_loss_mode", "return_home")
+        stats["signal_lost"] = True
+        stats["signal_lost_time"] = time.time_ns()
+        state = COMMAND_STATES.get(mode)
+        if state is not None:
+            stats["mission_state"] = state
+        log_connection.warning("Signal du drone perdu", extra={"fields": {"drone": drone.drone_id, "mode": mode}})
+        # Commande de sécurité pour une Raspberry encore connectée mais muette : jamais gardée pour sa
+        # reconnexion, où elle serait rejouée après restored() et peut-être après de nouvelles commandes.
+        self._send(drone, "raspberry", {"action": "command", "command": mode, "reason": "signal_loss"}, now,
+                   priority=True, keep=False)
+        self._send(drone, "flutter", {"action": "signal_lost", "drone_id": drone.drone_id, "mode": mode}, now)
+
+    def restored(self, drone, client_type):
+        if client_type == "flutter":
+            log_connection.info("Signal de l'application retrouvé", extra={"fields": {"drone": drone.drone_id}})
+            return
+        drone.stats["signal_lost"] = False
+        log_connection.info("Signal du drone retrouvé", extra={"fields": {"drone": drone.drone_id}})
+        self._send(drone, "flutter", {"action": "signal_restored", "drone_id": drone.drone_id}, time.monotonic())
+
+
+def sample_ns(record, t, now):
+    """
+    Heure d'une mesure en ns, dans l'horloge du serveur. "t" vient de l'horloge du
+    client (la Raspberry n'a pas d'horloge RTC) : il est ramené par le décalage
+    estimé (voir clock.py) quand il est connu, et jamais après la réception `now`.
+    """
+    if t is None:
+        return now
+    t_ns = int(t * 1_000_000_000)
+    server_ns = record.clock.to_server(t_ns)
+    return min(t_ns if server_ns is None else server_ns, now)
+
+
+def scalar_handler(metric):
+    """Handler d'une valeur de télémétrie simple : last_<metric>, son heure et sa série temporelle."""
+    last_key = f"last_{metric}"
+    time_key = f"last_{metric}_time"
+
+    def handle(dispatcher, record, data, now):
+        drone = record.drone
+        value = data.get("value")
+        now = sample_ns(record, data.get("t"), now)
+        drone.stats[last_key] = value
+        drone.stats[time_key] = now
+        drone.telemetry.add(metric, value, now / 1e9)
+        return RELAY
+
+    return handle
+
+
+def handle_raspberry_gps(dispatcher, record, data, now):
+    drone = record.drone
+    stats = drone.stats
+    latitude = data.get("latitude")
+    longitude = data.get("longitude")
+    now = sample_ns(record, data.get("t"), now)
+    t = now / 1e9
+    stats["last_latitude"] = latitude
+    stats["last_longitude"] = longitude
+    stats["last_gps_time"] = now
+    drone.telemetry.add("latitude", latitude, t)
+    drone.telemetry.add("longitude", longitude, t)
+    if stats["start_latitude"] is None and stats["start_longitude"] is None:
+        stats["start_latitude"] = latitude
+        stats["start_longitude"] = longitude
+        stats["start_gps_time"] = now
+    if isinstance(latitude, NUMBER) and isinstance(longitude, NUMBER):
+        analyse_fix(dispatcher, drone, latitude, longitude, t)
+    return RELAY
+
+
+def analyse_fix(dispatcher, drone, latitude, longitude, t):
+    """
+    Distance, vitesse, temps de retour et zones pour un point GPS mesuré à `t`
+    (secondes depuis l'epoch, voir analytics.FlightTrack) ; les résultats partent vers Flutter.
+    """
+    stats = drone.stats
+    track = drone.track
+    track.update(stats, latitude, longitude, t)
+    subscribers = drone.subscribers()
+    geofences = dispatcher.geofences
+    if len(geofences):
+        inside = geofences.contains(latitude, longitude)
+        for event in geofences.transitions(track.inside, inside):
+            event["action"] = "geofence"
+            event["drone_id"] = drone.drone_id
+            (log_telemetry.warning if event["breach"] else log_telemetry.info)("Zone", extra={"fields": event})
+            for subscriber in subscribers:
+                dispatcher.notify(subscriber, event, event["breach"])
+            if drone.peers["flutter"] is None:
+                drone.outboxes["flutter"].add(event, time.monotonic())
+        track.inside = inside
+    if subscribers and t - track.last_event >= TRACK_EVENT_INTERVAL:
+        track.last_event = t
+        event = {
+            "action": "track",
+            "drone_id": drone.drone_id,
+            "distance_home_m": stats.get("distance_home_m"),
+            "total_distance_m": stats.get("total_distance_m"),
+            "ground_speed_mps": stats.get("ground_speed_mps"),
+            "return_home_eta_s": stats.get("return_home_eta_s"),
+        }
+        for subscriber in subscribers:
+            dispatcher.notify(subscriber, event)
+
+
+def handle_flight_mode(dispatcher, record, data, now):
+    stats = record.drone.stats
+    stats["last_flight_mode"] = data.get("value")
+    stats["last_flight_mode_time"] = sample_ns(record, data.get("t"), now)
+    return RELAY
+
+
+def handle_ack(dispatcher, record, data, now):
+    """Acquittement d'une commande par la Raspberry : mesure la latence et prévient Flutter."""
+    drone = record.drone
+    result = drone.commands.ack(data.get("seq"), time.monotonic())
+    if result is None:
+        return DROP
+    command, latency = result
+    latency_ms = round(latency * 1000, 1)
+    drone.stats["last_command_latency_ms"] = latency_ms
+    drone.telemetry.add("command_latency", latency_ms)
+    flutter = drone.peers["flutter"]
+    if flutter is not None:
+        dispatcher.notify(flutter, {"action": "command_ack", "seq": command.seq, "command": command.data.get("command"), "latency_ms": latency_ms})
+    return DROP
+
+
+def handle_command(dispatcher, record, data, now):
+    drone = record.drone
+    stats = drone.stats
+    command = data.get("command")
+    if command == "set_signal_loss_mode":
+        mode = data.get("mode", "return_home")
+        stats["signal_loss_mode"] = mode
+        log_command.info("Mode de perte de signal changé", extra={"fields": {"drone": drone.drone_id, "mode": mode}})
+        return DROP
+    stats["last_command"] = command
+    state = COMMAND_STATES.get(command)
+    if state is not None:
+        stats["mission_state"] = state
+    log_command.info("Commande reçue", extra={"fields": {"drone": drone.drone_id, "command": command, "state": stats["mission_state"]}})
+    return RELAY
+
+
+def handle_batch(dispatcher, record, data, now):
+    """
+    Lot de mesures de la Raspberry : tout est validé avant d'appliquer quoi que ce
+    soit, puis chaque mesure passe par le handler de son action, sans le coût du
+    dispatch (journalisation, compteurs, persistance), qui est payé une fois pour le lot.
+    """
+    samples = data["samples"]
+    if len(samples) > MAX_BATCH_SAMPLES:
+        raise Rejected(f"Too many samples (max {MAX_BATCH_SAMPLES})")
+    client_type = record.client_type
+    steps = []
+    for index, sample in enumerate(samples):
+        action = sample.get("action") if isinstance(sample, dict) else None
+        if action not in BATCH_ACTIONS:
+            raise Rejected(f"Invalid sample {index}")
+        handler, validate = dispatcher.handlers[(client_type, action)]
+        if validate is not None:
+            try:
+                validate(sample)
+            except Rejected as e:
+                raise Rejected(f"Sample {index}: {e}")
+        steps.append((handler, sample))
+    for handler, sample in steps:
+        handler(dispatcher, record, sample, now)
+        MESSAGES.inc(client_type, sample["action"])
+    return RELAY
+
+
+def handle_flutter_gps(dispatcher, record, data, now):
+    drone = record.drone
+    stats = drone.stats
+    stats["last_flutter_latitude"] = data.get("latitude")
+    stats["last_flutter_longitude"] = data.get("longitude")
+    stats["last_flutter_gps_time"] = now
+    log_telemetry.info("GPS Flutter reçu", extra={"fields": {
+        "drone": drone.drone_id, "latitude": stats["last_flutter_latitude"], "longitude": stats["last_flutter_longitude"]}})
+    data["handled_by"] = "server"
+    return REWRITTEN
+
+
+def handle_pong(dispatcher, record, data, now):
+    """Réponse à un ping d'horloge (voir clock.py) : met à jour le décalage estimé du client."""
+    client_clock = record.clock
+    if client_clock.add(data["server_ns"], data["client_ns"], now):
+        clock.CLOCK_RTT.observe((now - data["server_ns"]) / 1e9, record.client_type)
+        record.drone.stats[f"{record.client_type}_clock_offset_ms"] = round(client_clock.offset / 1e6, 3)
+    return DROP
+
+
+def handle_subscribe(dispatcher, record, data, now):
+    """Nouvelles limites de débit de la télémétrie vers ce client (voir fanout.py)."""
+    rates = parse_rates(data["rates"])
+    record.limiter = RateLimiter(rates) if rates else None
+    return DROP
+
+
+def handle_delta_ack(dispatcher, record, data, now):
+    """Le client a reçu une image complète du flux delta (voir delta.py)."""
+    if record.delta is not None:
+        record.delta.ack(data["key"])
+    return DROP
+
+
+def handle_trace(dispatcher, record, data, now):
+    """Heure de réception d'un message tracé, renvoyée par son destinataire (voir clock.py)."""
+    received_ns = record.clock.to_server(data["recv_ns"])
+    if received_ns is None:
+        return DROP
+    drone = record.drone
+    target = record.client_type
+    hops = data["hops"]
+    fwd_ns = hops.get("fwd_ns")
+    origin_ns = hops.get("origin_ns")
+    if type(fwd_ns) is int:
+        clock.observe(drone.drone_id, f"server_to_{target}", received_ns - fwd_ns)
+    if type(origin_ns) is int:
+        source = "flutter" if target == "raspberry" else "raspberry"
+        latency_ns = received_ns - origin_ns
+        clock.observe(drone.drone_id, f"{source}_to_{target}", latency_ns)
+        drone.telemetry.add("end_to_end_latency", latency_ns / 1e6)
+    return DROP
+
+
+def create_dispatcher(notify, changed):
+    """Registre des actions acceptées par les deux serveurs."""
+    dispatcher = Dispatcher(notify, changed)
+    for metric in ("battery", "altitude", "speed"):
+        dispatcher.register("raspberry", metric, value=(NUMBER, False), t=(NUMBER, False))(scalar_handler(metric))
+    dispatcher.register("raspberry", "gps", latitude=(NUMBER, False), longitude=(NUMBER, False),
+                        t=(NUMBER, False))(handle_raspberry_gps)
+    dispatcher.register("raspberry", "flight_mode", value=(str, False), t=(NUMBER, False))(handle_flight_mode)
+    dispatcher.register("raspberry", "batch", samples=(list, True))(handle_batch)
+    dispatcher.register("raspberry", "ack", seq=(int, True))(handle_ack)
+    dispatcher.register("flutter", "command", command=(str, True), mode=(str, False))(handle_command)
+    dispatcher.register("flutter", "gps", latitude=(NUMBER, False), longitude=(NUMBER, False))(handle_flutter_gps)
+    dispatcher.register("flutter", "delta_ack", key=(int, True))(handle_delta_ack)
+    dispatcher.register("flutter", "subscribe", rates=(dict, True))(handle_subscribe)
+    for client_type in ("raspberry", "flutter"):
+        dispatcher.register(client_type, "pong", server_ns=(int, True), client_ns=(int, True))(handle_pong)
+        dispatcher.register(client_type, "trace", hops=(dict, True), recv_ns=(int, True))(handle_trace)
+    return dispatcher
@@ -1,9 +1,20 @@
-from flask import Flask, render_template_string
+from flask import Flask, Response, request
+import glob
 import json
+import os
+import time
+
+import codec
+import history
+import recording
+from live import LIVE_SCRIPT, Viewer, dashboard_view
 
 # On crée une application Flask, qui va servir une page web pour afficher les statistiques du serveur WebSocket.
 app = Flask(__name__)
 
+# Intervalle (en secondes) entre deux vérifications de stats.json pour le flux en direct.
+STREAM_INTERVAL = 0.5
+
 # Ceci est le code HTML de la page web, avec du style et des blocs pour afficher les statistiques.
 # On utilise la syntaxe Jinja2 ({{ ... }}, {% ... %}) pour insérer dynamiquement les valeurs Python dans la page.
 TEMPLATE = """
@@ -11,12 +22,11 @@ TEMPLATE = """
 <html>
 <head>
     <title>Statistiques Serveur Drone</title>
-    <!-- La page se rafraîchit automatiquement toutes les 2 secondes -->
-    <meta http-equiv="refresh" content="2">
     <style>
         body { font-family: Arial, sans-serif; margin: 40px; background: #f8f9fa; }
         h1 { color: #2c3e50; }
         h2 { color: #1a7f37; margin-top: 40px; }
+        h3 { color: #2c3e50; margin-top: 30px; }
         table { border-collapse: collapse; margin-top: 10px; background: #fff; }
         td, th { border: 1px solid #ccc; padding: 12px 20px; font-size: 1.1em; }
         th { background: #e9ecef; text-align: left; }
@@ -27,105 +37,86 @@ TEMPLATE = """
 <body>
     <h1>Statistiques du Serveur Drone</h1>
 
+    <!-- Affiche une valeur dans un élément que le script met à jour quand elle change -->
+    {% macro field(stats, name) %}<span data-field="{{ name }}">{{ "?" if stats[name] is none else stats[name] }}</span>{% endmacro %}
+
+    <!-- Une section par drone de la flotte -->
+    {% for drone_id, stats in drones.items() %}
+    <div data-drone="{{ drone_id }}">
+    <h2>Drone {{ drone_id }}</h2>
+
     <!-- Section pour les infos du Raspberry Pi -->
-    <h2>Raspberry Pi</h2>
+    <h3>Raspberry Pi</h3>
     <table>
         <tr>
             <th>Messages reçus</th>
-            <td class="value">{{ stats['raspberry_messages'] }}</td>
+            <td class="value">{{ field(stats, 'raspberry_messages') }}</td>
         </tr>
         <tr>
             <th>Dernier niveau batterie</th>
             <td>
-                {% if stats['last_battery'] is not none %}
-                    <span class="value">{{ stats['last_battery'] }} %</span><br>
-                    <small>Reçu le {{ stats['last_battery_time'] or "?" }}</small>
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
+                <span class="value">{{ field(stats, 'last_battery') }} %</span><br>
+                <small>Reçu le {{ field(stats, 'last_battery_time') }}</small>
             </td>
         </tr>
         <tr>
             <th>Dernier GPS</th>
             <td>
-                {% if stats['last_latitude'] is not none and stats['last_longitude'] is not none %}
-                    <span class="value">Lat: {{ stats['last_latitude'] }}, Lon: {{ stats['last_longitude'] }}</span><br>
-                    <small>Reçu le {{ stats['last_gps_time'] or "?" }}</small>
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
+                <span class="value">Lat: {{ field(stats, 'last_latitude') }}, Lon: {{ field(stats, 'last_longitude') }}</span><br>
+                <small>Reçu le {{ field(stats, 'last_gps_time') }}</small>
             </td>
         </tr>
         <tr>
             <th>Dernière altitude</th>
             <td>
-                {% if stats['last_altitude'] is not none %}
-                    <span class="value">{{ stats['last_altitude'] }} m</span><br>
-                    <small>Reçu le {{ stats['last_altitude_time'] or "?" }}</small>
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
+                <span class="value">{{ field(stats, 'last_altitude') }} m</span><br>
+                <small>Reçu le {{ field(stats, 'last_altitude_time') }}</small>
             </td>
         </tr>
         <tr>
             <th>Dernière vitesse</th>
             <td>
-                {% if stats['last_speed'] is not none %}
-                    <span class="value">{{ stats['last_speed'] }} m/s</span><br>
-                    <small>Reçu le {{ stats['last_speed_time'] or "?" }}</small>
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
+                <span class="value">{{ field(stats, 'last_speed') }} m/s</span><br>
+                <small>Reçu le {{ field(stats, 'last_speed_time') }}</small>
             </td>
         </tr>
         <tr>
             <th>Dernier mode de vol</th>
             <td>
-                {% if stats['last_flight_mode'] is not none %}
-                    <span class="value">{{ stats['last_flight_mode'] }}</span><br>
-                    <small>Reçu le {{ stats['last_flight_mode_time'] or "?" }}</small>
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
+                <span class="value">{{ field(stats, 'last_flight_mode') }}</span><br>
+                <small>Reçu le {{ field(stats, 'last_flight_mode_time') }}</small>
             </td>
         </tr>
         <tr>
             <th>Coordonnées de départ</th>
             <td>
-                {% if stats['start_latitude'] is not none and stats['start_longitude'] is not none %}
-                    <span class="value">Lat: {{ stats['start_latitude'] }}, Lon: {{ stats['start_longitude'] }}</span><br>
-                    <small>Reçu le {{ stats['start_gps_time'] or "?" }}</small>
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
+                <span class="value">Lat: {{ field(stats, 'start_latitude') }}, Lon: {{ field(stats, 'start_longitude') }}</span><br>
+                <small>Reçu le {{ field(stats, 'start_gps_time') }}</small>
             </td>
         </tr>
     </table>
 
     <!-- Section pour les infos de l'application Flutter -->
-    <h2>Application Flutter</h2>
+    <h3>Application Flutter</h3>
     <table>
         <tr>
             <th>Messages reçus</th>
-            <td class="value">{{ stats['flutter_messages'] }}</td>
+            <td class="value">{{ field(stats, 'flutter_messages') }}</td>
         </tr>
         <tr>
             <th>Dernier GPS envoyé</th>
             <td>
-                {% if stats['last_flutter_latitude'] is not none and stats['last_flutter_longitude'] is not none %}
-                    <span class="value">Lat: {{ stats['last_flutter_latitude'] }}, Lon: {{ stats['last_flutter_longitude'] }}</span><br>
-                    <small>Envoyé le {{ stats['last_flutter_gps_time'] or "?" }}</small>
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
+                <span class="value">Lat: {{ field(stats, 'last_flutter_latitude') }}, Lon: {{ field(stats, 'last_flutter_longitude') }}</span><br>
+                <small>Envoyé le {{ field(stats, 'last_flutter_gps_time') }}</small>
             </td>
         </tr>
     </table>
 
     <!-- Historique des messages Raspberry -> Flutter -->
-    <h2>Messages de la Raspberry vers l'application</h2>
+    <h3>Messages de la Raspberry vers l'application</h3>
     <table>
         <tr><th>Date/Heure</th><th>Données</th></tr>
+        <tbody data-history="raspberry_to_flutter">
         {% for msg in stats.get('raspberry_to_flutter', []) %}
         <tr>
             <td>{{ msg.timestamp }}</td>
@@ -134,12 +125,14 @@ TEMPLATE = """
         {% else %}
         <tr><td colspan="2" class="none">Aucun message</td></tr>
         {% endfor %}
+        </tbody>
     </table>
 
     <!-- Historique des messages Flutter -> Raspberry -->
-    <h2>Messages de l'application vers la Raspberry</h2>
+    <h3>Messages de l'application vers la Raspberry</h3>
     <table>
         <tr><th>Date/Heure</th><th>Données</th></tr>
+        <tbody data-history="flutter_to_raspberry">
         {% for msg in stats.get('flutter_to_raspberry', []) %}
         <tr>
             <td>{{ msg.timestamp }}</td>
@@ -148,25 +141,63 @@ TEMPLATE = """
         {% else %}
         <tr><td colspan="2" class="none">Aucun message</td></tr>
         {% endfor %}
+        </tbody>
     </table>
+    </div>
+    {% else %}
+    <p class="none">Aucun drone pour le moment</p>
+    {% endfor %}
 
-    <p style="margin-top:20px;color:#555;"><i>La page se rafraîchit toutes les 2 secondes.<br>
+    <p style="margin-top:20px;color:#555;"><i>La page se met à jour en direct quand stats.json change.<br>
     Les valeurs s'affichent en vert lorsqu'elles sont reçues.</i></p>
+
+    <!-- Les modifications arrivent par Server-Sent Events (/stream) : seuls les champs changés sont envoyés -->
+    {{ live_script | safe }}
+    <script>
+        const source = new EventSource("/stream");
+        source.onmessage = (event) => applyDelta(JSON.parse(event.data));
+    </script>
 </body>
 </html>
 """
 
+# Dernière lecture de stats.json : les fichiers ne sont relus et re-parsés que s'ils ont changé.
+_cache = {"mtime": None, "drones": {}, "views": {}, "html": None}
+
+def stats_files():
+    """stats.json, et un fichier stats-<n>.json par worker quand ws_server.py tourne avec WORKERS > 1."""
+    return sorted(glob.glob("stats.json") + glob.glob("stats-*.json"))
+
 def get_stats():
     """
     Cette fonction lit le fichier stats.json (créé par le serveur WebSocket)
-    et retourne les statistiques sous forme de dictionnaire Python.
-    Si le fichier n'existe pas ou qu'il y a une erreur, elle retourne un dictionnaire vide.
+    et retourne les statistiques de chaque drone : {drone_id: statistiques}.
+    En mode multi-worker, les fichiers de chaque worker sont réunis.
+    Un ancien fichier (statistiques d'un seul drone, sans la clé "drones") est
+    affiché comme le drone "default".
+    Les fichiers ne sont relus que si leur date de modification a changé depuis la dernière lecture.
+    Si aucun fichier n'existe ou qu'il y a une erreur, elle retourne un dictionnaire vide.
     """
     try:
-        with open("stats.json", "r") as f:
-            return json.load(f)
+        mtime = tuple((path, os.stat(path).st_mtime_ns) for path in stats_files())
+    except OSError:
+        return {}
+    if mtime == _cache["mtime"]:
+        return _cache["drones"]
+    drones = {}
+    try:
+        for path, _ in mtime:
+            with open(path, "r") as f:
+                data = json.load(f)
+            drones.update(data["drones"] if "drones" in data else {"default": data})
     except Exception:
         return {}
+    _cache.update(mtime=mtime, drones=drones, views={drone_id: dashboard_view(stats) for drone_id, stats in drones.items()},
+                  html=None)
+    return drones
+
+# Le modèle est compilé une seule fois au démarrage, pas à chaque affichage de la page.
+page = app.jinja_env.from_string(TEMPLATE)
 
 @app.route("/")
 def index():
@@ -174,9 +205,96 @@ def index():
     Cette fonction est appelée quand on accède à la page principale ("/").
     Elle affiche la page HTML avec les statistiques actuelles.
     """
-    return render_template_string(TEMPLATE, stats=get_stats())
+    # Les vues (heures mises en forme, voir live.py) plutôt que les statistiques brutes.
+    # La page rendue est gardée jusqu'à la prochaine modification des fichiers.
+    get_stats()
+    if _cache["html"] is None:
+        _cache["html"] = page.render(drones=_cache["views"], live_script=LIVE_SCRIPT)
+    return _cache["html"]
+
+@app.route("/stream")
+def stream():
+    """
+    Flux Server-Sent Events utilisé par la page : toutes les STREAM_INTERVAL secondes,
+    on envoie au navigateur seulement les champs qui ont changé depuis son dernier envoi.
+    Le paramètre ?max_rate= permet à un dashboard de demander moins de mises à jour par seconde.
+    """
+    viewer = Viewer()
+    viewer.set_max_rate(request.args.get("max_rate"))
+
+    def events():
+        while True:
+            get_stats()
+            delta = viewer.delta(_cache["views"], time.monotonic())
+            if delta:
+                yield f"data: {json.dumps(delta)}\n\n"
+            time.sleep(max(STREAM_INTERVAL, viewer.min_interval))
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.route("/recordings")
+def recordings():
+    """Sessions enregistrées par le serveur (voir recording.py) : {drone_id: [début de chaque session en ns]}."""
+    return Response(json.dumps(recording.list_recordings()), mimetype="application/json")
+
+@app.route("/api/drones/<path:drone_id>/series")
+def series(drone_id):
+    """
+    Séries d'une session enregistrée (?session=, la dernière par défaut), réduites à ?points=
+    par ?method=lttb|minmax entre ?from= et ?to= (secondes). Voir history.py.
+    """
+    try:
+        return history.recorded_series(drone_id, request.args)
+    except history.NotFound as e:
+        return history.error(str(e), 404)
+    except ValueError as e:
+        return history.error(str(e))
+
+@app.route("/api/drones/<path:drone_id>/messages")
+def messages(drone_id):
+    """Messages relayés d'une session enregistrée, par pages de ?limit= à partir de ?cursor= ou ?from=."""
+    try:
+        return history.recorded_messages(drone_id, request.args)
+    except history.NotFound as e:
+        return history.error(str(e), 404)
+    except ValueError as e:
+        return history.error(str(e))
+
+@app.route("/replay/<path:drone_id>")
+def replay(drone_id):
+    """
+    Relecture d'une session en Server-Sent Events, au rythme d'origine multiplié par ?speed=
+    (?session= : début de la session, la dernière par défaut ; ?position= : départ en secondes).
+    Chaque trame relayée est un événement ; les trames binaires sont converties en JSON.
+    """
+    try:
+        player = recording.Player.from_request({
+            "drone_id": drone_id,
+            "session": request.args.get("session", "latest"),
+            "speed": request.args.get("speed", 1),
+            "position": request.args.get("position", 0),
+        })
+    except (ValueError, OSError) as e:
+        return Response(json.dumps({"status": "error", "message": str(e)}), status=404, mimetype="application/json")
+
+    def events():
+        try:
+            yield f"event: replay\ndata: {json.dumps(player.describe())}\n\n"
+            while True:
+                frames, delay = player.due()
+                for binary, frame in frames:
+                    text = json.dumps(codec.decode_batch(frame)) if binary else frame
+                    yield "data: " + text.replace("\n", "\ndata: ") + "\n\n"
+                if delay is None:
+                    yield "event: replay_end\ndata: {}\n\n"
+                    return
+                time.sleep(min(delay, STREAM_INTERVAL))
+        finally:
+            player.close()
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 if __name__ == "__main__":
     # Si ce fichier est lancé directement, on démarre le serveur web Flask sur le port 5000.
     # Le mode debug permet de voir les erreurs plus facilement pendant le développement.
-    app.run(port=5000, debug=True)
\ No newline at end of file
+    app.run(port=5000, debug=True)
@@ -0,0 +1,71 @@
+"""
+Flux delta vers un abonné, activé par {"delta": true} dans identify (Flutter).
+
+Pour chaque action de télémétrie, le serveur envoie d'abord une image complète
+(keyframe) : le message habituel avec "key", le numéro de l'image. Le client la
+confirme par {"action": "delta_ack", "key": n}. Les messages suivants de cette
+action sont envoyés en
+    {"d": "gps", "b": n, "s": {champs modifiés}, "u": [champs supprimés]}
+par rapport à l'image confirmée n, et non au message précédent : un delta
+perdu ou remplacé (fusion de la télémétrie d'un client lent, voir outbound.py)
+ne casse pas les suivants.
+
+Une nouvelle image part toutes les DELTA_KEYFRAME_INTERVAL secondes par action
+pour resynchroniser le client. Tant qu'elle n'est pas confirmée, les deltas
+restent calculés sur l'ancienne : le client garde ses images par numéro et peut
+oublier celles plus anciennes que le dernier "b" reçu.
+
+Les autres messages (commandes, événements, lots "batch") partent tels quels.
+"""
+import os
+
+import metrics
+from core import TELEMETRY_ACTIONS
+
+DELTA_KEYFRAME_INTERVAL = float(os.environ.get("DELTA_KEYFRAME_INTERVAL", 10))
+
+FRAMES = metrics.counter("delta_frames_total", "Messages envoyés aux abonnés du flux delta, par forme", ("kind",))
+
+_MISSING = object()
+
+
+class DeltaEncoder:
+    """État du flux delta d'un abonné : images confirmées et images en attente, par action."""
+
+    def __init__(self, keyframe_interval=DELTA_KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.base = {}      # action -> (numéro, champs) de la dernière image confirmée
+        self.pending = {}   # action -> (numéro, champs) de la dernière image envoyée, pas encore confirmée
+        self.keyframe_at = {}  # action -> heure (time.monotonic()) de la dernière image envoyée
+        self.next_key = 0
+
+    def encode(self, data, now):
+        """Message à envoyer à la place de `data` (qui n'est pas modifié)."""
+        action = data.get("action")
+        if action not in TELEMETRY_ACTIONS:
+            FRAMES.inc("full")
+            return data
+        base = self.base.get(action)
+        if base is None or now - self.keyframe_at[action] >= self.keyframe_interval:
+            self.next_key += 1
+            self.pending[action] = (self.next_key, data)
+            self.keyframe_at[action] = now
+            FRAMES.inc("keyframe")
+            return dict(data, key=self.next_key)
+        key, fields = base
+        changed = {name: value for name, value in data.items()
+                   if name != "action" and fields.get(name, _MISSING) != value}
+        frame = {"d": action, "b": key, "s": changed}
+        removed = [name for name in fields if name not in data]
+        if removed:
+            frame["u"] = removed
+        FRAMES.inc("delta")
+        return frame
+
+    def ack(self, key):
+        """Le client a reçu l'image `key` : les deltas suivants de son action seront calculés sur elle."""
+        for action, (pending_key, fields) in self.pending.items():
+            if pending_key == key:
+                self.base[action] = self.pending.pop(action)
+                return True
+        return False
@@ -0,0 +1,102 @@
+"""
+Diffusion des messages d'un drone à toutes les applications qui le suivent.
+
+Un drone a au plus une application qui le contrôle (drone.peers["flutter"]) :
+elle seule envoie des commandes, reçoit les messages gardés pendant son
+absence (outbox.py) et compte pour la détection de perte de signal. Les
+autres applications et stations sol sont des spectateurs (drone.viewers) :
+ils reçoivent la même télémétrie et les mêmes événements, mais seules les
+actions de core.VIEWER_ACTIONS (pong, trace, delta_ack, subscribe) leur sont
+permises. Voir Fleet.register pour le choix du rôle à l'identification.
+
+Chaque forme de trame (JSON, binaire) d'un envoi n'est encodée qu'une fois,
+quel que soit le nombre d'abonnés qui la reçoivent (Publication). Seul le flux
+delta (delta.py), propre à chaque abonné, est encodé pour chacun.
+
+Un abonné peut limiter le débit de chaque action de télémétrie, à
+l'identification ou plus tard :
+    {"action": "subscribe", "rates": {"gps": 2, "battery": 0.2}}
+(messages par seconde ; 0 ou null retire la limite). Les messages en trop ne
+sont pas perdus : le plus récent de chaque action est retenu et envoyé dès que
+la limite le permet (voir RateLimiter.due), l'abonné a donc toujours la
+dernière valeur. Les lots "batch" ne sont pas limités.
+"""
+import json
+
+import codec
+
+# Période d'envoi des messages retenus par les limites de débit, en secondes.
+FANOUT_TICK = 0.05
+
+
+class RateLimiter:
+    """Débit maximum par action d'un abonné ; le dernier message en trop de chaque action est retenu."""
+
+    def __init__(self, rates):
+        self.intervals = {action: 1.0 / rate for action, rate in rates.items()}
+        self.next_time = {}  # action -> heure (time.monotonic()) du prochain envoi permis
+        self.held = {}       # action -> dernier message retenu
+
+    def admit(self, data, now):
+        """True si le message part maintenant ; sinon il est retenu (à la place du précédent)."""
+        action = data.get("action")
+        interval = self.intervals.get(action)
+        if interval is None:
+            return True
+        if now >= self.next_time.get(action, 0.0):
+            self.next_time[action] = now + interval
+            self.held.pop(action, None)
+            return True
+        self.held[action] = data
+        return False
+
+    def due(self, now):
+        """Messages retenus qui peuvent partir (ils repassent ensuite par admit)."""
+        if not self.held:
+            return []
+        ready = [action for action in self.held if now >= self.next_time[action]]
+        return [self.held.pop(action) for action in ready]
+
+
+class Publication:
+    """
+    Messages envoyés à plusieurs abonnés. Les trames sont encodées à la première
+    demande puis réutilisées ; `raw` (trame d'origine) est repris tel quel quand
+    il correspond à ce qui est demandé : du texte JSON, ou des octets seulement
+    si c'est un lot codec (client d'encodage "binary").
+    """
+
+    def __init__(self, messages, raw=None):
+        self.messages = messages
+        self.raw = raw
+        self.json_frames = {}    # index -> trame JSON d'un message
+        self.binary_frames = {}  # tuple d'index -> trame binaire
+
+    def admitted(self, peer, now):
+        """Index des messages à envoyer à ce pair, après ses limites de débit."""
+        limiter = peer.limiter
+        if limiter is None:
+            return range(len(self.messages))
+        return [index for index, data in enumerate(self.messages) if limiter.admit(data, now)]
+
+    def json(self, index):
+        frame = self.json_frames.get(index)
+        if frame is None:
+            if isinstance(self.raw, str) and len(self.messages) == 1:
+                frame = self.raw
+            else:
+                frame = json.dumps(self.messages[index])
+            self.json_frames[index] = frame
+        return frame
+
+    def binary(self, indexes):
+        """Trame binaire des messages `indexes` (tous encodables, voir codec.can_encode)."""
+        key = tuple(indexes)
+        frame = self.binary_frames.get(key)
+        if frame is None:
+            if isinstance(self.raw, bytes) and len(key) == len(self.messages):
+                frame = self.raw
+            else:
+                frame = codec.encode_batch([self.messages[index] for index in key])
+            self.binary_frames[key] = frame
+        return frame
@@ -0,0 +1,264 @@
+import json
+import re
+import uuid
+
+import metrics
+from analytics import FlightTrack
+from clock import ClockOffset
+from commands import CommandScheduler
+from outbox import Outbox
+from timeseries import TelemetryStore
+
+# Drone utilisé quand un client ne donne pas de drone_id (anciennes versions
+# de l'application Flutter et du script Raspberry).
+DEFAULT_DRONE_ID = "default"
+# drone_id accepté par identify : lettres, chiffres, "_", ".", ":" et "-", sans commencer par un
+# point. Il sert de label dans /metrics et de nom de dossier pour les enregistrements.
+DRONE_ID_PATTERN = re.compile(r"\w[\w.:-]{0,63}")
+
+CLIENT_TYPES = ("raspberry", "flutter")
+
+# Nombre de messages relayés gardés dans l'historique affiché par les dashboards.
+HISTORY_SIZE = 10
+
+
+def check_drone_id(drone_id):
+    """drone_id donné par un client (None : drone par défaut) ; lève ValueError s'il est invalide."""
+    if not drone_id:
+        return DEFAULT_DRONE_ID
+    if isinstance(drone_id, bool) or not isinstance(drone_id, (str, int)) or not DRONE_ID_PATTERN.fullmatch(str(drone_id)):
+        raise ValueError("Invalid drone_id")
+    return str(drone_id)
+
+
+class ClientRecord:
+    """Un client connecté (Raspberry ou application Flutter) rattaché à un drone."""
+
+    def __init__(self, conn, client_type, drone, session_id):
+        self.conn = conn  # websocket (ws_server) ou sid Socket.IO (server_fusion)
+        self.client_type = client_type
+        self.drone = drone
+        self.session_id = session_id
+        self.encoding = "json"  # "binary" si négocié pendant identify (voir codec.py)
+        self.sender = None  # file d'envoi du client (ws_server, voir outbound.py)
+        self.acks = False   # la Raspberry acquitte les commandes (voir commands.py)
+        self.trace = False  # le client répond aux pings d'horloge (voir clock.py)
+        self.clock = ClockOffset()
+        self.delta = None   # DeltaEncoder si le client a demandé le flux delta (voir delta.py)
+        self.viewer = False  # application spectatrice, sans droit de commande (voir fanout.py)
+        self.limiter = None  # RateLimiter si le client a limité le débit de la télémétrie
+        self.replaced = None  # application qui contrôlait le drone avant celle-ci, devenue spectatrice
+
+
+class TrackedStats(dict):
+    """
+    Statistiques d'un drone : un dict qui retient les champs modifiés et les
+    entrées d'historique ajoutées depuis le dernier enregistrement dans le journal.
+
+    `version` augmente à chaque modification. Les formes dérivées des
+    statistiques (JSON de stats.json, vue des dashboards) sont gardées avec la
+    version pour laquelle elles ont été calculées (voir cached) : entre deux
+    modifications, les relire ne coûte qu'une comparaison.
+    """
+
+    __slots__ = ("changed", "appended", "version", "cache")
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changed = set()
+        self.appended = []
+        self.version = 0
+        self.cache = {}  # nom -> (version, valeur)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed.add(key)
+        self.version += 1
+
+    def cached(self, name, build):
+        """build(self), recalculé seulement si les statistiques ont changé depuis le dernier appel."""
+        entry = self.cache.get(name)
+        version = self.version
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = build(self)
+        # Version lue avant le calcul : une modification pendant build() (autre thread) le refera.
+        self.cache[name] = (version, value)
+        return value
+
+
+class DroneState:
+    """
+    État et historique d'un drone, avec ses deux pairs (Raspberry et l'application
+    Flutter qui le contrôle) et ses applications spectatrices.
+    """
+
+    __slots__ = ("drone_id", "stats", "telemetry", "track", "commands", "peers", "viewers", "outboxes")
+
+    def __init__(self, drone_id, stats):
+        self.drone_id = drone_id
+        self.stats = TrackedStats(stats)
+        self.telemetry = TelemetryStore()
+        self.track = FlightTrack()
+        self.commands = CommandScheduler()
+        self.peers = {"raspberry": None, "flutter": None}
+        self.viewers = {}  # conn -> ClientRecord des applications spectatrices (voir fanout.py)
+        # Messages gardés pour un pair déconnecté, envoyés quand il revient (voir outbox.py)
+        self.outboxes = {"raspberry": Outbox(), "flutter": Outbox()}
+
+    def add_history(self, key, entry):
+        """Ajoute un message à une liste d'historique de stats, en place (sans recopier la liste)."""
+        history = self.stats[key]
+        history.append(entry)
+        if len(history) > HISTORY_SIZE:
+            del history[0]
+        self.stats.appended.append([key, entry])
+        self.stats.version += 1
+
+    def peer(self, client_type):
+        """Retourne le client de l'autre côté du lien (None s'il n'est pas connecté)."""
+        target = "flutter" if client_type == "raspberry" else "raspberry"
+        return self.peers[target]
+
+    def subscribers(self):
+        """Applications qui reçoivent les messages du drone : celle qui le contrôle, puis les spectatrices."""
+        flutter = self.peers["flutter"]
+        if not self.viewers:
+            return [flutter] if flutter is not None else []
+        viewers = list(self.viewers.values())
+        return [flutter] + viewers if flutter is not None else viewers
+
+
+class Fleet:
+    """
+    Registre des drones et des clients connectés.
+
+    Deux index permettent un routage en O(1) quelle que soit la taille de la flotte :
+    - by_conn : websocket/sid -> ClientRecord (qui envoie ce message ?)
+    - drones  : drone_id -> DroneState (à qui le relayer ?)
+    """
+
+    def __init__(self, stats_factory):
+        self.stats_factory = stats_factory  # crée les statistiques d'un nouveau drone
+        self.by_conn = {}
+        self.drones = {}
+        self.journal = None  # voir journal.py ; None = pas de journal
+
+    def drone(self, drone_id):
+        drone = self.drones.get(drone_id)
+        if drone is None:
+            drone = self.drones[drone_id] = DroneState(drone_id, self.stats_factory())
+        return drone
+
+    def register(self, conn, client_type, drone_id=None, session_id=None, role=None):
+        """
+        Enregistre un client après `identify`. Une nouvelle Raspberry remplace la précédente.
+
+        Une application Flutter prend le contrôle du drone si aucune ne l'a, si
+        elle reprend la session de celle qui l'a (reconnexion), ou si elle le
+        demande (role "controller") : l'ancienne devient alors spectatrice
+        (record.replaced). Sinon, ou avec role "viewer", elle est spectatrice.
+        """
+        drone = self.drone(check_drone_id(drone_id))
+        self._detach(self.by_conn.get(conn))
+        record = ClientRecord(conn, client_type, drone, session_id or uuid.uuid4().hex)
+        previous = drone.peers[client_type]
+        if client_type == "flutter" and previous is not None and role != "controller" and (
+                role == "viewer" or previous.session_id != record.session_id):
+            record.viewer = True
+            drone.viewers[conn] = record
+        else:
+            if previous is not None:
+                if client_type == "flutter":
+                    previous.viewer = True
+                    drone.viewers[previous.conn] = previous
+                    record.replaced = previous
+                else:
+                    self.by_conn.pop(previous.conn, None)
+            drone.peers[client_type] = record
+        self.by_conn[conn] = record
+        return record
+
+    def lookup(self, conn):
+        return self.by_conn.get(conn)
+
+    def unregister(self, conn):
+        """Retire un client déconnecté. Retourne son enregistrement (ou None)."""
+        record = self.by_conn.pop(conn, None)
+        self._detach(record)
+        return record
+
+    def _detach(self, record):
+        if record is None:
+            return
+        drone = record.drone
+        if drone.peers[record.client_type] is record:
+            drone.peers[record.client_type] = None
+        elif drone.viewers.get(record.conn) is record:
+            del drone.viewers[record.conn]
+
+    def commit(self, drone):
+        """Enregistre dans le journal les changements faits sur un drone depuis le dernier appel."""
+        stats = drone.stats
+        if not stats.changed and not stats.appended:
+            return
+        if self.journal is not None:
+            patch = {key: stats[key] for key in stats.changed}
+            self.journal.record(drone.drone_id, patch, stats.appended)
+            self.journal.maybe_snapshot(self.snapshot_json)
+        stats.changed = set()
+        stats.appended = []
+
+    def restore(self, journal):
+        """
+        Recharge l'état au démarrage (dernier snapshot + fin du journal), puis
+        enregistre les changements suivants dans ce journal.
+        """
+        state, records = journal.load()
+        if state:
+            for drone_id, saved in state.get("drones", {}).items():
+                dict.update(self.drone(drone_id).stats, saved)
+        for record in records:
+            drone = self.drone(record["d"])
+            dict.update(drone.stats, record.get("s", {}))
+            for key, entry in record.get("h", ()):
+                drone.add_history(key, entry)
+            drone.stats.appended = []
+        for drone in self.drones.values():
+            drone.stats.version += 1  # modifiées par dict.update, sans passer par __setitem__
+        self.journal = journal
+        return len(records)
+
+    def register_metrics(self):
+        """Jauges communes aux deux serveurs, calculées à la lecture de /metrics."""
+        def connected():
+            counts = {(client_type,): 0 for client_type in CLIENT_TYPES}
+            for record in list(self.by_conn.values()):
+                counts[(record.client_type,)] += 1
+            return counts
+
+        metrics.gauge("connected_clients", "Clients identifiés, par type", connected, ("client_type",))
+        metrics.gauge("drones", "Drones connus du serveur", lambda: {(): len(self.drones)})
+        metrics.gauge("flutter_viewers", "Applications spectatrices connectées (voir fanout.py)",
+                      lambda: {(): sum(len(drone.viewers) for drone in list(self.drones.values()))})
+        metrics.gauge("pending_commands", "Commandes envoyées et pas encore acquittées",
+                      lambda: {(): sum(len(drone.commands.pending) for drone in list(self.drones.values()))})
+        metrics.gauge("outbox_messages", "Messages gardés pour des pairs déconnectés",
+                      lambda: {(): sum(len(outbox) for drone in list(self.drones.values()) for outbox in drone.outboxes.values())})
+
+    def snapshot(self):
+        """Objet écrit dans stats.json : les statistiques de chaque drone."""
+        return {"drones": {drone_id: drone.stats for drone_id, drone in self.drones.items()}}
+
+    def snapshot_json(self, extra=None):
+        """
+        snapshot() (plus les clés de `extra`) déjà sérialisé en JSON. Le JSON de
+        chaque drone est gardé tant que ses statistiques ne changent pas : seuls
+        les drones modifiés depuis la dernière écriture sont resérialisés.
+        """
+        drones = ", ".join(f"{json.dumps(drone_id)}: {drone.stats.cached('json', json.dumps)}"
+                           for drone_id, drone in list(self.drones.items()))
+        parts = [f'"drones": {{{drones}}}']
+        if extra:
+            parts.extend(f"{json.dumps(key)}: {json.dumps(value)}" for key, value in extra.items())
+        return "{" + ", ".join(parts) + "}"
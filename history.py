@@ -0,0 +1,332 @@
+"""
+API HTTP d'historique commune aux deux dashboards (server_fusion.py et dashboard.py).
+
+    GET /api/drones/<drone_id>/series?metrics=battery,altitude&from=...&to=...&points=500&method=lttb
+        {"drone_id": ..., "from": ..., "to": ..., "method": "lttb",
+         "series": {"battery": {"t": [...], "v": [...], "count": 18000}, ...}}
+Séries de télémétrie entre `from` et `to` (secondes depuis l'epoch, facultatifs),
+réduites sur le serveur à au plus `points` points par métrique ("count" : nombre
+d'échantillons avant réduction). Deux méthodes :
+- "lttb" (Largest Triangle Three Buckets) : un point par tranche, celui qui forme
+  le plus grand triangle avec ses voisins retenus ; garde l'allure de la courbe ;
+- "minmax" : le minimum et le maximum de chaque tranche ; garde tous les pics.
+
+    GET /api/drones/<drone_id>/messages?session=latest&cursor=...&limit=100&from=...&direction=raspberry_to_flutter
+        {"drone_id": ..., "session": ..., "messages": [{"t": ns, "direction": ..., "data": ...}], "next": "..."}
+Messages relayés, lus dans les enregistrements de session (voir recording.py),
+par pages : "next" est le curseur opaque de la page suivante. Tant que la
+session est enregistrée, "next" est toujours donné, même en fin de page vide :
+on peut revenir plus tard avec lui chercher les nouveaux messages ; il vaut
+null seulement à la fin d'une session terminée. Le curseur désigne une trame
+de la session (numéro et position dans le fichier, vérifiés avant la lecture) :
+une page coûte la lecture de ses seules trames, quelle que soit la longueur du
+vol. Avec un curseur, ?session= est facultatif (la session est celle du curseur).
+
+Les deux réponses portent un ETag calculé avant tout calcul, à partir de la
+requête et de la version des données (nombre d'échantillons, taille de
+l'enregistrement). Un client qui renvoie If-None-Match reçoit 304 sans que la
+réponse soit recalculée ni envoyée.
+
+server_fusion.py lit les séries en mémoire (timeseries.py) ; dashboard.py, qui
+ne partage pas la mémoire du serveur, les extrait des enregistrements.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import math
+from array import array
+
+import numpy as np
+from flask import Response, request
+
+import codec
+import recording
+from timeseries import METRICS
+
+DEFAULT_POINTS = 500
+MAX_POINTS = 5000
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+METHODS = ("lttb", "minmax")
+
+# Métriques extraites des enregistrements : action -> ((champ, métrique), ...).
+RECORDED_FIELDS = {
+    "battery": (("value", "battery"),),
+    "altitude": (("value", "altitude"),),
+    "speed": (("value", "speed"),),
+    "gps": (("latitude", "latitude"), ("longitude", "longitude")),
+}
+RECORDED_METRICS = ("battery", "altitude", "speed", "latitude", "longitude")
+
+# Séries extraites des enregistrements les plus récemment demandés.
+SERIES_CACHE_SIZE = 16
+_series_cache = {}  # chemin de la session -> (fin lue dans .rec, {métrique: (array temps, array valeurs)})
+
+
+class NotFound(Exception):
+    """Pas de données pour ce drone ou cette session (réponse 404) ; les paramètres invalides lèvent ValueError (400)."""
+
+
+def lttb(t, v, points):
+    """Réduit (t, v) à `points` points par Largest Triangle Three Buckets ; premier et dernier points gardés."""
+    size = len(t)
+    if points >= size or points < 3:
+        return t, v
+    # Les points intérieurs sont répartis en points - 2 tranches [edges[i], edges[i + 1]).
+    edges = np.linspace(1, size - 1, points - 1).astype(np.intp)
+    counts = np.diff(edges)
+    # Moyenne de chaque tranche : le troisième sommet du triangle de la tranche précédente.
+    mean_t = np.add.reduceat(t[:size - 1], edges[:-1]) / counts
+    mean_v = np.add.reduceat(v[:size - 1], edges[:-1]) / counts
+    keep = np.empty(points, dtype=np.intp)
+    keep[0] = 0
+    keep[-1] = size - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        if i + 1 < points - 2:
+            next_t, next_v = mean_t[i + 1], mean_v[i + 1]
+        else:
+            next_t, next_v = t[size - 1], v[size - 1]
+        bucket_t = t[lo:hi]
+        bucket_v = v[lo:hi]
+        area = np.abs((t[a] - next_t) * (bucket_v - v[a]) - (t[a] - bucket_t) * (next_v - v[a]))
+        a = lo + int(area.argmax())
+        keep[i + 1] = a
+    return t[keep], v[keep]
+
+
+def minmax(t, v, points):
+    """Réduit (t, v) à au plus `points` points : minimum et maximum de points // 2 tranches, dans l'ordre."""
+    size = len(t)
+    buckets = points // 2
+    if points >= size or buckets < 1:
+        return t, v
+    edges = np.linspace(0, size, buckets + 1).astype(np.intp)
+    keep = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        low = lo + int(v[lo:hi].argmin())
+        high = lo + int(v[lo:hi].argmax())
+        keep.extend(sorted({low, high}))
+    return t[keep], v[keep]
+
+
+def downsample(t, v, points, method="lttb"):
+    t = np.frombuffer(t, dtype=float) if isinstance(t, array) else np.asarray(t, dtype=float)
+    v = np.frombuffer(v, dtype=float) if isinstance(v, array) else np.asarray(v, dtype=float)
+    reduced_t, reduced_v = (lttb if method == "lttb" else minmax)(t, v, points)
+    return {"t": reduced_t.tolist(), "v": reduced_v.tolist(), "count": len(t)}
+
+
+def _number(args, name):
+    value = args.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"Invalid parameter: {name}")
+    if not math.isfinite(number):
+        raise ValueError(f"Invalid parameter: {name}")
+    return number
+
+
+def _integer(args, name, default, lowest, highest):
+    value = args.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        return min(highest, max(lowest, int(value)))
+    except ValueError:
+        raise ValueError(f"Invalid parameter: {name}")
+
+
+def parse_series_query(args, available=METRICS):
+    """(métriques, from, to, points, méthode) d'une requête de séries ; lève ValueError."""
+    names = args.get("metrics")
+    metrics = tuple(name for name in names.split(",") if name) if names else tuple(available)
+    for name in metrics:
+        if name not in available:
+            raise ValueError(f"Unknown metric: {name}")
+    method = args.get("method") or "lttb"
+    if method not in METHODS:
+        raise ValueError("Invalid parameter: method")
+    return metrics, _number(args, "from"), _number(args, "to"), _integer(args, "points", DEFAULT_POINTS, 3, MAX_POINTS), method
+
+
+def respond(tag, build):
+    """
+    Réponse JSON de build(), avec un ETag tiré de `tag` (requête et version des
+    données). 304 sans appeler build() si le client a déjà cette version.
+    """
+    etag = hashlib.sha1(repr(tag).encode("utf-8")).hexdigest()[:24]
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(json.dumps(build()), mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def error(message, status=400):
+    return Response(json.dumps({"status": "error", "message": message}), status=status, mimetype="application/json")
+
+
+def telemetry_series(drone, args):
+    """Réponse /series depuis les séries en mémoire d'un drone (server_fusion.py)."""
+    metrics, t0, t1, points, method = parse_series_query(args)
+    store = drone.telemetry.series
+    tag = ("series", drone.drone_id, metrics, t0, t1, points, method, tuple(store[name].count for name in metrics))
+
+    def build():
+        series = {}
+        for name in metrics:
+            t, v = store[name].columns(t0, t1)
+            series[name] = downsample(t, v, points, method)
+        return {"drone_id": drone.drone_id, "from": t0, "to": t1, "method": method, "series": series}
+
+    return respond(tag, build)
+
+
+def _open(drone_id, session, directory):
+    try:
+        return recording.open_recording(drone_id, session, directory)
+    except (ValueError, OSError) as e:
+        raise NotFound(str(e))
+
+
+def _frame_messages(frame, binary):
+    try:
+        messages = codec.decode_batch(frame) if binary else [json.loads(frame)]
+    except ValueError:
+        return []
+    return [data for data in messages if isinstance(data, dict)]
+
+
+def _scan(rec, offset, columns):
+    """Ajoute à `columns` les mesures de la Raspberry enregistrées à partir de `offset`."""
+    while offset < rec.end:
+        t_ns, flags, binary, frame, offset = rec.read(offset)
+        if flags & recording.FLUTTER_TO_RASPBERRY:
+            continue
+        for data in _frame_messages(frame, binary):
+            samples = data.get("samples") if data.get("action") == "batch" else [data]
+            if not isinstance(samples, list):
+                continue
+            for sample in samples:
+                fields = RECORDED_FIELDS.get(sample.get("action")) if isinstance(sample, dict) else None
+                if fields is None:
+                    continue
+                t = sample.get("t")
+                t = t if isinstance(t, (int, float)) and not isinstance(t, bool) else t_ns / 1e9
+                for field, name in fields:
+                    value = sample.get(field)
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        times, values = columns[name]
+                        times.append(t)
+                        values.append(value)
+    return offset
+
+
+def recorded_columns(rec):
+    """Séries de mesures d'une session enregistrée ; seule la partie écrite depuis la dernière lecture est relue."""
+    cached = _series_cache.pop(rec.path, None)
+    if cached is None:
+        cached = (len(recording.MAGIC), {name: (array("d"), array("d")) for name in RECORDED_METRICS})
+    offset, columns = cached
+    if offset < rec.end:
+        offset = _scan(rec, offset, columns)
+    _series_cache[rec.path] = (offset, columns)  # le plus récent en dernier
+    while len(_series_cache) > SERIES_CACHE_SIZE:
+        del _series_cache[next(iter(_series_cache))]
+    return columns
+
+
+def recorded_series(drone_id, args, directory=recording.RECORDINGS_DIR):
+    """Réponse /series depuis l'enregistrement d'une session (dashboard.py)."""
+    metrics, t0, t1, points, method = parse_series_query(args, RECORDED_METRICS)
+    rec = _open(drone_id, args.get("session", "latest"), directory)
+    try:
+        tag = ("series", rec.path, rec.end, metrics, t0, t1, points, method)
+
+        def build():
+            columns = recorded_columns(rec)
+            series = {}
+            for name in metrics:
+                times, values = columns[name]
+                t = np.frombuffer(times, dtype=float) if times else np.empty(0)
+                v = np.frombuffer(values, dtype=float) if values else np.empty(0)
+                lo = 0 if t0 is None else int(np.searchsorted(t, t0, "left"))
+                hi = len(t) if t1 is None else int(np.searchsorted(t, t1, "right"))
+                series[name] = downsample(t[lo:max(lo, hi)], v[lo:max(lo, hi)], points, method)
+            return {"drone_id": drone_id, "session": rec.start_ns, "from": t0, "to": t1, "method": method,
+                    "series": series}
+
+        return respond(tag, build)
+    finally:
+        rec.close()
+
+
+def encode_cursor(session, n, offset):
+    return base64.urlsafe_b64encode(f"{session}:{n}:{offset}".encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """(session, numéro de trame, position) d'un curseur ; lève ValueError s'il est illisible."""
+    try:
+        text = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        session, n, offset = (int(part) for part in text.split(":"))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid parameter: cursor")
+    return session, n, offset
+
+
+def recorded_messages(drone_id, args, directory=recording.RECORDINGS_DIR):
+    """Réponse /messages : une page de messages relayés d'une session enregistrée."""
+    limit = _integer(args, "limit", DEFAULT_LIMIT, 1, MAX_LIMIT)
+    t0 = _number(args, "from")
+    directions = args.get("direction")
+    wanted = tuple(directions.split(",")) if directions else tuple(recording.DIRECTIONS)
+    for name in wanted:
+        if name not in recording.DIRECTIONS:
+            raise ValueError("Invalid parameter: direction")
+    names = {flag: name for name, flag in recording.DIRECTIONS.items()}
+    cursor = args.get("cursor")
+    session = args.get("session", "latest")
+    if cursor:
+        cursor_session, n, offset = decode_cursor(cursor)
+        if session not in (None, "latest") and session != str(cursor_session):
+            raise ValueError("Invalid parameter: cursor")
+        session = cursor_session
+    rec = _open(drone_id, session, directory)
+    try:
+        if cursor:
+            # Le curseur doit désigner le début d'une trame de cette session.
+            if rec.offset_of(n) != offset:
+                raise ValueError("Invalid parameter: cursor")
+        elif t0 is not None:
+            offset, n = rec.locate(int(t0 * 1e9))
+        else:
+            offset, n = len(recording.MAGIC), 0
+        tag = ("messages", rec.path, rec.end, rec.closed, offset, limit, wanted)
+
+        def build():
+            position, count = offset, n
+            messages = []
+            while position < rec.end and len(messages) < limit:
+                t_ns, flags, binary, frame, position = rec.read(position)
+                count += 1
+                direction = names[flags & recording.FLUTTER_TO_RASPBERRY]
+                if direction not in wanted:
+                    continue
+                for data in _frame_messages(frame, binary):
+                    messages.append({"t": t_ns, "direction": direction, "data": data})
+            done = position >= rec.end and rec.closed
+            return {"drone_id": drone_id, "session": rec.start_ns, "messages": messages,
+                    "next": None if done else encode_cursor(rec.start_ns, count, position)}
+
+        return respond(tag, build)
+    finally:
+        rec.close()
@@ -0,0 +1,201 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+from persistence import write_atomic
+
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR", "journal")
+# Taille d'un segment avant de passer au suivant.
+SEGMENT_BYTES = int(os.environ.get("JOURNAL_SEGMENT_BYTES", 4 * 1024 * 1024))
+# Un snapshot est pris tous les SNAPSHOT_RECORDS enregistrements ou toutes les SNAPSHOT_INTERVAL secondes.
+SNAPSHOT_RECORDS = int(os.environ.get("JOURNAL_SNAPSHOT_RECORDS", 10000))
+SNAPSHOT_INTERVAL = float(os.environ.get("JOURNAL_SNAPSHOT_INTERVAL", 60))
+# Nombre de snapshots gardés ; les segments plus anciens que le plus vieux snapshot sont supprimés.
+KEEP_SNAPSHOTS = int(os.environ.get("JOURNAL_KEEP_SNAPSHOTS", 2))
+FLUSH_INTERVAL = float(os.environ.get("JOURNAL_FLUSH_INTERVAL", 0.2))
+
+FLUSH_SECONDS = metrics.histogram("journal_flush_seconds", "Durée d'une écriture du journal sur disque")
+RECORDS = metrics.counter("journal_records_total", "Enregistrements ajoutés au journal")
+
+
+def _numbered(directory, prefix, suffix):
+    """Fichiers prefix-<numéro>suffix du dossier, triés par numéro : [(numéro, chemin), ...]."""
+    files = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(suffix):
+            try:
+                files.append((int(name[len(prefix):-len(suffix)]), os.path.join(directory, name)))
+            except ValueError:
+                pass
+    return sorted(files)
+
+
+class Journal:
+    """
+    Journal des changements d'état, en ajout seul, découpé en segments, avec des
+    snapshots compactés réguliers.
+
+    Chaque enregistrement est une ligne JSON numérotée :
+        {"n": 42, "d": "<drone_id>", "s": {champ: nouvelle valeur}, "h": [[historique, entrée], ...]}
+    Au démarrage, on charge le dernier snapshot puis on rejoue seulement les
+    enregistrements écrits après lui : le temps de redémarrage dépend de la fin
+    du journal, pas de la durée du vol.
+
+    record() et maybe_snapshot() sont appelés par les handlers : ils ne font que
+    sérialiser et mettre en file. Un thread en arrière-plan écrit sur le disque.
+    """
+
+    def __init__(self, directory=JOURNAL_DIR, segment_bytes=SEGMENT_BYTES, snapshot_records=SNAPSHOT_RECORDS,
+                 snapshot_interval=SNAPSHOT_INTERVAL, keep_snapshots=KEEP_SNAPSHOTS, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.snapshot_records = snapshot_records
+        self.snapshot_interval = snapshot_interval
+        self.keep_snapshots = max(1, keep_snapshots)
+        self.flush_interval = flush_interval
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self.last_snapshot_time = time.monotonic()
+        self.pending = deque()  # lignes à écrire, et ("snapshot", seq, contenu)
+        self.segment = None
+        self.segment_size = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """Retourne (état du dernier snapshot ou None, enregistrements écrits après lui)."""
+        os.makedirs(self.directory, exist_ok=True)
+        state = None
+        snapshot_seq = 0
+        for seq, path in reversed(_numbered(self.directory, "snapshot-", ".json")):
+            try:
+                with open(path, "r") as f:
+                    state = json.load(f)
+                snapshot_seq = seq
+                break
+            except (OSError, ValueError):
+                continue  # snapshot illisible : on essaie le précédent
+        records = []
+        segments = _numbered(self.directory, "segment-", ".jsonl")
+        for i, (first, path) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= snapshot_seq + 1:
+                continue  # segment entièrement couvert par le snapshot
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # dernière ligne tronquée (arrêt brutal)
+                    if record["n"] > snapshot_seq:
+                        records.append(record)
+        self.seq = records[-1]["n"] if records else snapshot_seq
+        return state, records
+
+    def record(self, drone_id, patch, appended):
+        self.seq += 1
+        entry = {"n": self.seq, "d": drone_id}
+        if patch:
+            entry["s"] = patch
+        if appended:
+            entry["h"] = appended
+        self.pending.append(json.dumps(entry))
+        self.records_since_snapshot += 1
+        RECORDS.inc()
+
+    def maybe_snapshot(self, state, force=False):
+        """
+        Prend un snapshot si c'est le moment. `state` est une fonction qui retourne
+        l'état complet, ou sa forme JSON (voir Fleet.snapshot_json).
+        """
+        if not force:
+            if not self.records_since_snapshot:
+                return
+            if (self.records_since_snapshot < self.snapshot_records
+                    and time.monotonic() - self.last_snapshot_time < self.snapshot_interval):
+                return
+        # Sérialisé ici, dans le même fil que les handlers : le contenu correspond exactement à self.seq.
+        content = state()
+        if not isinstance(content, str):
+            content = json.dumps(content)
+        self.pending.append(("snapshot", self.seq, content))
+        self.records_since_snapshot = 0
+        self.last_snapshot_time = time.monotonic()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self.pending:
+                return
+            start = time.perf_counter()
+            lines = []
+            while self.pending:
+                item = self.pending.popleft()
+                if isinstance(item, str):
+                    lines.append(item)
+                    continue
+                self._write_lines(lines)
+                lines = []
+                self._write_snapshot(item[1], item[2])
+            self._write_lines(lines)
+            FLUSH_SECONDS.observe(time.perf_counter() - start)
+
+    def _write_lines(self, lines):
+        for line in lines:
+            if self.segment is None or self.segment_size >= self.segment_bytes:
+                self._rotate(json.loads(line)["n"])
+            data = line + "\n"
+            self.segment.write(data)
+            self.segment_size += len(data)
+        if lines:
+            self.segment.flush()
+
+    def _rotate(self, first_seq):
+        if self.segment is not None:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+        path = os.path.join(self.directory, "segment-%012d.jsonl" % first_seq)
+        self.segment = open(path, "a")
+        self.segment_size = 0
+
+    def _write_snapshot(self, seq, payload):
+        if self.segment is not None:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+        write_atomic(os.path.join(self.directory, "snapshot-%012d.json" % seq), payload)
+        # Rétention : on garde les derniers snapshots et les segments dont ils ont besoin.
+        snapshots = _numbered(self.directory, "snapshot-", ".json")
+        for _, path in snapshots[:-self.keep_snapshots]:
+            os.unlink(path)
+        oldest = snapshots[-self.keep_snapshots:][0][0]
+        segments = _numbered(self.directory, "segment-", ".jsonl")
+        for i, (first, path) in enumerate(segments[:-1]):
+            if segments[i + 1][0] <= oldest + 1:
+                os.unlink(path)
+
+    def close(self, state=None):
+        """Arrête le thread ; prend un dernier snapshot si `state` est donné, puis écrit tout."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if state is not None:
+            self.maybe_snapshot(state, force=True)
+        self.flush()
+        if self.segment is not None:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+            self.segment = None
@@ -0,0 +1,133 @@
+"""
+Mise à jour en direct des dashboards : au lieu de recharger la page toutes les
+2 secondes, le navigateur charge la page une fois puis reçoit seulement les
+champs qui ont changé (par Socket.IO dans server_fusion.py, par SSE dans dashboard.py).
+
+Les serveurs enregistrent les heures en nanosecondes (time.time_ns()) ; elles ne
+sont mises en forme qu'ici, au moment de l'affichage.
+"""
+import datetime
+
+_MISSING = object()
+
+# Intervalle minimal entre deux envois à un même dashboard (en secondes).
+DEFAULT_MIN_INTERVAL = 0.5
+
+
+def format_timestamp(value):
+    """Heure en ns -> "jj/mm/aaaa hh:mm:ss.mmm" ; les anciennes heures (déjà en texte) sont gardées telles quelles."""
+    if type(value) is not int:
+        return value
+    return datetime.datetime.fromtimestamp(value / 1e9).strftime("%d/%m/%Y %H:%M:%S.%f")[:-3]
+
+
+def dashboard_view(stats):
+    """
+    Vue "à plat" d'un drone telle qu'affichée par les dashboards, heures mises en forme.
+    Les listes d'historique sont copiées : elles sont modifiées en place par les serveurs.
+    """
+    view = {}
+    for key, value in stats.items():
+        if isinstance(value, list):
+            value = [dict(entry, timestamp=format_timestamp(entry.get("timestamp"))) if isinstance(entry, dict) else entry
+                     for entry in value]
+        elif key.endswith("_time"):
+            value = format_timestamp(value)
+        view[key] = value
+    return view
+
+
+def drone_view(drone):
+    """
+    Vue d'un drone du serveur, avec l'état de ses connexions. La partie tirée des
+    statistiques n'est recalculée que si elles ont changé (voir TrackedStats.cached).
+    """
+    view = dict(drone.stats.cached("view", dashboard_view))
+    view["raspberry_connected"] = drone.peers["raspberry"] is not None
+    view["flutter_connected"] = drone.peers["flutter"] is not None
+    return view
+
+
+class Viewer:
+    """
+    Un dashboard abonné aux mises à jour. Retient ce qui lui a déjà été envoyé
+    pour ne lui transmettre que les différences, au plus une fois par `min_interval`.
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL):
+        self.min_interval = min_interval
+        self.next_time = 0.0
+        self.sent = {}  # drone_id -> dernière vue envoyée
+
+    def set_max_rate(self, max_rate):
+        """Limite demandée par le navigateur (mises à jour par seconde), jamais au-dessus du défaut."""
+        try:
+            max_rate = float(max_rate)
+        except (TypeError, ValueError):
+            return
+        if max_rate > 0:
+            self.min_interval = max(DEFAULT_MIN_INTERVAL, 1.0 / max_rate)
+
+    def delta(self, views, now):
+        """Retourne {drone_id: {champ: valeur}} des champs modifiés, ou None s'il n'y a rien à envoyer."""
+        if now < self.next_time:
+            return None
+        delta = {}
+        for drone_id, view in views.items():
+            sent = self.sent.get(drone_id)
+            if sent is None:
+                changed = view
+            else:
+                changed = {k: v for k, v in view.items() if sent.get(k, _MISSING) != v}
+            if changed:
+                delta[drone_id] = changed
+                self.sent[drone_id] = view
+        if not delta:
+            return None
+        self.next_time = now + self.min_interval
+        return delta
+
+
+# Code JavaScript commun aux deux dashboards : applique un delta reçu à la page.
+# Les valeurs sont dans des éléments [data-field] à l'intérieur de [data-drone],
+# les historiques dans des <tbody data-history="...">.
+LIVE_SCRIPT = """
+<script>
+function formatValue(value) {
+    if (value === null || value === undefined) return "?";
+    if (value === true) return "Oui";
+    if (value === false) return "Non";
+    return String(value);
+}
+function renderHistory(tbody, messages) {
+    tbody.textContent = "";
+    if (!messages.length) {
+        tbody.innerHTML = '<tr><td colspan="2" class="none">Aucun message</td></tr>';
+        return;
+    }
+    for (const msg of messages) {
+        const row = tbody.insertRow();
+        row.insertCell().textContent = msg.timestamp;
+        const pre = document.createElement("pre");
+        pre.textContent = JSON.stringify(msg.data, null, 2);
+        row.insertCell().appendChild(pre);
+    }
+}
+function applyDelta(delta) {
+    for (const [droneId, fields] of Object.entries(delta)) {
+        const section = document.querySelector('[data-drone="' + CSS.escape(droneId) + '"]');
+        if (!section) { location.reload(); return; }
+        for (const [field, value] of Object.entries(fields)) {
+            if (Array.isArray(value)) {
+                const tbody = section.querySelector('[data-history="' + field + '"]');
+                if (tbody) renderHistory(tbody, value);
+                continue;
+            }
+            for (const el of section.querySelectorAll('[data-field="' + field + '"]')) {
+                el.textContent = formatValue(value);
+            }
+        }
+    }
+}
+</script>
+"""
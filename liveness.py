@@ -0,0 +1,90 @@
+import math
+
+
+class TimerWheel:
+    """
+    Roue de temporisation hachée : `slots` cases de `tick` secondes.
+
+    Une échéance est rangée dans la case de son tick (modulo le nombre de cases) ;
+    advance() ne lit que les cases des ticks écoulés. Ajouter une échéance est en
+    O(1), et un tick ne coûte que les échéances de sa case, quel que soit le
+    nombre total de sessions suivies.
+    """
+
+    def __init__(self, tick=0.1, slots=512, start=0.0):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(start / tick)  # dernier tick traité
+
+    def schedule(self, key, deadline):
+        # Une échéance déjà passée est traitée au prochain tick.
+        deadline_tick = max(self.current + 1, math.ceil(deadline / self.tick))
+        self.slots[deadline_tick % len(self.slots)].append((deadline_tick, key))
+
+    def advance(self, now):
+        """Retourne les clés dont l'échéance est atteinte, dans l'ordre des ticks."""
+        expired = []
+        target = int(now / self.tick)
+        # Après une longue pause, un tour complet suffit à voir toutes les cases.
+        first = max(self.current + 1, target - len(self.slots) + 1)
+        for t in range(first, target + 1):
+            slot = self.slots[t % len(self.slots)]
+            if not slot:
+                continue
+            later = [entry for entry in slot if entry[0] > target]
+            if len(later) < len(slot):
+                expired.extend(key for deadline_tick, key in slot if deadline_tick <= target)
+                slot[:] = later
+        self.current = max(self.current, target)
+        return expired
+
+
+class LivenessTracker:
+    """
+    Détection de silence : une clé (ex: (drone_id, "raspberry")) est perdue quand
+    elle n'a pas été vue depuis `timeout` secondes.
+
+    touch() ne fait qu'écrire l'heure dans un dict. Le timer n'est pas déplacé à
+    chaque message : quand il expire, on regarde la dernière heure vue et on le
+    ré-arme si la clé a parlé entre-temps. Chaque session coûte donc environ un
+    passage dans la roue par période de `timeout`.
+    """
+
+    def __init__(self, timeout, tick=0.1, slots=512, now=0.0):
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick, slots, now)
+        self.last_seen = {}
+        self.armed = set()
+        self.lost = set()
+
+    def touch(self, key, now):
+        """Retourne True si la clé était perdue (elle vient de reparler)."""
+        self.last_seen[key] = now
+        if key not in self.armed:
+            self.armed.add(key)
+            self.wheel.schedule(key, now + self.timeout)
+        if key in self.lost:
+            self.lost.discard(key)
+            return True
+        return False
+
+    def forget(self, key):
+        """Arrête le suivi de la clé (départ propre) : son timer expire sans la déclarer perdue."""
+        self.last_seen.pop(key, None)
+        self.lost.discard(key)
+
+    def tick(self, now):
+        """Retourne les clés devenues silencieuses depuis le dernier appel."""
+        silent = []
+        for key in self.wheel.advance(now):
+            last_seen = self.last_seen.get(key)
+            if last_seen is None:
+                self.armed.discard(key)  # oubliée entre-temps
+            elif now - last_seen >= self.timeout:
+                self.armed.discard(key)
+                del self.last_seen[key]  # re-posée par touch() quand la clé reparle
+                self.lost.add(key)
+                silent.append(key)
+            else:
+                self.wheel.schedule(key, last_seen + self.timeout)
+        return silent
@@ -0,0 +1,178 @@
+"""
+Journalisation des serveurs, sans écriture synchrone dans les handlers.
+
+Les handlers passent par des loggers "drone.<catégorie>" (telemetry, command,
+connection, server). Les messages retenus sont mis en forme puis déposés dans
+une file en mémoire ; un thread (QueueListener) les écrit sur la sortie standard.
+
+Chaque catégorie peut être échantillonnée (1 message sur N) et limitée (au plus
+N messages par seconde) avant même d'entrer dans la file :
+    LOG_SAMPLE="telemetry=100"     une trame de télémétrie sur 100
+    LOG_RATE="telemetry=20"        au plus 20 messages de télémétrie par seconde
+Les commandes ne sont pas échantillonnées par défaut.
+
+Le niveau (LOG_LEVEL, INFO par défaut) se change sans redémarrer : SIGUSR1
+bascule le mode verbeux (DEBUG, sans échantillonnage) ; voir toggle_verbose().
+LOG_FORMAT=json écrit une ligne JSON par message au lieu du texte.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+CATEGORIES = ("telemetry", "command", "connection", "server")
+DEFAULT_SAMPLE = "telemetry=100"
+DEFAULT_RATE = ""
+
+
+def get(category):
+    return logging.getLogger(f"drone.{category}")
+
+
+def _parse(spec):
+    """"telemetry=100,command=1" -> {"telemetry": 100, "command": 1}"""
+    values = {}
+    for item in spec.split(","):
+        if "=" in item:
+            category, value = item.split("=", 1)
+            try:
+                values[category.strip()] = float(value)
+            except ValueError:
+                pass
+    return values
+
+
+class CategoryFilter(logging.Filter):
+    """Échantillonnage 1 sur `sample` et limite de `rate` messages par seconde, pour une catégorie."""
+
+    def __init__(self, sample=1, rate=0):
+        super().__init__()
+        self.sample = max(1, int(sample))
+        self.rate = rate
+        self.enabled = True  # False en mode verbeux : tout passe
+        self.seen = 0
+        self.window = 0
+        self.in_window = 0
+        self.suppressed = 0  # messages écartés depuis le dernier message écrit
+
+    def filter(self, record):
+        if not self.enabled:
+            return True
+        self.seen += 1
+        if self.seen % self.sample:
+            self.suppressed += 1
+            return False
+        if self.rate:
+            second = int(time.monotonic())
+            if second != self.window:
+                self.window = second
+                self.in_window = 0
+            if self.in_window >= self.rate:
+                self.suppressed += 1
+                return False
+            self.in_window += 1
+        record.suppressed = self.suppressed
+        self.suppressed = 0
+        return True
+
+
+class Formatter(logging.Formatter):
+    """Texte lisible, ou JSON avec LOG_FORMAT=json. Les champs passés dans extra={"fields": ...} sont ajoutés."""
+
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        suppressed = getattr(record, "suppressed", 0)
+        category = record.name.rsplit(".", 1)[-1]
+        if self.as_json:
+            entry = {"time": record.created, "level": record.levelname, "category": category, "message": record.getMessage()}
+            entry.update(fields)
+            if suppressed:
+                entry["suppressed"] = suppressed
+            return json.dumps(entry, default=str)
+        text = f"{self.formatTime(record)} {record.levelname} {category} {record.getMessage()}"
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if suppressed:
+            text += f" (+{suppressed} non écrits)"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+filters = {}
+_state = {"level": logging.INFO, "verbose": False, "listener": None}
+
+
+def setup(level=None, sample=None, rate=None, stream=None):
+    """Installe la file, le thread d'écriture et les filtres. À appeler au démarrage du serveur."""
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    samples = _parse(os.environ.get("LOG_SAMPLE", DEFAULT_SAMPLE) if sample is None else sample)
+    rates = _parse(os.environ.get("LOG_RATE", DEFAULT_RATE) if rate is None else rate)
+
+    records = queue.SimpleQueue()
+    # Le texte est construit au moment de l'appel (les messages relayés peuvent être
+    # modifiés ensuite, ex: "seq" des commandes) ; le thread ne fait que l'écriture.
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.setFormatter(Formatter(os.environ.get("LOG_FORMAT") == "json"))
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    _state["listener"] = listener
+
+    root = logging.getLogger("drone")
+    root.handlers[:] = [queue_handler]
+    root.propagate = False
+    for category in CATEGORIES:
+        logger = get(category)
+        for old in list(logger.filters):
+            logger.removeFilter(old)
+        filters[category] = CategoryFilter(samples.get(category, 1), rates.get(category, 0))
+        logger.addFilter(filters[category])
+    set_level(level)
+
+
+def set_level(level):
+    """Change le niveau de tous les loggers "drone.*" (nom ou valeur numérique)."""
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            return
+    _state["level"] = level
+    if not _state["verbose"]:
+        logging.getLogger("drone").setLevel(level)
+
+
+def set_sampling(category, sample=None, rate=None):
+    category_filter = filters.get(category)
+    if category_filter is None:
+        return
+    if sample is not None:
+        category_filter.sample = max(1, int(sample))
+    if rate is not None:
+        category_filter.rate = rate
+
+
+def toggle_verbose(*args):
+    """Mode verbeux : niveau DEBUG et plus d'échantillonnage. Un second appel revient à la configuration."""
+    verbose = not _state["verbose"]
+    _state["verbose"] = verbose
+    for category_filter in filters.values():
+        category_filter.enabled = not verbose
+    logging.getLogger("drone").setLevel(logging.DEBUG if verbose else _state["level"])
+    get("server").warning("Mode verbeux %s", "activé" if verbose else "désactivé")
+
+
+def shutdown():
+    """Écrit les messages encore en file et arrête le thread."""
+    listener = _state["listener"]
+    if listener is not None:
+        listener.stop()
+        _state["listener"] = None
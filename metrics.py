@@ -0,0 +1,165 @@
+"""
+Métriques des serveurs, au format texte de Prometheus (sans dépendance).
+
+Les compteurs et histogrammes sont mis à jour par les handlers : un accès à un
+dict ou une recherche dichotomique, assez peu coûteux pour rester actif en
+production. Les jauges (clients connectés, profondeur des files...) sont
+calculées seulement quand /metrics est lu.
+
+server_fusion.py expose /metrics sur l'application Flask ; ws_server.py ouvre
+un petit serveur HTTP à part (voir serve()) sur METRICS_PORT.
+"""
+import asyncio
+import time
+from bisect import bisect_left
+
+# Bornes des histogrammes de durée, en secondes.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    # Échappements du format texte : une valeur ne peut ni fermer le label ni ajouter une ligne.
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # tuple des valeurs de labels -> total
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # tuple des valeurs de labels -> [compte par borne..., +Inf, somme]
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        """Chronomètre un bloc : `with histogram.time(): ...`."""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for labels, series in sorted(self.series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {total}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Gauge:
+    """Jauge calculée à la lecture : `collect()` retourne {tuple des valeurs de labels: valeur}."""
+
+    def __init__(self, name, help, collect, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric):
+        # Un module rechargé ou importé deux fois retrouve la même métrique ; deux
+        # mesures différentes sous le même nom sont une erreur, pas une fusion.
+        existing = self.metrics.setdefault(metric.name, metric)
+        if type(existing) is not type(metric) or existing.help != metric.help or existing.labels != metric.labels:
+            raise ValueError(f"Metric {metric.name} already registered with another definition")
+        return existing
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, collect, labels=()):
+        return self._add(Gauge(name, help, collect, labels))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+gauge = registry.gauge
+render = registry.render
+
+
+async def _handle_http(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # en-têtes ignorés
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status, body, content_type = "200 OK", render().encode(), CONTENT_TYPE
+        else:
+            status, body, content_type = "404 Not Found", b"not found\n", "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    """Serveur HTTP minimal (GET /metrics) dans la boucle asyncio : les jauges lisent l'état sans verrou."""
+    return await asyncio.start_server(_handle_http, host, port)
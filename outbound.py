@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections import deque
+
+import metrics
+
+# Nombre de trames en attente au-delà duquel un client est considéré en retard.
+DEFAULT_MAX_QUEUE = 100
+
+SEND_SECONDS = metrics.histogram("relay_send_seconds", "Temps entre la mise en file d'une trame et son écriture sur la socket")
+DROPPED = metrics.counter("send_queue_dropped_total", "Trames de télémétrie remplacées par une plus récente (client lent)")
+
+
+class PeerSender:
+    """
+    File d'envoi d'un client websocket, vidée par sa propre tâche d'écriture.
+
+    Un téléphone sur un mauvais réseau ne bloque donc plus la boucle de réception
+    de la Raspberry. Tant que le client suit, les trames partent dans l'ordre.
+    Quand il prend du retard (plus de `max_queue` trames en attente), la
+    télémétrie est fusionnée par clé (action) : seule la valeur la plus récente
+    de chaque clé est gardée. Les trames sans clé (commandes, réponses) ne sont
+    jamais supprimées, et les trames prioritaires (commandes de sécurité) passent
+    avant tout le reste.
+    """
+
+    def __init__(self, websocket, max_queue=DEFAULT_MAX_QUEUE):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.urgent = deque()  # trames prioritaires, envoyées avant la file normale
+        self.queue = deque()   # trames à envoyer dans l'ordre
+        self.latest = {}      # clé -> trame la plus récente, quand le client est en retard
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0      # trames de télémétrie remplacées par une plus récente
+        self.max_depth = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    def send(self, frame, key=None, priority=False):
+        """Ajoute une trame à envoyer, sans attendre. `key` permet de fusionner la télémétrie."""
+        if self.closed:
+            return
+        item = (frame, time.perf_counter(), key)
+        if priority:
+            self.urgent.append(item)
+        elif key is not None and (key in self.latest or len(self.queue) >= self.max_queue):
+            if key in self.latest:
+                self.dropped += 1
+                DROPPED.inc()
+            self.latest[key] = item
+        else:
+            self.queue.append(item)
+        depth = self.depth()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        self.wakeup.set()
+
+    def depth(self):
+        return len(self.urgent) + len(self.queue) + len(self.latest)
+
+    def counters(self):
+        return {"queued": self.depth(), "max_queued": self.max_depth, "sent": self.sent, "dropped": self.dropped}
+
+    async def _run(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.urgent or self.queue or self.latest:
+                    priority = bool(self.urgent)
+                    if self.urgent:
+                        frame, queued_at, key = self.urgent.popleft()
+                    elif self.queue:
+                        frame, queued_at, key = self.queue.popleft()
+                    else:
+                        frame, queued_at, key = self.latest.pop(next(iter(self.latest)))
+                    await self.write(frame, key, priority)
+                    self.sent += 1
+                    SEND_SECONDS.observe(time.perf_counter() - queued_at)
+        except Exception:
+            # Connexion fermée : le handler du client fait le ménage.
+            self.closed = True
+            self.urgent.clear()
+            self.queue.clear()
+            self.latest.clear()
+
+    async def write(self, frame, key, priority):
+        """Écrit une trame sur la socket (cluster.RemoteSender la transmet avec sa clé et sa priorité)."""
+        await self.websocket.send(frame)
+
+    async def close(self):
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
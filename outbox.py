@@ -0,0 +1,73 @@
+import os
+from collections import deque
+
+import metrics
+
+# Durée de conservation d'un message pour un pair déconnecté, en secondes.
+OUTBOX_TTL = float(os.environ.get("OUTBOX_TTL", 30))
+# Nombre maximum de commandes et de points GPS gardés (les plus anciens sont supprimés).
+OUTBOX_SIZE = int(os.environ.get("OUTBOX_SIZE", 200))
+# Un point GPS gardé toutes les OUTBOX_GPS_INTERVAL secondes (le plus récent remplace les autres).
+OUTBOX_GPS_INTERVAL = float(os.environ.get("OUTBOX_GPS_INTERVAL", 1.0))
+
+# Politique par action : "all" (tout garder), "sample" (sous-échantillonner), "latest" (dernière valeur).
+# Les actions absentes gardent seulement leur dernière valeur.
+# Un lot "batch" est sous-échantillonné comme le GPS, qu'il contient souvent.
+RETENTION = {"command": "all", "gps": "sample", "batch": "sample"}
+
+DROPPED = metrics.counter("outbox_dropped_total", "Messages en attente supprimés (expirés ou file pleine)", ("reason",))
+
+
+class Outbox:
+    """
+    Messages destinés à un pair déconnecté (un rôle d'un drone).
+
+    Quand la liaison avec le téléphone coupe quelques secondes, la télémétrie
+    et les commandes sont gardées ici selon RETENTION, pendant au plus `ttl`
+    secondes, puis envoyées d'un bloc au pair quand il se ré-identifie (voir
+    drain()). Les temps sont ceux de time.monotonic().
+    """
+
+    def __init__(self, ttl=OUTBOX_TTL, max_size=OUTBOX_SIZE, gps_interval=OUTBOX_GPS_INTERVAL):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.gps_interval = gps_interval
+        self.kept = deque()   # (t, message) des commandes
+        self.sampled = deque()  # (t, message) des points GPS, au moins gps_interval secondes d'écart
+        self.sample_start = None  # début de l'intervalle du dernier point GPS gardé
+        self.latest = {}      # action -> (t, message)
+
+    def __len__(self):
+        return len(self.kept) + len(self.sampled) + len(self.latest)
+
+    def add(self, data, now):
+        policy = RETENTION.get(data.get("action"), "latest")
+        if policy == "all":
+            self._append(self.kept, (now, data))
+        elif policy == "sample":
+            if self.sampled and now - self.sample_start < self.gps_interval:
+                self.sampled[-1] = (now, data)
+            else:
+                self._append(self.sampled, (now, data))
+                self.sample_start = now
+        else:
+            self.latest[data.get("action")] = (now, data)
+
+    def _append(self, entries, entry):
+        entries.append(entry)
+        if len(entries) > self.max_size:
+            entries.popleft()
+            DROPPED.inc("overflow")
+
+    def drain(self, now):
+        """Vide la boîte et retourne les messages encore valables, du plus ancien au plus récent."""
+        entries = list(self.kept) + list(self.sampled) + list(self.latest.values())
+        self.kept.clear()
+        self.sampled.clear()
+        self.latest.clear()
+        self.sample_start = None
+        fresh = [entry for entry in entries if now - entry[0] <= self.ttl]
+        if len(fresh) < len(entries):
+            DROPPED.inc("expired", amount=len(entries) - len(fresh))
+        fresh.sort(key=lambda entry: entry[0])
+        return [message for _, message in fresh]
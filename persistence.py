@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+import logs
+import metrics
+
+FLUSH_SECONDS = metrics.histogram("stats_flush_seconds", "Durée d'une écriture de stats.json (sérialisation comprise)")
+
+# Droits d'un fichier créé par open() (0666 moins l'umask) : mkstemp crée en 0600, et
+# stats.json doit rester lisible par un dashboard lancé sous un autre utilisateur.
+# L'umask n'est lisible qu'en le changeant : une seule fois, à l'import.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def write_atomic(path, payload):
+    """
+    Écrit payload dans un fichier temporaire du même dossier puis le renomme.
+    Un lecteur (ex: dashboard.py) voit soit l'ancien fichier, soit le nouveau,
+    jamais un fichier à moitié écrit.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".stats-", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(payload)
+            f.flush()
+            os.fchmod(f.fileno(), FILE_MODE)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class StatsWriter:
+    """
+    Persistance différée (write-behind) des statistiques.
+
+    Les handlers de messages appellent seulement mark_dirty(). Un thread en
+    arrière-plan réécrit le fichier au plus une fois par `interval` secondes :
+    toutes les modifications faites entre deux écritures sont regroupées, et
+    l'état sur disque n'a jamais plus de `interval` secondes de retard.
+    """
+
+    def __init__(self, snapshot, path="stats.json", interval=1.0):
+        self.snapshot = snapshot  # fonction qui retourne l'objet à sérialiser (ou déjà sérialisé en JSON)
+        self.path = path
+        self.interval = interval
+        self._dirty = False
+        self._lock = threading.Lock()  # une seule écriture à la fois
+        self._stop = threading.Event()
+        self._thread = None
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stats-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._dirty:
+                self.flush()
+
+    def flush(self):
+        """Écrit l'état si nécessaire. Retourne True si le fichier a été réécrit."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            self._dirty = False
+            start = time.perf_counter()
+            try:
+                payload = self.snapshot()
+                if not isinstance(payload, str):
+                    payload = json.dumps(payload)
+            except RuntimeError:
+                # L'état a été modifié pendant la sérialisation : on réessaie au prochain tour.
+                self._dirty = True
+                return False
+            try:
+                write_atomic(self.path, payload)
+            except OSError as e:
+                self._dirty = True
+                logs.get("server").error("Erreur d'écriture", extra={"fields": {"path": self.path, "error": str(e)}})
+                return False
+            FLUSH_SECONDS.observe(time.perf_counter() - start)
+            return True
+
+    def close(self):
+        """Arrête le thread et force une dernière écriture (à appeler à l'arrêt du serveur)."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
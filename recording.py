@@ -0,0 +1,452 @@
+"""
+Enregistrement des sessions de vol et relecture accélérée.
+
+Chaque session d'un drone (de la première trame relayée jusqu'à ce que ses deux
+clients soient partis) est enregistrée dans RECORDINGS_DIR/<drone>/<début>.rec,
+avec son index <début>.idx (<début> : heure de la première trame, en ns).
+
+Fichier .rec : un en-tête MAGIC, puis une suite d'enregistrements
+    heure (ns, u64) | drapeaux (u8) | longueur (u32) | trame
+La trame est gardée telle qu'elle a été relayée (texte JSON ou trame binaire,
+voir codec.py), sans ré-encodage. Drapeaux : sens (Raspberry -> Flutter ou
+l'inverse) et trame binaire.
+
+Les handlers ne font que mettre les trames en file (Recorder.record) ; un
+thread en arrière-plan les écrit sur le disque, comme le journal (journal.py).
+
+Fichier .idx : une entrée (heure, position dans .rec) toutes les INDEX_EVERY
+trames (l'entrée i est celle de la trame i * INDEX_EVERY). Une session terminée
+se clôt par l'entrée (CLOSED, fin de .rec) ; sans elle (session en cours, ou
+interrompue par un arrêt brutal), la session est vue comme encore enregistrée. Une recherche par heure est une dichotomie dans l'index puis la lecture
+d'au plus INDEX_EVERY trames. Les deux fichiers sont lus par mmap : la relecture
+ne charge jamais un fichier entier en mémoire.
+
+Relecture (voir Player) : à 1x, 10x, 100x... avec déplacement dans le temps.
+    {"type": "replay", "drone_id": "d1", "session": "latest", "speed": 10, "position": 30}
+puis, pendant la lecture :
+    {"action": "seek", "position": 120}   {"action": "speed", "value": 100}
+    {"action": "pause"}                   {"action": "resume"}
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import urllib.parse
+from bisect import bisect_right
+from collections import deque
+
+import metrics
+from fleet import check_drone_id
+
+# Dossier des enregistrements ; vide pour ne rien enregistrer.
+RECORDINGS_DIR = os.environ.get("RECORDINGS_DIR", "recordings")
+# Nombre de sessions gardées par drone (les plus anciennes sont supprimées).
+RECORDINGS_KEEP = int(os.environ.get("RECORDINGS_KEEP", 50))
+# Une entrée d'index toutes les INDEX_EVERY trames.
+INDEX_EVERY = 64
+WRITE_BUFFER = 1 << 16
+# Période d'écriture des trames en file ; au-delà de RECORDINGS_QUEUE trames en attente
+# (disque bloqué), les nouvelles trames ne sont pas enregistrées.
+FLUSH_INTERVAL = float(os.environ.get("RECORDINGS_FLUSH_INTERVAL", 0.2))
+RECORDINGS_QUEUE = int(os.environ.get("RECORDINGS_QUEUE", 100000))
+
+DROPPED = metrics.counter("recording_dropped_total", "Trames non enregistrées (file d'écriture pleine)")
+
+MAGIC = b"DREC\x01\x00\x00\x00"
+_RECORD = struct.Struct("!QBI")
+_INDEX = struct.Struct("!QQ")
+CLOSED = (1 << 64) - 1  # heure de l'entrée d'index qui clôt une session terminée
+
+FLUTTER_TO_RASPBERRY = 0x01  # sinon Raspberry -> Flutter
+BINARY = 0x02
+DIRECTIONS = {"raspberry_to_flutter": 0, "flutter_to_raspberry": FLUTTER_TO_RASPBERRY}
+
+# Nombre maximum de trames envoyées d'un coup par Player.due() (vitesses élevées).
+MAX_BURST = 500
+MIN_SPEED = 0.1
+MAX_SPEED = 1000.0
+
+
+def drone_directory(directory, drone_id):
+    """Dossier des sessions d'un drone ; un drone_id refusé par identify lève ValueError (pas de "." ni "..")."""
+    return os.path.join(directory, urllib.parse.quote(check_drone_id(drone_id), safe=""))
+
+
+class Session:
+    """Session en cours d'enregistrement : écritures bufferisées, en ajout seulement."""
+
+    def __init__(self, path, start_ns):
+        self.start_ns = start_ns
+        self.data = open(path + ".rec", "wb", buffering=WRITE_BUFFER)
+        self.index = open(path + ".idx", "wb", buffering=WRITE_BUFFER)
+        self.data.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.count = 0
+        self.last_ns = start_ns
+
+    def write(self, flags, frame, t_ns):
+        # Les heures restent croissantes même si l'horloge recule (dichotomie de l'index).
+        t_ns = max(t_ns, self.last_ns)
+        self.last_ns = t_ns
+        if isinstance(frame, str):
+            frame = frame.encode("utf-8")
+        else:
+            flags |= BINARY
+        if self.count % INDEX_EVERY == 0:
+            self.index.write(_INDEX.pack(t_ns, self.offset))
+        self.data.write(_RECORD.pack(t_ns, flags, len(frame)))
+        self.data.write(frame)
+        self.offset += _RECORD.size + len(frame)
+        self.count += 1
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.index.write(_INDEX.pack(CLOSED, self.offset))
+        self.data.close()
+        self.index.close()
+
+
+class Recorder:
+    """
+    Sessions en cours, une par drone. `directory` vide : rien n'est enregistré.
+
+    record() et end() sont appelés par les handlers : ils ne font que mettre en
+    file. Le thread lancé par start() écrit toutes les `flush_interval` secondes ;
+    les sessions (self.sessions) ne sont manipulées que sous self._lock.
+    """
+
+    def __init__(self, directory=RECORDINGS_DIR, keep=RECORDINGS_KEEP, flush_interval=FLUSH_INTERVAL,
+                 max_pending=RECORDINGS_QUEUE):
+        self.directory = directory
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.sessions = {}
+        self.pending = deque()  # (drone_id, drapeaux, trame, heure), ou (drone_id, None, None, None) : fin de session
+        self.live = set()       # drones dont une session est en cours (vu des handlers)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, drone_id, source, frame, t_ns):
+        """Enregistre une trame relayée ; `source` est le type du client qui l'a envoyée."""
+        if not self.directory:
+            return
+        if len(self.pending) >= self.max_pending:
+            DROPPED.inc()
+            return
+        self.live.add(drone_id)
+        self.pending.append((drone_id, FLUTTER_TO_RASPBERRY if source == "flutter" else 0, frame, t_ns))
+
+    def start(self):
+        if self._thread is None and self.directory:
+            self._thread = threading.Thread(target=self._run, name="recording-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _start(self, drone_id, t_ns):
+        directory = drone_directory(self.directory, drone_id)
+        os.makedirs(directory, exist_ok=True)
+        starts = sessions_in(directory)
+        for start in starts[:max(0, len(starts) - self.keep + 1)]:
+            for ext in (".rec", ".idx"):
+                try:
+                    os.unlink(os.path.join(directory, f"{start}{ext}"))
+                except FileNotFoundError:
+                    pass
+        return Session(os.path.join(directory, str(t_ns)), t_ns)
+
+    def end(self, drone_id):
+        """Fin de session (plus aucun client pour ce drone)."""
+        if drone_id in self.live:
+            self.live.discard(drone_id)
+            self.pending.append((drone_id, None, None, None))
+
+    def flush(self):
+        """Écrit les trames en file et les rend visibles aux lecteurs (Recording, Player)."""
+        with self._lock:
+            while self.pending:
+                drone_id, flags, frame, t_ns = self.pending.popleft()
+                if flags is None:
+                    session = self.sessions.pop(drone_id, None)
+                    if session is not None:
+                        session.close()
+                    continue
+                session = self.sessions.get(drone_id)
+                if session is None:
+                    session = self.sessions[drone_id] = self._start(drone_id, t_ns)
+                session.write(flags, frame, t_ns)
+            for session in self.sessions.values():
+                session.flush()
+
+    def close(self):
+        """Arrête le thread, écrit ce qui reste en file et ferme les sessions."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+        self.live.clear()
+
+
+def sessions_in(directory):
+    """Heures de début des sessions enregistrées dans un dossier de drone, de la plus ancienne à la plus récente."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-4]) for name in names if name.endswith(".rec") and name[:-4].isdigit())
+
+
+def list_recordings(directory=RECORDINGS_DIR):
+    """{drone_id: [début de chaque session, ...]} pour tous les drones enregistrés."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return {}
+    return {urllib.parse.unquote(name): sessions_in(os.path.join(directory, name)) for name in sorted(names)}
+
+
+def _map(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _IndexTimes:
+    """Heures de l'index, lues dans le mmap à la demande (pour bisect)."""
+
+    def __init__(self, index):
+        self.index = index
+        self.size = len(index) // _INDEX.size if index is not None else 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return _INDEX.unpack_from(self.index, i * _INDEX.size)[0]
+
+
+class Recording:
+    """Lecture d'une session enregistrée (éventuellement encore en cours : jusqu'à la dernière écriture visible)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = _map(path + ".rec")
+        if self.data is None or self.data[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("Invalid recording")
+        self.index = _map(path + ".idx")
+        self.times = _IndexTimes(self.index)
+        # Session en cours : l'index peut déjà pointer après la fin visible de .rec.
+        while self.times.size and self._index_offset(self.times.size - 1) > len(self.data):
+            self.times.size -= 1
+        self.closed = bool(self.times.size) and self.times[self.times.size - 1] == CLOSED
+        if self.closed:
+            self.times.size -= 1
+        self.start_ns = int(os.path.basename(path))
+        self.end = self._complete_end()
+        self.end_ns = self._last_time()
+
+    def _complete_end(self):
+        """Fin du dernier enregistrement complet (une session en cours peut finir au milieu d'une trame)."""
+        offset = self._index_offset(len(self.times) - 1) if len(self.times) else len(MAGIC)
+        size = len(self.data)
+        while offset + _RECORD.size <= size:
+            _, _, length = _RECORD.unpack_from(self.data, offset)
+            if offset + _RECORD.size + length > size:
+                break
+            offset += _RECORD.size + length
+        return offset
+
+    def _index_offset(self, i):
+        return _INDEX.unpack_from(self.index, i * _INDEX.size)[1]
+
+    def _last_time(self):
+        last = self.start_ns
+        offset = self._index_offset(len(self.times) - 1) if len(self.times) else len(MAGIC)
+        while offset < self.end:
+            last, _, _, _, offset = self.read(offset)
+        return last
+
+    @property
+    def duration(self):
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def read(self, offset):
+        """(heure, drapeaux, binaire, trame, position suivante) de l'enregistrement à `offset`."""
+        t_ns, flags, length = _RECORD.unpack_from(self.data, offset)
+        start = offset + _RECORD.size
+        frame = self.data[start:start + length]
+        return t_ns, flags, bool(flags & BINARY), frame if flags & BINARY else frame.decode("utf-8"), start + length
+
+    def seek(self, t_ns):
+        """Position de la première trame à `t_ns` ou après : dichotomie dans l'index, puis au plus INDEX_EVERY trames."""
+        return self.locate(t_ns)[0]
+
+    def locate(self, t_ns):
+        """(position, numéro) de la première trame à `t_ns` ou après (numéro : 0 pour la première trame)."""
+        i = bisect_right(self.times, t_ns) - 1
+        offset, n = (self._index_offset(i), i * INDEX_EVERY) if i >= 0 else (len(MAGIC), 0)
+        while offset < self.end:
+            record_ns, _, length = _RECORD.unpack_from(self.data, offset)
+            if record_ns >= t_ns:
+                break
+            offset += _RECORD.size + length
+            n += 1
+        return offset, n
+
+    def offset_of(self, n):
+        """Position de la trame numéro `n` (fin de .rec si n est le nombre de trames) ; None au-delà."""
+        if n < 0:
+            return None
+        i = min(n // INDEX_EVERY, len(self.times) - 1)
+        offset, k = (self._index_offset(i), i * INDEX_EVERY) if i >= 0 else (len(MAGIC), 0)
+        while k < n and offset < self.end:
+            _, _, length = _RECORD.unpack_from(self.data, offset)
+            offset += _RECORD.size + length
+            k += 1
+        return offset if k == n else None
+
+    def close(self):
+        for mapped in (self.data, getattr(self, "index", None)):
+            if mapped is not None:
+                mapped.close()
+
+
+def open_recording(drone_id, session="latest", directory=RECORDINGS_DIR):
+    directory = drone_directory(directory, drone_id)
+    starts = sessions_in(directory)
+    if not starts:
+        raise ValueError("No recording for this drone")
+    if session in (None, "latest"):
+        start = starts[-1]
+    else:
+        try:
+            start = int(session)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid session")
+        if start not in starts:
+            raise ValueError("Unknown session")
+    return Recording(os.path.join(directory, str(start)))
+
+
+def _speed(value):
+    try:
+        speed = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid speed")
+    return min(MAX_SPEED, max(MIN_SPEED, speed))
+
+
+def _position(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid position")
+
+
+class Player:
+    """
+    Lecture d'un enregistrement au rythme d'origine multiplié par `speed`.
+    La boucle d'envoi du serveur appelle due() : trames à envoyer maintenant et
+    délai avant la suivante.
+    """
+
+    def __init__(self, recording, speed=1.0, position=0.0, directions=("raspberry_to_flutter",)):
+        self.recording = recording
+        self.speed = speed
+        self.paused = False
+        self.flags = {DIRECTIONS[direction] for direction in directions}
+        self.seek(position)
+
+    @classmethod
+    def from_request(cls, request, directory=RECORDINGS_DIR):
+        """Player d'une demande {"drone_id", "session", "speed", "position", "directions"} ; ValueError si elle est invalide."""
+        directions = request.get("directions") or ("raspberry_to_flutter",)
+        if not isinstance(directions, (list, tuple)) or any(direction not in DIRECTIONS for direction in directions):
+            raise ValueError("Invalid directions")
+        speed = _speed(request.get("speed", 1))
+        position = _position(request.get("position", 0))
+        recording = open_recording(request.get("drone_id"), request.get("session", "latest"), directory)
+        return cls(recording, speed, position, directions)
+
+    def describe(self):
+        recording = self.recording
+        return {"session": recording.start_ns, "duration_s": round(recording.duration, 3), "speed": self.speed}
+
+    def position_ns(self, now=None):
+        if self.paused:
+            return self.origin_ns
+        now = time.monotonic() if now is None else now
+        return self.origin_ns + int((now - self.origin_clock) * self.speed * 1e9)
+
+    def seek(self, position):
+        """Se place à `position` secondes du début de la session."""
+        self.origin_ns = self.recording.start_ns + int(position * 1e9)
+        self.origin_clock = time.monotonic()
+        self.offset = self.recording.seek(self.origin_ns)
+
+    def set_speed(self, speed):
+        self.origin_ns = self.position_ns()
+        self.origin_clock = time.monotonic()
+        self.speed = speed
+
+    def control(self, data):
+        """Applique une commande du client ({"action": "seek" | "speed" | "pause" | "resume", ...}) ; ValueError si invalide."""
+        action = data.get("action")
+        if action == "seek":
+            self.seek(_position(data.get("position")))
+        elif action == "speed":
+            self.set_speed(_speed(data.get("value")))
+        elif action == "pause":
+            self.origin_ns = self.position_ns()
+            self.paused = True
+        elif action == "resume":
+            # Sans pause en cours, "resume" ne change rien (sinon la lecture serait décalée).
+            if self.paused:
+                # La lecture repart de la position de la pause (origin_ns, figée par "pause").
+                self.origin_clock = time.monotonic()
+                self.paused = False
+        else:
+            raise ValueError("Unknown action")
+
+    def due(self, now=None):
+        """
+        Retourne ([(binaire, trame), ...], délai) : les trames dont l'heure est passée
+        et le temps réel (en secondes) avant la suivante ; délai None à la fin de
+        l'enregistrement ou en pause.
+        """
+        limit = self.position_ns(now)
+        recording = self.recording
+        frames = []
+        while self.offset < recording.end and len(frames) < MAX_BURST:
+            t_ns, flags, binary, frame, next_offset = recording.read(self.offset)
+            if t_ns > limit:
+                if self.paused:
+                    return frames, None
+                return frames, (t_ns - limit) / 1e9 / self.speed
+            self.offset = next_offset
+            if (flags & FLUTTER_TO_RASPBERRY) in self.flags:
+                frames.append((binary, frame))
+        if self.offset < recording.end:
+            return frames, 0.0
+        return frames, None
+
+    def finished(self):
+        return self.offset >= self.recording.end
+
+    def close(self):
+        self.recording.close()
@@ -1,54 +1,142 @@
-from flask import Flask, render_template_string, request
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, request
 import json
-import datetime
 import os
+import signal
+import sys
+import time
+
+import clock
+import codec
+import core
+import fanout
+import history
+import logs
+import metrics
+import recording
+from core import DROP, RELAY
+from delta import DeltaEncoder
+from fleet import Fleet
+from live import LIVE_SCRIPT, Viewer, drone_view
+from journal import Journal
+from persistence import StatsWriter
+
+# "eventlet" (défaut) : Flask-SocketIO ; "asyncio" : Socket.IO servi en asyncio pur, sans eventlet
+# ni Flask-SocketIO, par la même boucle websockets que ws_server.py (voir socketio_asyncio.py).
+SOCKETIO_MODE = os.environ.get("SOCKETIO_MODE", "eventlet")
+# Limite de la file d'envoi de chaque client en mode asyncio (voir outbound.PeerSender).
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", 100))
 
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
-
-clients = {}  # {'raspberry': sid, 'flutter': sid}
-
-stats = {
-    "raspberry_messages": 0,
-    "flutter_messages": 0,
-    "last_battery": None,
-    "last_battery_time": None,
-    "last_latitude": None,
-    "last_longitude": None,
-    "last_gps_time": None,
-    "last_altitude": None,
-    "last_altitude_time": None,
-    "last_speed": None,
-    "last_speed_time": None,
-    "last_flight_mode": None,
-    "last_flight_mode_time": None,
-    "last_flutter_latitude": None,
-    "last_flutter_longitude": None,
-    "last_flutter_gps_time": None,
-    "start_latitude": None,
-    "start_longitude": None,
-    "start_gps_time": None,
-    "raspberry_to_flutter": [],
-    "flutter_to_raspberry": [],
-    "mission_state": "idle",
-    "last_command": None,
-    "signal_loss_mode": "return_home",
-    "flutter_sent": [],
-    "raspberry_sent": [],
-}
-
-def save_stats():
-    with open("stats.json", "w") as f:
-        json.dump(stats, f)
+if SOCKETIO_MODE == "asyncio":
+    import socketio_asyncio
+    socketio = socketio_asyncio.SocketIO(app, max_queue=SEND_QUEUE_SIZE)
+else:
+    from flask_socketio import SocketIO
+    socketio = SocketIO(app, cors_allowed_origins="*")
+
+def on(event, namespace=None):
+    """
+    Enregistre un handler Socket.IO appelé avec le sid du client, handler(sid, *args),
+    quel que soit le mode (Flask-SocketIO donne le sid dans request.sid).
+    """
+    def register(handler):
+        if SOCKETIO_MODE == "asyncio":
+            socketio.on(event, namespace)(handler)
+        else:
+            socketio.on(event, namespace=namespace)(lambda *args: handler(request.sid, *args))
+        return handler
+    return register
+
+def emit(event, data, to, key=None, priority=False):
+    """
+    socketio.emit vers un ou plusieurs sids. En mode asyncio, `key` (fusion de la
+    télémétrie d'un client lent) et `priority` (commandes de sécurité en premier)
+    vont à la file d'envoi du client ; Flask-SocketIO n'a pas de file par client.
+    """
+    if SOCKETIO_MODE == "asyncio":
+        socketio.emit(event, data, to=to, key=key, priority=priority)
+    else:
+        socketio.emit(event, data, to=to)
+
+def start_task(task, *args):
+    """Lance une tâche de fond : task(*args) est un générateur qui donne le délai avant son prochain passage."""
+    if SOCKETIO_MODE == "asyncio":
+        socketio.start_background_task(task, *args)
+    else:
+        socketio.start_background_task(run_task, task, *args)
+
+def run_task(task, *args):
+    for delay in task(*args):
+        socketio.sleep(delay)
+
+def new_stats():
+    return {
+        "raspberry_messages": 0,
+        "flutter_messages": 0,
+        "last_battery": None,
+        "last_battery_time": None,
+        "last_latitude": None,
+        "last_longitude": None,
+        "last_gps_time": None,
+        "last_altitude": None,
+        "last_altitude_time": None,
+        "last_speed": None,
+        "last_speed_time": None,
+        "last_flight_mode": None,
+        "last_flight_mode_time": None,
+        "last_flutter_latitude": None,
+        "last_flutter_longitude": None,
+        "last_flutter_gps_time": None,
+        "start_latitude": None,
+        "start_longitude": None,
+        "start_gps_time": None,
+        "raspberry_to_flutter": [],
+        "flutter_to_raspberry": [],
+        "mission_state": "idle",
+        "last_command": None,
+        "last_command_latency_ms": None,
+        "signal_loss_mode": "return_home",
+        "signal_lost": False,
+        "signal_lost_time": None,
+        "raspberry_clock_offset_ms": None,
+        "flutter_clock_offset_ms": None,
+        "distance_home_m": None,
+        "total_distance_m": 0,
+        "ground_speed_mps": None,
+        "return_home_eta_s": None,
+        "flutter_sent": [],
+        "raspberry_sent": [],
+    }
+
+fleet = Fleet(new_stats)  # sid -> client, drone_id -> drone et ses deux pairs
+fleet.register_metrics()
+
+log_command = logs.get("command")
+log_connection = logs.get("connection")
+log_server = logs.get("server")
+
+# Métriques exposées sur /metrics (voir metrics.py)
+HANDLER_SECONDS = metrics.histogram("handler_seconds", "Durée de traitement d'un message reçu", ("client_type",))
+RELAY_SECONDS = metrics.histogram("relay_emit_seconds", "Durée de l'émission des messages vers le pair")
+
+# Les handlers marquent seulement l'état comme modifié ; l'écriture de stats.json
+# se fait en arrière-plan, au plus une fois par STATS_FLUSH_INTERVAL secondes.
+# Sessions de chaque drone enregistrées pour être rejouées (voir recording.py).
+recorder = recording.Recorder()
+players = {}  # sid Socket.IO -> Player (relectures en cours)
+# Au plus REPLAY_TICK secondes entre deux passages de la boucle de relecture (prise en compte des commandes).
+REPLAY_TICK = 0.05
+
+persistence = StatsWriter(fleet.snapshot_json, interval=float(os.environ.get("STATS_FLUSH_INTERVAL", 1.0)))
 
 # Dashboard HTML minimal (adapte-le selon tes besoins)
+# La page est chargée une seule fois ; ensuite seuls les champs modifiés sont
+# poussés par Socket.IO (namespace /dashboard), voir push_dashboard().
 TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
     <title>Dashboard Serveur Drone</title>
-    <meta http-equiv="refresh" content="2">
     <style>
         body { font-family: Arial; margin: 40px; }
         h1 { color: #2c3e50; }
@@ -61,42 +149,30 @@ TEMPLATE = """
 </head>
 <body>
     <h1>Dashboard Serveur Drone</h1>
-    <h2>Statistiques</h2>
-    <table>
-        <tr><th>Messages Raspberry</th><td>{{ stats['raspberry_messages'] }}</td></tr>
-        <tr><th>Messages Flutter</th><td>{{ stats['flutter_messages'] }}</td></tr>
-        <tr><th>Dernier niveau batterie</th><td>{{ stats['last_battery'] or "?" }}</td></tr>
-        <tr><th>Dernier GPS Raspberry</th>
-            <td>
-                {% if stats['last_latitude'] and stats['last_longitude'] %}
-                    Lat: {{ stats['last_latitude'] }}, Lon: {{ stats['last_longitude'] }}
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
-            </td>
-        </tr>
-        <tr><th>Dernier GPS Flutter</th>
-            <td>
-                {% if stats['last_flutter_latitude'] and stats['last_flutter_longitude'] %}
-                    Lat: {{ stats['last_flutter_latitude'] }}, Lon: {{ stats['last_flutter_longitude'] }}
-                {% else %}
-                    <span class="none">Aucune donnée</span>
-                {% endif %}
-            </td>
-        </tr>
-        <tr><th>Mission State</th><td>{{ stats['mission_state'] }}</td></tr>
-        <tr><th>Signal Loss Mode</th><td>{{ stats['signal_loss_mode'] }}</td></tr>
-        <tr><th>Raspberry connectée</th>
-            <td>{{ "Oui" if clients.get("raspberry") else "Non" }}</td>
-        </tr>
-        <tr><th>Flutter connectée</th>
-            <td>{{ "Oui" if clients.get("flutter") else "Non" }}</td>
-        </tr>
-    </table>
-    <h2>Historique Raspberry → Flutter</h2>
+    {% for section in sections %}
+    {{ section | safe }}
+    {% else %}
+    <p class="none">Aucun drone connecté</p>
+    {% endfor %}
+    <script src="https://cdn.socket.io/4.5.4/socket.io.min.js"></script>
+    {{ live_script | safe }}
+    <script>
+        const socket = io("/dashboard", { transports: ["websocket"] });
+        socket.on("connect", () => socket.emit("subscribe", { max_rate: 2 }));
+        socket.on("delta", applyDelta);
+    </script>
+</body>
+</html>
+"""
+
+# Section d'un drone, rendue à part : elle n'est recalculée que si la vue du drone a changé (voir drone_section).
+DRONE_TEMPLATE = """
+    {% macro field(view, name) %}<span data-field="{{ name }}">{{ "?" if view[name] is none else view[name] }}</span>{% endmacro %}
+    {% macro history(view, name) %}
     <table>
         <tr><th>Date/Heure</th><th>Données</th></tr>
-        {% for msg in stats.get('raspberry_to_flutter', []) %}
+        <tbody data-history="{{ name }}">
+        {% for msg in view.get(name, []) %}
         <tr>
             <td>{{ msg.timestamp }}</td>
             <td><pre>{{ msg.data | tojson(indent=2) }}</pre></td>
@@ -104,164 +180,404 @@ TEMPLATE = """
         {% else %}
         <tr><td colspan="2" class="none">Aucun message</td></tr>
         {% endfor %}
+        </tbody>
     </table>
-    <h2>Historique Flutter → Raspberry</h2>
+    {% endmacro %}
+    <div data-drone="{{ drone_id }}">
+    <h2>Drone {{ drone_id }}</h2>
+    <h3>Statistiques</h3>
     <table>
-        <tr><th>Date/Heure</th><th>Données</th></tr>
-        {% for msg in stats.get('flutter_to_raspberry', []) %}
-        <tr>
-            <td>{{ msg.timestamp }}</td>
-            <td><pre>{{ msg.data | tojson(indent=2) }}</pre></td>
+        <tr><th>Messages Raspberry</th><td>{{ field(view, 'raspberry_messages') }}</td></tr>
+        <tr><th>Messages Flutter</th><td>{{ field(view, 'flutter_messages') }}</td></tr>
+        <tr><th>Dernier niveau batterie</th><td>{{ field(view, 'last_battery') }}</td></tr>
+        <tr><th>Dernier GPS Raspberry</th>
+            <td>Lat: {{ field(view, 'last_latitude') }}, Lon: {{ field(view, 'last_longitude') }}</td>
         </tr>
-        {% else %}
-        <tr><td colspan="2" class="none">Aucun message</td></tr>
-        {% endfor %}
-    </table>
-    <h2>Messages envoyés par l'application (Flutter)</h2>
-    <table>
-        <tr><th>Date/Heure</th><th>Données</th></tr>
-        {% for msg in stats.get('flutter_sent', []) %}
-        <tr>
-            <td>{{ msg.timestamp }}</td>
-            <td><pre>{{ msg.data | tojson(indent=2) }}</pre></td>
+        <tr><th>Dernier GPS Flutter</th>
+            <td>Lat: {{ field(view, 'last_flutter_latitude') }}, Lon: {{ field(view, 'last_flutter_longitude') }}</td>
+        </tr>
+        <tr><th>Distance au départ</th>
+            <td>{{ field(view, 'distance_home_m') }} m (retour en {{ field(view, 'return_home_eta_s') }} s)</td>
+        </tr>
+        <tr><th>Distance parcourue</th><td>{{ field(view, 'total_distance_m') }} m</td></tr>
+        <tr><th>Vitesse sol</th><td>{{ field(view, 'ground_speed_mps') }} m/s</td></tr>
+        <tr><th>Mission State</th><td>{{ field(view, 'mission_state') }}</td></tr>
+        <tr><th>Signal Loss Mode</th><td>{{ field(view, 'signal_loss_mode') }}</td></tr>
+        <tr><th>Signal perdu</th><td>{{ field(view, 'signal_lost') }} ({{ field(view, 'signal_lost_time') }})</td></tr>
+        <tr><th>Décalage d'horloge</th>
+            <td>Raspberry: {{ field(view, 'raspberry_clock_offset_ms') }} ms, Flutter: {{ field(view, 'flutter_clock_offset_ms') }} ms</td>
+        </tr>
+        <tr><th>Raspberry connectée</th>
+            <td><span data-field="raspberry_connected">{{ "Oui" if view['raspberry_connected'] else "Non" }}</span></td>
+        </tr>
+        <tr><th>Flutter connectée</th>
+            <td><span data-field="flutter_connected">{{ "Oui" if view['flutter_connected'] else "Non" }}</span></td>
         </tr>
-        {% else %}
-        <tr><td colspan="2" class="none">Aucun message</td></tr>
-        {% endfor %}
     </table>
-
-    <h2>Messages envoyés par la Raspberry</h2>
+    <h3>Télémétrie (dernière minute)</h3>
     <table>
-        <tr><th>Date/Heure</th><th>Données</th></tr>
-        {% for msg in stats.get('raspberry_sent', []) %}
+        <tr><th>Mesure</th><th>Échantillons</th><th>Min</th><th>Max</th><th>Moyenne</th></tr>
+        {% for metric in dashboard_metrics %}
         <tr>
-            <td>{{ msg.timestamp }}</td>
-            <td><pre>{{ msg.data | tojson(indent=2) }}</pre></td>
+            <th>{{ metric }}</th>
+            <td>{{ field(view, metric ~ '_count') }}</td>
+            <td>{{ field(view, metric ~ '_min') }}</td>
+            <td>{{ field(view, metric ~ '_max') }}</td>
+            <td>{{ field(view, metric ~ '_mean') }}</td>
         </tr>
-        {% else %}
-        <tr><td colspan="2" class="none">Aucun message</td></tr>
         {% endfor %}
     </table>
-</body>
-</html>
+    <h3>Historique Raspberry → Flutter</h3>
+    {{ history(view, 'raspberry_to_flutter') }}
+    <h3>Historique Flutter → Raspberry</h3>
+    {{ history(view, 'flutter_to_raspberry') }}
+    <h3>Messages envoyés par l'application (Flutter)</h3>
+    {{ history(view, 'flutter_sent') }}
+
+    <h3>Messages envoyés par la Raspberry</h3>
+    {{ history(view, 'raspberry_sent') }}
+    </div>
 """
 
+# Compilés une seule fois au démarrage (render_template_string les recompile à chaque appel).
+dashboard_template = app.jinja_env.from_string(TEMPLATE)
+drone_template = app.jinja_env.from_string(DRONE_TEMPLATE)
+
+DASHBOARD_METRICS = ("battery", "altitude", "speed", "end_to_end_latency")
+
+# Période de vérification des commandes non acquittées (voir commands.py).
+COMMAND_TICK = 0.1
+DASHBOARD_TICK = float(os.environ.get("DASHBOARD_TICK", 0.25))
+# Le résumé de la dernière minute (min/max/moyenne) change peu d'un tick à l'autre : recalculé moins souvent.
+DASHBOARD_SUMMARY_INTERVAL = float(os.environ.get("DASHBOARD_SUMMARY_INTERVAL", 5))
+# Raisons de déconnexion d'un départ propre : pas de perte de signal signalée (voir core.SignalMonitor).
+CLEAN_DISCONNECT_REASONS = ("client disconnect", "client namespace disconnect", "server disconnect")
+
+viewers = {}  # sid Socket.IO -> Viewer (dashboards ouverts)
+sections = {}  # drone_id -> (vue, HTML) de la dernière section rendue
+summaries = {}  # drone_id -> (heure, champs du résumé de télémétrie)
+
+def telemetry_summary(drone, now):
+    """Résumé de la dernière minute de télémétrie, recalculé au plus toutes les DASHBOARD_SUMMARY_INTERVAL secondes."""
+    cached = summaries.get(drone.drone_id)
+    if cached is not None and now - cached[0] < DASHBOARD_SUMMARY_INTERVAL:
+        return cached[1]
+    fields = {}
+    for metric in DASHBOARD_METRICS:
+        summary = drone.telemetry.summary(metric, 60, now)
+        fields[f"{metric}_count"] = summary["count"]
+        for key in ("min", "max", "mean"):
+            value = summary[key]
+            fields[f"{metric}_{key}"] = None if value is None else round(value, 2)
+    summaries[drone.drone_id] = (now, fields)
+    return fields
+
+def dashboard_views():
+    """Vue de chaque drone pour le dashboard, avec le résumé de la dernière minute de télémétrie."""
+    views = {}
+    now = time.time()
+    for drone_id, drone in list(fleet.drones.items()):
+        view = drone_view(drone)
+        view.update(telemetry_summary(drone, now))
+        views[drone_id] = view
+    return views
+
+def drone_section(drone_id, view):
+    """HTML de la section d'un drone, rendu de nouveau seulement si sa vue a changé."""
+    cached = sections.get(drone_id)
+    if cached is not None and cached[0] == view:
+        return cached[1]
+    html = drone_template.render(drone_id=drone_id, view=view, dashboard_metrics=DASHBOARD_METRICS)
+    sections[drone_id] = (view, html)
+    return html
+
 @app.route("/")
 def dashboard():
-    return render_template_string(TEMPLATE, stats=stats, clients=clients)
+    views = dashboard_views()
+    return dashboard_template.render(sections=[drone_section(drone_id, view) for drone_id, view in views.items()],
+                                     live_script=LIVE_SCRIPT)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+# Historique paginé et séries réduites pour les graphiques (voir history.py)
+@app.route("/api/drones/<path:drone_id>/series")
+def drone_series(drone_id):
+    drone = fleet.drones.get(drone_id)
+    if drone is None:
+        return history.error("Unknown drone", 404)
+    try:
+        return history.telemetry_series(drone, request.args)
+    except ValueError as e:
+        return history.error(str(e))
+
+@app.route("/api/drones/<path:drone_id>/messages")
+def drone_messages(drone_id):
+    # La session en cours est lue jusqu'à sa dernière trame, pas jusqu'au dernier tampon écrit.
+    recorder.flush()
+    try:
+        return history.recorded_messages(drone_id, request.args, recorder.directory)
+    except history.NotFound as e:
+        return history.error(str(e), 404)
+    except ValueError as e:
+        return history.error(str(e))
+
+# Dashboard en direct : chaque navigateur reçoit seulement les champs modifiés
+@on('connect', namespace='/dashboard')
+def dashboard_connect(sid, auth=None):
+    viewers[sid] = Viewer()
+
+@on('subscribe', namespace='/dashboard')
+def dashboard_subscribe(sid, data=None):
+    viewer = viewers.get(sid)
+    if viewer is not None and isinstance(data, dict):
+        viewer.set_max_rate(data.get("max_rate"))
+
+@on('disconnect', namespace='/dashboard')
+def dashboard_disconnect(sid, reason=None):
+    viewers.pop(sid, None)
+
+def push_dashboard():
+    """Tâche de fond : calcule les vues une fois par tick et envoie à chaque dashboard son delta."""
+    while True:
+        yield DASHBOARD_TICK
+        if not viewers:
+            continue
+        views = dashboard_views()
+        now = time.monotonic()
+        for sid, viewer in list(viewers.items()):
+            delta = viewer.delta(views, now)
+            if delta:
+                socketio.emit("delta", delta, namespace="/dashboard", to=sid)
 
 # WebSocket: identification
-@socketio.on('identify')
-def handle_identify(data):
-    client_type = data.get("type")
+@on('identify')
+def handle_identify(sid, data=None):
+    client_type = data.get("type") if isinstance(data, dict) else None
     if client_type not in ["raspberry", "flutter"]:
-        emit("error", {"message": "Unknown client type"})
+        socketio.emit("error", {"message": "Unknown client type"}, to=sid)
+        return
+    # {"rates": {"gps": 2}} : débit maximum de chaque action de télémétrie vers l'application (voir fanout.py).
+    try:
+        rates = core.parse_rates(data["rates"]) if client_type == "flutter" and "rates" in data else None
+        # drone_id/session_id sont optionnels : sans drone_id, le client rejoint le drone par défaut.
+        # "role" ("controller" ou "viewer") : voir Fleet.register.
+        record = fleet.register(sid, client_type, data.get("drone_id"), data.get("session_id"), data.get("role"))
+    except ValueError as e:
+        socketio.emit("error", {"message": str(e)}, to=sid)
         return
-    clients[client_type] = request.sid
-    emit("registered", {
+    # "encoding": "binary" active les trames binaires compactes (voir codec.py) ; JSON par défaut.
+    if data.get("encoding") in codec.ENCODINGS:
+        record.encoding = data["encoding"]
+    # Une Raspberry qui envoie {"ack": true} acquitte les commandes : elles sont renvoyées sans acquittement.
+    record.acks = client_type == "raspberry" and data.get("ack") is True
+    # {"trace": true} : le client répond aux pings d'horloge et renvoie l'heure de réception des messages tracés.
+    record.trace = data.get("trace") is True
+    # {"delta": true} : l'application reçoit la télémétrie en images complètes et deltas (voir delta.py).
+    if client_type == "flutter" and data.get("delta") is True and record.encoding == "json":
+        record.delta = DeltaEncoder()
+    if rates:
+        record.limiter = fanout.RateLimiter(rates)
+    drone = record.drone
+    log_connection.info("Client identifié", extra={"fields": {
+        "drone": drone.drone_id, "client_type": client_type, "session_id": record.session_id, "encoding": record.encoding}})
+    registered = {
         "status": "ok",
         "message": f"{client_type} registered",
-        "signal_loss_mode": stats.get("signal_loss_mode", "return_home")
-    })
-    if client_type == "raspberry" and "flutter" in clients:
-        socketio.emit("drone_connected", {"drone_connected": True}, room=clients["flutter"])
+        "drone_id": drone.drone_id,
+        "session_id": record.session_id,
+        "encoding": record.encoding,
+        "delta": record.delta is not None,
+        "signal_loss_mode": drone.stats.get("signal_loss_mode", "return_home")
+    }
+    if client_type == "flutter":
+        registered["role"] = "viewer" if record.viewer else "controller"
+    socketio.emit("registered", registered, to=sid)
+    if record.trace:
+        notify(record, clock.ping())
+    if not record.viewer:
+        flush_outbox(record)
+    if record.replaced is not None:
+        notify(record.replaced, {"action": "control", "role": "viewer"})
+    subscribers = drone.subscribers()
+    if client_type == "raspberry" and subscribers:
+        socketio.emit("drone_connected", {"drone_connected": True}, to=[subscriber.conn for subscriber in subscribers])
 
-# WebSocket: gestion des messages
-@socketio.on('message')
-def handle_message(data):
-    # Trouve le type du client qui envoie
-    client_type = None
-    for k, v in clients.items():
-        if v == request.sid:
-            client_type = k
-            break
-    if not client_type:
-        emit("error", {"message": "Client not identified"})
+def flush_outbox(record):
+    """Envoie en un seul message "backlog" ce qui a été gardé pendant que le client était déconnecté."""
+    messages = record.drone.outboxes[record.client_type].drain(time.monotonic())
+    if not messages:
         return
+    now = time.monotonic()
+    for data in messages:
+        if data.get("action") == "command":
+            record.drone.commands.submit(data, now, track=record.acks)
+    clock.stamp_forward(messages)
+    socketio.emit("message", {"action": "backlog", "messages": messages}, room=record.conn)
 
-    action = data.get("action")
-    now = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-
-    # Gestion Raspberry
-    if client_type == "raspberry":
-        stats["raspberry_messages"] += 1
-        if action == "battery":
-            stats["last_battery"] = data.get("value")
-            stats["last_battery_time"] = now
-        if action == "gps":
-            stats["last_latitude"] = data.get("latitude")
-            stats["last_longitude"] = data.get("longitude")
-            stats["last_gps_time"] = now
-            if stats["start_latitude"] is None and stats["start_longitude"] is None:
-                stats["start_latitude"] = data.get("latitude")
-                stats["start_longitude"] = data.get("longitude")
-                stats["start_gps_time"] = now
-        if action == "altitude":
-            stats["last_altitude"] = data.get("value")
-            stats["last_altitude_time"] = now
-        if action == "speed":
-            stats["last_speed"] = data.get("value")
-            stats["last_speed_time"] = now
-        if action == "flight_mode":
-            stats["last_flight_mode"] = data.get("value")
-            stats["last_flight_mode_time"] = now
-        save_stats()
-
-    # Gestion Flutter
-    elif client_type == "flutter":
-        stats["flutter_messages"] += 1
+def apply_message(record, data, now):
+    """Applique un message (voir core.py). Retourne DROP, RELAY ou REWRITTEN ; un refus est signalé au client."""
+    if not isinstance(data, dict):
+        socketio.emit("error", {"message": "Invalid message"}, to=record.conn)
+        return DROP
+    if record.client_type == "flutter":
         # Ajoute à l'historique des messages envoyés par Flutter
-        entry = {
+        record.drone.add_history("flutter_sent", {
             "timestamp": now,
             "data": data
-        }
-        stats["flutter_sent"].append(entry)
-        stats["flutter_sent"] = stats["flutter_sent"][-10:]
-        if action == "command":
-            command = data.get("command")
-            if command == "set_signal_loss_mode":
-                mode = data.get("mode", "return_home")
-                stats["signal_loss_mode"] = mode
-                save_stats()
-                print(f"Mode de perte de signal changé: {mode}")
-                return
-            stats["last_command"] = command
-            if command == "pause":
-                stats["mission_state"] = "paused"
-            elif command == "resume":
-                stats["mission_state"] = "running"
-            elif command == "stop":
-                stats["mission_state"] = "stopped"
-            elif command == "return_home":
-                stats["mission_state"] = "returning_home"
-            elif command == "hover":
-                stats["mission_state"] = "hovering"
-            save_stats()
-            print(f"Commande reçue: {command}, nouvel état: {stats['mission_state']}")
-        if action == "gps":
-            stats["last_flutter_latitude"] = data.get("latitude")
-            stats["last_flutter_longitude"] = data.get("longitude")
-            stats["last_flutter_gps_time"] = now
-            print(f"GPS Flutter reçu: {stats['last_flutter_latitude']}, {stats['last_flutter_longitude']}")
-        save_stats()
+        })
+    try:
+        return dispatcher.dispatch(record, data, now)
+    except core.Rejected as e:
+        socketio.emit("error", {"message": str(e)}, to=record.conn)
+        return DROP
+
+def notify(record, payload, priority=False):
+    emit("message", payload, record.conn, priority=priority)
+
+dispatcher = core.create_dispatcher(notify, persistence.mark_dirty)
+monitor = core.SignalMonitor(dispatcher, fleet)
+
+def watch_signal():
+    """Tâche de fond : détecte les drones et applications silencieux (voir core.SignalMonitor)."""
+    while True:
+        yield core.LIVENESS_TICK
+        for drone in monitor.tick(time.monotonic()):
+            fleet.commit(drone)
+
+def ping_clients():
+    """Tâche de fond : pings d'horloge des clients tracés (voir clock.py)."""
+    while True:
+        yield clock.CLOCK_PING_INTERVAL
+        for record in list(fleet.by_conn.values()):
+            if record.trace:
+                notify(record, clock.ping())
+
+def release_held():
+    """Tâche de fond : envoie les messages retenus par les limites de débit des applications (voir fanout.py)."""
+    while True:
+        yield fanout.FANOUT_TICK
+        now = time.monotonic()
+        for record in list(fleet.by_conn.values()):
+            if record.limiter is not None and record.limiter.held:
+                held = record.limiter.due(now)
+                if held:
+                    emit_messages([record], held)
+
+def emit_messages(peers, messages, raw=None):
+    """
+    Envoie des messages à chaque pair dans l'encodage qu'il a choisi. Un même
+    paquet Socket.IO part vers tous les pairs qui le reçoivent : il n'est
+    encodé qu'une fois (voir fanout.py). `raw` est la trame binaire d'origine,
+    réutilisée telle quelle pour les pairs binaires.
+    """
+    # Les commandes (vers la Raspberry) sont numérotées (champ "seq") et acquittées si la Raspberry le permet.
+    now = time.monotonic()
+    for peer in peers:
+        for data in messages:
+            if data.get("action") == "command":
+                peer.drone.commands.submit(data, now, track=peer.acks)
+    publication = fanout.Publication(messages, raw)
+    binary_sids = {}  # index des messages -> sids
+    json_sids = {}    # index d'un message -> sids
+    for peer in peers:
+        indexes = publication.admitted(peer, now)
+        if peer.encoding == "binary":
+            telemetry = tuple(index for index in indexes if codec.can_encode(messages[index]))
+            if telemetry:
+                binary_sids.setdefault(telemetry, []).append(peer.conn)
+            indexes = [index for index in indexes if not codec.can_encode(messages[index])]
+        elif peer.delta is not None:
+            for index in indexes:
+                data = messages[index]
+                emit("message", peer.delta.encode(data, now), peer.conn, core.conflation_key([data]))
+            continue
+        for index in indexes:
+            json_sids.setdefault(index, []).append(peer.conn)
+    for indexes, sids in binary_sids.items():
+        emit("message", publication.binary(indexes), sids, core.conflation_key([messages[index] for index in indexes]))
+    for index in sorted(json_sids):
+        data = messages[index]
+        # Les commandes passent avant la télémétrie en attente ; la télémétrie d'un client lent est fusionnée.
+        emit("message", data, json_sids[index], core.conflation_key([data]), data.get("action") == "command")
+
+# WebSocket: gestion des messages
+@on('message')
+def handle_message(sid, data=None):
+    start = time.perf_counter()
+    # Trouve le client qui envoie (et son drone) à partir de son sid
+    record = fleet.lookup(sid)
+    if record is None:
+        socketio.emit("error", {"message": "Client not identified"}, to=sid)
+        return
+    try:
+        relay_message(record, data)
+    finally:
+        fleet.commit(record.drone)
+        HANDLER_SECONDS.observe(time.perf_counter() - start, record.client_type)
+
+def relay_message(record, data):
+    """Applique les messages d'une trame aux statistiques et les relaie au pair."""
+    client_type = record.client_type
+    drone = record.drone
+
+    now = time.time_ns()
+
+    # Une trame binaire (encoding "binary") peut contenir plusieurs messages
+    raw = None
+    if isinstance(data, (bytes, bytearray)):
+        if record.encoding != "binary":
+            socketio.emit("error", {"message": "Binary encoding not negotiated"}, to=record.conn)
+            return
+        try:
+            messages = codec.decode_batch(data)
+        except ValueError as e:
+            socketio.emit("error", {"message": str(e)}, to=record.conn)
+            return
+        raw = bytes(data)
+    else:
+        messages = [data]
+    relayed = []
+    for message in messages:
+        result = apply_message(record, message, now)
+        if result != DROP:
+            relayed.append(message)
+        if result != RELAY:
+            raw = None
+    if not relayed:
+        return
+    if raw is not None:
+        recorder.record(drone.drone_id, client_type, raw, now)
+    else:
+        for message in relayed:
+            recorder.record(drone.drone_id, client_type, json.dumps(message), now)
 
     # Relais des messages
     target = "flutter" if client_type == "raspberry" else "raspberry"
-    if target in clients:
-        entry = {
-            "timestamp": now,
-            "data": data
-        }
-        if client_type == "raspberry":
-            stats["raspberry_to_flutter"].append(entry)
-            stats["raspberry_to_flutter"] = stats["raspberry_to_flutter"][-10:]
-        else:
-            stats["flutter_to_raspberry"].append(entry)
-            stats["flutter_to_raspberry"] = stats["flutter_to_raspberry"][-10:]
-        save_stats()
-        socketio.emit("message", data, room=clients[target])
+    peer = drone.peer(client_type)
+    # La télémétrie part vers toutes les applications du drone, les commandes vers la Raspberry.
+    peers = drone.subscribers() if client_type == "raspberry" else [peer] if peer is not None else []
+    if peers:
+        clock.stamp_forward(relayed)
+        with RELAY_SECONDS.time():
+            emit_messages(peers, relayed, raw)
+    if peer is not None:
+        history = "raspberry_to_flutter" if client_type == "raspberry" else "flutter_to_raspberry"
+        for message in relayed:
+            drone.add_history(history, {
+                "timestamp": now,
+                "data": message
+            })
+        persistence.mark_dirty()
     else:
-        emit("error", {"message": f"{target} not connected"})
+        # Gardé pour le pair (voir outbox.py) et envoyé quand il se reconnecte.
+        outbox = drone.outboxes[target]
+        received_at = time.monotonic()
+        for message in relayed:
+            outbox.add(message, received_at)
+        if client_type == "flutter":
+            socketio.emit("queued", {"message": f"{target} not connected, message queued"}, to=record.conn)
 
 """    # Ajoute à l'historique des messages envoyés
     entry = {
@@ -274,17 +590,102 @@ def handle_message(data):
     elif client_type == "flutter":
         stats["flutter_sent"].append(entry)
         stats["flutter_sent"] = stats["flutter_sent"][-10:]
-    save_stats()
+    persistence.mark_dirty()
 """
-@socketio.on('disconnect')
-def handle_disconnect():
-    for k, v in list(clients.items()):
-        if v == request.sid:
-            del clients[k]
-            print(f"{k} déconnecté.")
-            break
+@on('disconnect')
+def handle_disconnect(sid, reason=None):
+    players.pop(sid, None)
+    record = fleet.unregister(sid)
+    if record is not None:
+        drone = record.drone
+        monitor.disconnected(record, reason in CLEAN_DISCONNECT_REASONS)
+        if drone.peers["raspberry"] is None and drone.peers["flutter"] is None:
+            recorder.end(drone.drone_id)
+        log_connection.info("Client déconnecté", extra={"fields": {"drone": drone.drone_id, "client_type": record.client_type}})
+
+# Relecture d'une session enregistrée (voir recording.py) : les trames arrivent en événements "message"
+@on('replay')
+def handle_replay(sid, data=None):
+    try:
+        player = recording.Player.from_request(data if isinstance(data, dict) else {})
+    except (ValueError, OSError) as e:
+        socketio.emit("error", {"message": str(e)}, to=sid)
+        return
+    players[sid] = player  # une relecture précédente de ce client s'arrête
+    socketio.emit("replay", player.describe(), to=sid)
+    start_task(stream_replay, sid, player)
+
+@on('replay_control')
+def handle_replay_control(sid, data=None):
+    """{"action": "seek" | "speed" | "pause" | "resume", ...} pendant une relecture."""
+    player = players.get(sid)
+    if player is None:
+        socketio.emit("error", {"message": "No replay in progress"}, to=sid)
+        return
+    try:
+        player.control(data if isinstance(data, dict) else {})
+    except ValueError as e:
+        socketio.emit("error", {"message": str(e)}, to=sid)
+
+def stream_replay(sid, player):
+    """Tâche de fond d'une relecture, jusqu'à la déconnexion du client ou une nouvelle relecture."""
+    ended = False
+    try:
+        while players.get(sid) is player:
+            frames, delay = player.due()
+            for binary, frame in frames:
+                socketio.emit("message", frame if binary else json.loads(frame), to=sid)
+            # "replay_end" une fois par arrivée en fin d'enregistrement (un seek peut relancer la lecture).
+            at_end = delay is None and player.finished()
+            if at_end and not ended:
+                socketio.emit("message", {"action": "replay_end"}, to=sid)
+            ended = at_end
+            yield REPLAY_TICK if delay is None else min(delay, REPLAY_TICK)
+    finally:
+        player.close()
+
+def retransmit_commands():
+    """Tâche de fond : renvoie les commandes non acquittées et signale à Flutter celles qui ont échoué."""
+    while True:
+        yield COMMAND_TICK
+        now = time.monotonic()
+        for drone in list(fleet.drones.values()):
+            if not drone.commands.pending:
+                continue
+            retry, failed = drone.commands.due(now)
+            raspberry = drone.peers["raspberry"]
+            flutter = drone.peers["flutter"]
+            for command in retry:
+                if raspberry is not None:
+                    emit("message", command.data, raspberry.conn, priority=True)
+            for command in failed:
+                log_command.warning("Commande non acquittée", extra={"fields": {
+                    "drone": drone.drone_id, "command": command.data.get("command"), "seq": command.seq}})
+                if flutter is not None:
+                    socketio.emit("message", {"action": "command_failed", "seq": command.seq, "command": command.data.get("command")}, room=flutter.conn)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
-    socketio.run(app, host="0.0.0.0", port=port)
+    # Render arrête le service avec SIGTERM : on sort proprement pour écrire les stats.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logs.setup()
+    signal.signal(signal.SIGUSR1, logs.toggle_verbose)
+    journal = Journal()
+    replayed = fleet.restore(journal)
+    log_server.info("État rechargé", extra={"fields": {"journal": journal.directory, "drones": len(fleet.drones), "replayed": replayed}})
+    journal.start()
+    persistence.start()
+    recorder.start()
+    start_task(push_dashboard)
+    start_task(retransmit_commands)
+    start_task(watch_signal)
+    start_task(ping_clients)
+    start_task(release_held)
+    try:
+        socketio.run(app, host="0.0.0.0", port=port)
+    finally:
+        journal.close(fleet.snapshot_json)
+        recorder.close()
+        persistence.close()
+        logs.shutdown()
 
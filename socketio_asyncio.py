@@ -0,0 +1,413 @@
+"""
+Serveur Socket.IO en asyncio pur pour server_fusion.py (SOCKETIO_MODE=asyncio),
+sans eventlet ni Flask-SocketIO : la même boucle et la même bibliothèque
+websockets que ws_server.py.
+
+Protocoles compatibles avec les clients existants : Engine.IO 4 et Socket.IO 5,
+transport websocket seulement (clients créés avec transports: ["websocket"],
+comme l'application et test.html). Le long-polling et son passage au websocket
+ne sont pas proposés : une requête de polling reçoit 400.
+
+    Client                                  Serveur
+    GET /socket.io/?EIO=4&transport=websocket
+                                            0{"sid": ..., "pingInterval": 25000, ...}   ouverture Engine.IO
+    40 (ou 40/dashboard,)                   40{"sid": ...}                              connexion au namespace
+    42["identify", {...}]                   42["registered", {...}]                     événements
+    451-["message", {"_placeholder": true, "num": 0}] puis la trame binaire            événement binaire
+                                            2 / 3                                       ping / pong
+
+Les autres requêtes HTTP (GET seulement, 405 sinon) sont servies par
+l'application Flask, appelée en WSGI dans un thread (run_in_executor) : une page
+lente, comme la lecture d'un enregistrement, ne retarde pas les connexions
+Socket.IO. Les vues copient les dicts de la flotte avant de les parcourir.
+
+Les handlers sont appelés avec le sid du client : handler(sid, *args) ; connect
+reçoit (sid, auth) et disconnect (sid, raison). Les tâches de fond sont des
+générateurs qui donnent le délai avant leur prochain passage (voir
+start_background_task). Un paquet émis vers plusieurs clients n'est encodé
+qu'une fois ; chaque client a sa file d'envoi (outbound.PeerSender), où
+emit(key=..., priority=...) fusionne la télémétrie d'un client lent et fait
+passer les commandes de sécurité en premier.
+"""
+import asyncio
+import io
+import json
+import secrets
+import signal
+import sys
+import urllib.parse
+
+import websockets
+from websockets.datastructures import Headers
+from websockets.http11 import Response
+
+import logs
+from outbound import DEFAULT_MAX_QUEUE, PeerSender
+
+# Paquets Engine.IO
+EIO_OPEN, EIO_CLOSE, EIO_PING, EIO_PONG, EIO_MESSAGE = "0", "1", "2", "3", "4"
+# Paquets Socket.IO
+CONNECT, DISCONNECT, EVENT, ACK, CONNECT_ERROR, BINARY_EVENT, BINARY_ACK = range(7)
+
+log_server = logs.get("server")
+
+
+def _has_binary(data):
+    if isinstance(data, (bytes, bytearray)):
+        return True
+    if isinstance(data, list):
+        return any(_has_binary(item) for item in data)
+    if isinstance(data, dict):
+        return any(_has_binary(item) for item in data.values())
+    return False
+
+
+def _deconstruct(data, attachments):
+    """Remplace les données binaires par des marqueurs {"_placeholder": true, "num": n}."""
+    if isinstance(data, (bytes, bytearray)):
+        attachments.append(bytes(data))
+        return {"_placeholder": True, "num": len(attachments) - 1}
+    if isinstance(data, list):
+        return [_deconstruct(item, attachments) for item in data]
+    if isinstance(data, dict):
+        return {key: _deconstruct(value, attachments) for key, value in data.items()}
+    return data
+
+
+def _reconstruct(data, attachments):
+    if isinstance(data, list):
+        return [_reconstruct(item, attachments) for item in data]
+    if isinstance(data, dict):
+        if data.get("_placeholder") is True and isinstance(data.get("num"), int):
+            if not 0 <= data["num"] < len(attachments):
+                raise ValueError("Invalid attachment")
+            return attachments[data["num"]]
+        return {key: _reconstruct(value, attachments) for key, value in data.items()}
+    return data
+
+
+def encode(packet_type, namespace="/", data=None, packet_id=None):
+    """Trames websocket (Engine.IO) d'un paquet Socket.IO : le texte, puis les pièces binaires."""
+    attachments = []
+    if data is not None and _has_binary(data):
+        data = _deconstruct(data, attachments)
+        packet_type = BINARY_EVENT if packet_type == EVENT else BINARY_ACK
+    text = EIO_MESSAGE + str(packet_type)
+    if attachments:
+        text += f"{len(attachments)}-"
+    if namespace != "/":
+        text += namespace + ","
+    if packet_id is not None:
+        text += str(packet_id)
+    if data is not None:
+        text += json.dumps(data, separators=(",", ":"))
+    return [text, *attachments]
+
+
+def decode(text):
+    """(type, namespace, id, données, nombre de pièces binaires) d'un paquet Socket.IO ; lève ValueError."""
+    packet_type = int(text[0])
+    position = 1
+    attachments = 0
+    if packet_type in (BINARY_EVENT, BINARY_ACK):
+        dash = text.index("-", position)
+        attachments = int(text[position:dash])
+        position = dash + 1
+    namespace = "/"
+    if text.startswith("/", position):
+        comma = text.find(",", position)
+        end = len(text) if comma < 0 else comma
+        namespace = text[position:end]
+        position = end + 1
+    start = position
+    while position < len(text) and text[position].isdigit():
+        position += 1
+    packet_id = int(text[start:position]) if position > start else None
+    data = json.loads(text[position:]) if position < len(text) else None
+    return packet_type, namespace, packet_id, data, attachments
+
+
+class PacketSender(PeerSender):
+    """File d'envoi d'un client : chaque élément est un paquet (son texte puis ses pièces binaires), fusionné ou prioritaire en entier."""
+
+    async def write(self, frames, key, priority):
+        for frame in frames:
+            await self.websocket.send(frame)
+
+
+class Client:
+    """Une connexion Engine.IO : sa socket, sa file d'envoi et ses namespaces connectés."""
+
+    def __init__(self, websocket, max_queue=DEFAULT_MAX_QUEUE):
+        self.websocket = websocket
+        self.sender = PacketSender(websocket, max_queue)
+        self.namespaces = {}  # namespace -> sid Socket.IO
+        self.pong = asyncio.Event()
+        self.partial = None   # (paquet, pièces reçues, pièces attendues) d'un paquet binaire en cours
+
+    def send(self, frames, key=None, priority=False):
+        self.sender.send(frames, key, priority)
+
+
+class SocketIO:
+    """Serveur Socket.IO : même usage que flask_socketio.SocketIO dans server_fusion.py."""
+
+    def __init__(self, app, path="socket.io", ping_interval=25, ping_timeout=20, max_payload=1000000,
+                 max_queue=DEFAULT_MAX_QUEUE):
+        self.app = app
+        self.max_queue = max_queue  # limite de la file d'envoi de chaque client (outbound.PeerSender)
+        self.path = "/" + path.strip("/")
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.max_payload = max_payload
+        self.handlers = {}  # (namespace, événement) -> handler
+        self.sockets = {}   # sid -> (Client, namespace)
+        self.tasks = set()
+        self.pending = []   # tâches de fond demandées avant le démarrage de la boucle
+
+    def on(self, event, namespace=None):
+        def register(handler):
+            self.handlers[(namespace or "/", event)] = handler
+            return handler
+        return register
+
+    def emit(self, event, data=None, namespace=None, to=None, room=None, key=None, priority=False):
+        """
+        Émet vers un sid, une liste de sids, ou (sans destinataire) tous les clients du namespace.
+        `key` : clé de fusion de la télémétrie ; `priority` : le paquet passe avant la file (voir outbound.py).
+        """
+        namespace = namespace or "/"
+        target = to if to is not None else room
+        if target is None:
+            clients = [client for client, socket_namespace in self.sockets.values() if socket_namespace == namespace]
+        else:
+            sids = [target] if isinstance(target, str) else target
+            clients = [entry[0] for entry in map(self.sockets.get, sids) if entry is not None]
+        if not clients:
+            return
+        frames = encode(EVENT, namespace, [event] if data is None else [event, data])
+        for client in clients:
+            client.send(frames, key, priority)
+
+    def start_background_task(self, task, *args):
+        """
+        Lance `task(*args)`, un générateur qui donne le délai (secondes) avant de
+        reprendre ; la tâche s'arrête à la fin du générateur ou à l'arrêt du serveur.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.pending.append((task, args))
+            return
+        future = asyncio.ensure_future(self._drive(task(*args)))
+        self.tasks.add(future)
+        future.add_done_callback(self.tasks.discard)
+
+    async def _drive(self, generator):
+        try:
+            for delay in generator:
+                await asyncio.sleep(delay)
+        except Exception:
+            log_server.exception("Erreur dans une tâche de fond")
+        finally:
+            generator.close()
+
+    def _call(self, namespace, event, sid, *args):
+        handler = self.handlers.get((namespace, event))
+        if handler is None:
+            return None
+        try:
+            return handler(sid, *args)
+        except Exception:
+            log_server.exception("Erreur dans un handler Socket.IO", extra={"fields": {"event": event, "namespace": namespace}})
+            return None
+
+    # Réception
+
+    def _connect(self, client, namespace, auth):
+        if namespace != "/" and not any(key[0] == namespace for key in self.handlers):
+            client.send(encode(CONNECT_ERROR, namespace, {"message": "Invalid namespace"}))
+            return
+        if namespace in client.namespaces:
+            return
+        sid = secrets.token_urlsafe(15)
+        client.namespaces[namespace] = sid
+        self.sockets[sid] = (client, namespace)
+        client.send(encode(CONNECT, namespace, {"sid": sid}))
+        self._call(namespace, "connect", sid, auth)
+
+    def _disconnect(self, client, namespace, reason):
+        sid = client.namespaces.pop(namespace, None)
+        if sid is not None:
+            self.sockets.pop(sid, None)
+            self._call(namespace, "disconnect", sid, reason)
+
+    def _packet(self, client, packet_type, namespace, packet_id, data):
+        if packet_type == CONNECT:
+            self._connect(client, namespace, data)
+        elif packet_type == DISCONNECT:
+            self._disconnect(client, namespace, "client namespace disconnect")
+        elif packet_type in (EVENT, BINARY_EVENT):
+            sid = client.namespaces.get(namespace)
+            if sid is None or not isinstance(data, list) or not data or not isinstance(data[0], str):
+                return
+            result = self._call(namespace, data[0], sid, *data[1:])
+            if packet_id is not None:
+                # Le client attend un acquittement : la valeur de retour du handler.
+                args = [] if result is None else list(result) if isinstance(result, tuple) else [result]
+                client.send(encode(ACK, namespace, args, packet_id))
+        # ACK/BINARY_ACK : le serveur ne demande pas d'acquittement, ils sont ignorés.
+
+    def _receive(self, client, frame):
+        """Traite une trame websocket ; False si le client demande la fermeture."""
+        if isinstance(frame, bytes):
+            if client.partial is None:
+                return True
+            packet, attachments, expected = client.partial
+            attachments.append(frame)
+            if len(attachments) == expected:
+                client.partial = None
+                packet_type, namespace, packet_id, data = packet
+                try:
+                    data = _reconstruct(data, attachments)
+                except ValueError:
+                    return True
+                self._packet(client, packet_type, namespace, packet_id, data)
+            return True
+        kind = frame[:1]
+        if kind == EIO_MESSAGE:
+            try:
+                packet_type, namespace, packet_id, data, attachments = decode(frame[1:])
+            except (ValueError, IndexError):
+                return True
+            if attachments:
+                client.partial = ((packet_type, namespace, packet_id, data), [], attachments)
+            else:
+                self._packet(client, packet_type, namespace, packet_id, data)
+        elif kind == EIO_PONG:
+            client.pong.set()
+        elif kind == EIO_CLOSE:
+            return False
+        return True
+
+    async def _ping(self, client):
+        """Ping Engine.IO toutes les ping_interval secondes ; sans pong après ping_timeout, la connexion est fermée."""
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            client.pong.clear()
+            client.send([EIO_PING])
+            try:
+                await asyncio.wait_for(client.pong.wait(), self.ping_timeout)
+            except asyncio.TimeoutError:
+                await client.websocket.close()
+                return
+
+    async def _serve(self, websocket):
+        client = Client(websocket, self.max_queue)
+        client.sender.start()
+        client.send([EIO_OPEN + json.dumps({
+            "sid": secrets.token_urlsafe(15),
+            "upgrades": [],
+            "pingInterval": int(self.ping_interval * 1000),
+            "pingTimeout": int(self.ping_timeout * 1000),
+            "maxPayload": self.max_payload,
+        })])
+        pinger = asyncio.ensure_future(self._ping(client))
+        reason = "transport close"
+        try:
+            async for frame in websocket:
+                if not self._receive(client, frame):
+                    reason = "client disconnect"
+                    break
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            pinger.cancel()
+            for namespace in list(client.namespaces):
+                self._disconnect(client, namespace, reason)
+            await client.sender.close()
+
+    # HTTP
+
+    async def _process_request(self, connection, request):
+        path, _, query = request.path.partition("?")
+        if path.rstrip("/") != self.path:
+            if request.method != "GET":
+                # websockets ne lit pas le corps des requêtes : seules les pages en GET sont servies.
+                response = connection.respond(405, "Method not allowed\n")
+                response.headers["Allow"] = "GET"
+                return response
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._wsgi, connection, request, path, query)
+        params = urllib.parse.parse_qs(query)
+        if params.get("EIO") != ["4"]:
+            return connection.respond(400, "Unsupported Engine.IO protocol version\n")
+        if params.get("transport") != ["websocket"] or "Upgrade" not in request.headers:
+            return connection.respond(400, "Only the websocket transport is supported\n")
+        return None
+
+    def _wsgi(self, connection, request, path, query):
+        """Réponse de l'application Flask à une requête GET (appelée dans un thread)."""
+        host = connection.local_address
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": str(host[0]),
+            "SERVER_PORT": str(host[1]),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": str(connection.remote_address[0]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.raw_items():
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line, headers]
+
+        body = self.app(environ, start_response)
+        try:
+            content = b"".join(body)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        code, _, reason = status[0].partition(" ")
+        headers = Headers(status[1])
+        headers["Connection"] = "close"  # la connexion n'est pas réutilisée après la réponse
+        if "Content-Length" not in headers:
+            headers["Content-Length"] = str(len(content))
+        return Response(int(code), reason, headers, content)
+
+    # Démarrage
+
+    async def serve(self, host, port):
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        # Render arrête le service avec SIGTERM : la boucle s'arrête proprement (les finally du serveur s'exécutent).
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+        for task, args in self.pending:
+            self.start_background_task(task, *args)
+        self.pending = []
+        try:
+            async with websockets.serve(self._serve, host, port, process_request=self._process_request,
+                                        max_size=self.max_payload):
+                log_server.info(f"Serveur Socket.IO (asyncio) démarré sur http://{host}:{port}")
+                await stop
+        finally:
+            for future in list(self.tasks):
+                future.cancel()
+
+    def run(self, app=None, host="0.0.0.0", port=5000):
+        asyncio.run(self.serve(host, port))
@@ -0,0 +1,140 @@
+import math
+import os
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Nombre d'échantillons gardés par métrique : 1 heure à 50 Hz par défaut (~2,9 Mo par métrique).
+DEFAULT_CAPACITY = int(os.environ.get("TELEMETRY_CAPACITY", 50 * 3600))
+
+# Métriques numériques enregistrées pour chaque drone.
+METRICS = ("battery", "latitude", "longitude", "altitude", "speed", "command_latency", "end_to_end_latency")
+
+
+class _Timestamps:
+    """Vue en lecture seule des timestamps dans l'ordre chronologique (pour bisect)."""
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def __len__(self):
+        return self.ring.size
+
+    def __getitem__(self, i):
+        ring = self.ring
+        return ring.times[(ring.start + i) % ring.capacity]
+
+
+class RingSeries:
+    """
+    Série temporelle de capacité fixe : deux colonnes `array('d')` (timestamps en
+    secondes et valeurs) utilisées comme buffer circulaire. Les colonnes grandissent
+    jusqu'à `capacity`, puis les plus anciens échantillons sont écrasés.
+
+    Les timestamps sont croissants : les requêtes par intervalle de temps font une
+    recherche dichotomique au lieu de parcourir tout le buffer. Un échantillon plus
+    ancien que le dernier est rangé à l'heure de celui-ci.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.times = array("d")
+        self.values = array("d")
+        self.start = 0  # index physique de l'échantillon le plus ancien
+        self.size = 0
+        self.count = 0  # échantillons ajoutés depuis la création (change à chaque ajout, même buffer plein)
+
+    def __len__(self):
+        return self.size
+
+    def append(self, t, value):
+        if self.size:
+            latest = self.times[(self.start + self.size - 1) % self.capacity]
+            if t < latest:
+                t = latest
+        self.count += 1
+        if self.size < self.capacity:
+            self.times.append(t)
+            self.values.append(value)
+            self.size += 1
+        else:
+            self.times[self.start] = t
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+
+    def _index_range(self, t0, t1):
+        view = _Timestamps(self)
+        lo = 0 if t0 is None else bisect_left(view, t0)
+        hi = self.size if t1 is None else bisect_right(view, t1)
+        return lo, max(lo, hi)
+
+    def _iter(self, lo, hi):
+        times, values, start, capacity = self.times, self.values, self.start, self.capacity
+        for i in range(lo, hi):
+            j = (start + i) % capacity
+            yield times[j], values[j]
+
+    def range(self, t0=None, t1=None):
+        """Itère sur les échantillons (t, valeur) avec t0 <= t <= t1, sans copier le buffer."""
+        lo, hi = self._index_range(t0, t1)
+        return self._iter(lo, hi)
+
+    def columns(self, t0=None, t1=None):
+        """Copie des échantillons t0 <= t <= t1 en deux colonnes array('d') : (timestamps, valeurs)."""
+        lo, hi = self._index_range(t0, t1)
+        begin = (self.start + lo) % self.capacity
+        count = hi - lo
+        # Au plus deux tranches : jusqu'à la fin du buffer, puis depuis son début.
+        first = min(count, len(self.times) - begin)
+        rest = count - first
+        return (self.times[begin:begin + first] + self.times[:rest],
+                self.values[begin:begin + first] + self.values[:rest])
+
+    def last(self, n):
+        """Retourne les n derniers échantillons [(t, valeur), ...], du plus ancien au plus récent."""
+        n = max(0, min(n, self.size))
+        return list(self._iter(self.size - n, self.size))
+
+    def latest(self):
+        if not self.size:
+            return None
+        j = (self.start + self.size - 1) % self.capacity
+        return self.times[j], self.values[j]
+
+    def summary(self, t0=None, t1=None):
+        """min/max/moyenne sur une fenêtre de temps, calculés sur la colonne des valeurs (min, max et sum en C)."""
+        _, values = self.columns(t0, t1)
+        if not values:
+            return {"count": 0, "min": None, "max": None, "mean": None}
+        return {"count": len(values), "min": min(values), "max": max(values), "mean": sum(values) / len(values)}
+
+
+class TelemetryStore:
+    """Séries temporelles d'un drone, une RingSeries par métrique."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.series = {metric: RingSeries(capacity) for metric in METRICS}
+
+    def add(self, metric, value, t=None):
+        """Ajoute un échantillon ; les valeurs non numériques ou non finies sont ignorées."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError, OverflowError):
+            return False
+        if not math.isfinite(value):
+            return False
+        self.series[metric].append(time.time() if t is None else t, value)
+        return True
+
+    def range(self, metric, t0=None, t1=None):
+        return self.series[metric].range(t0, t1)
+
+    def last(self, metric, n):
+        return self.series[metric].last(n)
+
+    def summary(self, metric, window=None, now=None):
+        """Statistiques des `window` dernières secondes (toute la série si window est None)."""
+        if window is None:
+            return self.series[metric].summary()
+        now = time.time() if now is None else now
+        return self.series[metric].summary(now - window, now)
@@ -1,163 +1,533 @@
 import asyncio
 import websockets
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 import json
-import datetime
 import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
 
-clients = {}
-ALLOWED_ACTIONS = {"battery", "gps", "altitude", "speed", "command"}
-
-stats = {
-    "raspberry_messages": 0,
-    "flutter_messages": 0,
-    "last_battery": None,
-    "last_battery_time": None,
-    "last_latitude": None,
-    "last_longitude": None,
-    "last_gps_time": None,
-    "last_altitude": None,
-    "last_altitude_time": None,
-    "last_speed": None,
-    "last_speed_time": None,
-    "last_flight_mode": None,
-    "last_flight_mode_time": None,
-    "last_flutter_latitude": None,
-    "last_flutter_longitude": None,
-    "last_flutter_gps_time": None,
-    "start_latitude": None,
-    "start_longitude": None,
-    "start_gps_time": None,
-    "raspberry_to_flutter": [],
-    "flutter_to_raspberry": [],
-    "mission_state": "idle",
-    "last_command": None,
-    "signal_loss_mode": "return_home"
-}
-
-def save_stats():
-    with open("stats.json", "w") as f:
-        json.dump(stats, f)
-
-async def handler(websocket):
+import clock
+import cluster
+import codec
+import core
+import fanout
+import logs
+import metrics
+import recording
+from core import DROP, RELAY, REWRITTEN, conflation_key
+from delta import DeltaEncoder
+from fleet import Fleet
+from outbound import PeerSender
+from journal import JOURNAL_DIR, Journal
+from persistence import StatsWriter
+
+# "raw" : les trames sont relayées telles quelles, sans json.dumps ni champ ajouté.
+# "rewrite" : "received_ns" (heure de réception en ns) est ajouté aux messages de la Raspberry.
+RELAY_MODE = os.environ.get("RELAY_MODE", "raw")
+
+# Trames en attente au-delà desquelles la télémétrie vers un client lent est fusionnée.
+SEND_QUEUE_SIZE = int(os.environ.get("SEND_QUEUE_SIZE", 100))
+
+# Période de vérification des commandes non acquittées (voir commands.py).
+COMMAND_TICK = 0.1
+
+# Port du serveur HTTP qui expose /metrics (voir metrics.py) ; 0 pour le désactiver.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+# Nombre de processus qui partagent le port (voir cluster.py). WORKER_INDEX est
+# donné par le processus principal à chacun des workers qu'il lance.
+WORKERS = int(os.environ.get("WORKERS", 1))
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if "WORKER_INDEX" in os.environ else None
+# Dossier des sockets UNIX du bus entre workers, créé par le processus principal.
+BUS_DIR = os.environ.get("BUS_DIR", os.path.join(tempfile.gettempdir(), "drone-bus"))
+# Intervalle de surveillance des workers par le processus principal.
+WORKER_CHECK_INTERVAL = 0.5
+# Codes de fermeture d'un départ propre (normal, "going away") : pas de perte de signal signalée.
+CLEAN_CLOSE_CODES = (1000, 1001)
+
+# Compression permessage-deflate, négociée à la connexion ("none" pour la désactiver).
+# Le contexte zlib est gardé d'une trame à l'autre (context takeover) : c'est lui
+# qui compresse les petites trames de télémétrie, presque identiques entre elles.
+# Une fenêtre de 2^13 octets et memLevel 6 coûtent environ 64 Ko par connexion.
+WS_COMPRESSION = os.environ.get("WS_COMPRESSION", "deflate")
+WS_DEFLATE_WINDOW_BITS = int(os.environ.get("WS_DEFLATE_WINDOW_BITS", 13))
+WS_DEFLATE_MEM_LEVEL = int(os.environ.get("WS_DEFLATE_MEM_LEVEL", 6))
+WS_DEFLATE_LEVEL = int(os.environ.get("WS_DEFLATE_LEVEL", 6))
+
+HANDLER_SECONDS = metrics.histogram("handler_seconds", "Durée de traitement d'une trame reçue", ("client_type",))
+
+def new_stats():
+    return {
+        "raspberry_messages": 0,
+        "flutter_messages": 0,
+        "last_battery": None,
+        "last_battery_time": None,
+        "last_latitude": None,
+        "last_longitude": None,
+        "last_gps_time": None,
+        "last_altitude": None,
+        "last_altitude_time": None,
+        "last_speed": None,
+        "last_speed_time": None,
+        "last_flight_mode": None,
+        "last_flight_mode_time": None,
+        "last_flutter_latitude": None,
+        "last_flutter_longitude": None,
+        "last_flutter_gps_time": None,
+        "start_latitude": None,
+        "start_longitude": None,
+        "start_gps_time": None,
+        "raspberry_to_flutter": [],
+        "flutter_to_raspberry": [],
+        "mission_state": "idle",
+        "last_command": None,
+        "last_command_latency_ms": None,
+        "signal_loss_mode": "return_home",
+        "signal_lost": False,
+        "signal_lost_time": None,
+        "raspberry_clock_offset_ms": None,
+        "flutter_clock_offset_ms": None,
+        "distance_home_m": None,
+        "total_distance_m": 0,
+        "ground_speed_mps": None,
+        "return_home_eta_s": None
+    }
+
+fleet = Fleet(new_stats)
+fleet.register_metrics()
+
+log_command = logs.get("command")
+log_connection = logs.get("connection")
+log_server = logs.get("server")
+
+def queue_depths():
+    depths = {("raspberry",): 0, ("flutter",): 0}
+    for record in list(fleet.by_conn.values()):
+        if record.sender is not None:
+            depths[(record.client_type,)] += record.sender.depth()
+    return depths
+
+metrics.gauge("send_queue_depth", "Trames en attente d'envoi, par type de client destinataire", queue_depths, ("client_type",))
+
+# Les handlers marquent seulement l'état comme modifié ; l'écriture de stats.json
+# se fait en arrière-plan, au plus une fois par STATS_FLUSH_INTERVAL secondes.
+def snapshot():
+    """Contenu de stats.json (déjà en JSON) : statistiques des drones et état des files d'envoi (clients lents)."""
+    return fleet.snapshot_json({"send_queues": {
+        f"{record.drone.drone_id}/{record.client_type}": record.sender.counters()
+        for record in list(fleet.by_conn.values()) if record.sender is not None
+    }})
+
+# Chaque worker écrit les statistiques de ses drones dans son propre fichier (lu aussi par dashboard.py).
+STATS_FILE = "stats.json" if WORKER_INDEX is None else f"stats-{WORKER_INDEX}.json"
+# Sessions de chaque drone enregistrées pour être rejouées (voir recording.py).
+recorder = recording.Recorder()
+persistence = StatsWriter(snapshot, STATS_FILE, interval=float(os.environ.get("STATS_FLUSH_INTERVAL", 1.0)))
+
+def apply_message(record, data, now):
+    """Applique un message (voir core.py) ; un message refusé est signalé au client et n'est pas relayé."""
+    try:
+        result = dispatcher.dispatch(record, data, now)
+    except core.Rejected as e:
+        reply(record, {"status": "error", "message": str(e)})
+        return DROP
+    if result == RELAY and RELAY_MODE == "rewrite" and record.client_type == "raspberry":
+        data["received_ns"] = now
+        return REWRITTEN
+    return result
+
+def reply(record, payload, priority=False):
+    record.sender.send(json.dumps(payload), priority=priority)
+
+dispatcher = core.create_dispatcher(reply, persistence.mark_dirty)
+monitor = core.SignalMonitor(dispatcher, fleet)
+
+def send_messages(peers, messages, raw=None):
+    """
+    Met des messages dans la file d'envoi de chaque pair, dans l'encodage qu'il a choisi.
+    Chaque trame n'est encodée qu'une fois pour tous les pairs (voir fanout.py) ;
+    `raw` est la trame d'origine, réutilisée telle quelle pour les pairs du même encodage.
+    """
+    now = time.monotonic()
+    # Les commandes (vers la Raspberry) sont numérotées et passent avant la télémétrie en attente.
+    if any(data.get("action") == "command" for data in messages):
+        for peer in peers:
+            for data in messages:
+                if data.get("action") == "command":
+                    peer.sender.send(peer.drone.commands.submit(data, now, track=peer.acks), priority=True)
+        messages = [data for data in messages if data.get("action") != "command"]
+        raw = None
+    publication = fanout.Publication(messages, raw)
+    for peer in peers:
+        sender = peer.sender
+        indexes = publication.admitted(peer, now)
+        if peer.encoding == "binary":
+            telemetry = [index for index in indexes if codec.can_encode(messages[index])]
+            if telemetry:
+                sender.send(publication.binary(telemetry), conflation_key([messages[index] for index in telemetry]))
+            for index in indexes:
+                if not codec.can_encode(messages[index]):
+                    sender.send(publication.json(index), conflation_key([messages[index]]))
+        elif peer.delta is not None:
+            for index in indexes:
+                data = messages[index]
+                sender.send(json.dumps(peer.delta.encode(data, now), separators=(",", ":")), conflation_key([data]))
+        else:
+            for index in indexes:
+                sender.send(publication.json(index), conflation_key([messages[index]]))
+
+def flush_outbox(record):
+    """Envoie en une seule trame "backlog" les messages gardés pendant que le client était déconnecté."""
+    messages = record.drone.outboxes[record.client_type].drain(time.monotonic())
+    if not messages:
+        return
+    now = time.monotonic()
+    for data in messages:
+        if data.get("action") == "command":
+            record.drone.commands.submit(data, now, track=record.acks)
+    clock.stamp_forward(messages)
+    record.sender.send(json.dumps({"action": "backlog", "messages": messages}))
+
+def decode_frame(record, message):
+    """Décode une trame reçue en liste de messages (plusieurs pour une trame binaire)."""
+    if record.encoding == "binary" and isinstance(message, bytes):
+        return codec.decode_batch(message)
+    return [json.loads(message)]
+
+async def handler(websocket, ident_msg=None):
+    """Un client, de son identify à sa déconnexion. `ident_msg` : trame identify déjà lue (voir cluster.py)."""
     try:
-        ident_msg = await websocket.recv()
+        if ident_msg is None:
+            ident_msg = await websocket.recv()
         ident_data = json.loads(ident_msg)
         client_type = ident_data.get("type")
+        if client_type == "replay":
+            await replay(websocket, ident_data)
+            return
         if client_type not in ["raspberry", "flutter"]:
             await websocket.send(json.dumps({"status": "error", "message": "Unknown client type"}))
             return
-        clients[client_type] = websocket
-        if client_type == "raspberry" and "flutter" in clients:
-            await clients["flutter"].send(json.dumps({"drone_connected": True}))
+        # {"rates": {"gps": 2}} : débit maximum de chaque action de télémétrie vers l'application (voir fanout.py).
+        rates = core.parse_rates(ident_data["rates"]) if client_type == "flutter" and "rates" in ident_data else None
+        # drone_id/session_id sont optionnels : sans drone_id, le client rejoint le drone par défaut.
+        # "role" ("controller" ou "viewer") : voir Fleet.register.
+        record = fleet.register(websocket, client_type, ident_data.get("drone_id"), ident_data.get("session_id"),
+                                ident_data.get("role"))
+        # "encoding": "binary" active les trames binaires compactes (voir codec.py) ; JSON par défaut.
+        if ident_data.get("encoding") in codec.ENCODINGS:
+            record.encoding = ident_data["encoding"]
+        # Une Raspberry qui envoie {"ack": true} acquitte les commandes : elles sont renvoyées sans acquittement.
+        record.acks = client_type == "raspberry" and ident_data.get("ack") is True
+        # {"trace": true} : le client répond aux pings d'horloge et renvoie l'heure de réception des messages tracés.
+        record.trace = ident_data.get("trace") is True
+        # {"delta": true} : l'application reçoit la télémétrie en images complètes et deltas (voir delta.py).
+        if client_type == "flutter" and ident_data.get("delta") is True and record.encoding == "json":
+            record.delta = DeltaEncoder()
+        if rates:
+            record.limiter = fanout.RateLimiter(rates)
+        # Client connecté à un autre worker : la file qui compte est celle de ce worker, qui reçoit
+        # chaque trame avec sa clé de fusion et sa priorité (voir cluster.py).
+        if isinstance(websocket, cluster.RemoteConnection):
+            record.sender = websocket.sender(SEND_QUEUE_SIZE)
+        else:
+            record.sender = PeerSender(websocket, SEND_QUEUE_SIZE)
+        record.sender.start()
+        drone = record.drone
+        stats = drone.stats
+        if client_type == "raspberry":
+            for subscriber in drone.subscribers():
+                reply(subscriber, {"drone_connected": True})
+        if record.replaced is not None:
+            reply(record.replaced, {"action": "control", "role": "viewer"})
 
-        await websocket.send(json.dumps({
+        log_connection.info("Client identifié", extra={"fields": {
+            "drone": drone.drone_id, "client_type": client_type, "session_id": record.session_id, "encoding": record.encoding}})
+        registered = {
             "status": "ok",
             "message": f"{client_type} registered",
+            "drone_id": drone.drone_id,
+            "session_id": record.session_id,
+            "encoding": record.encoding,
+            "delta": record.delta is not None,
             "signal_loss_mode": stats.get("signal_loss_mode", "return_home")
-        }))
+        }
+        if client_type == "flutter":
+            registered["role"] = "viewer" if record.viewer else "controller"
+        reply(record, registered)
+        if record.trace:
+            reply(record, clock.ping())
+        if not record.viewer:
+            flush_outbox(record)
     except Exception as e:
         await websocket.send(json.dumps({"status": "error", "message": str(e)}))
         return
 
     try:
         async for message in websocket:
-            print(f"[{datetime.datetime.now()}] Message reçu de {client_type}: {message}")
+            start = time.perf_counter()
             try:
-                data = json.loads(message)
-                action = data.get("action")
-                if action not in ALLOWED_ACTIONS:
-                    await websocket.send(json.dumps({"status": "error", "message": "Unknown action"}))
+                # Décodé une seule fois pour lire l'action et les statistiques ; la trame
+                # d'origine est relayée sans être ré-encodée, sauf si on doit la modifier.
+                messages = decode_frame(record, message)
+                now = time.time_ns()
+                relayed = []
+                # Une trame binaire d'un client JSON contient du JSON : c'est ce texte, et non
+                # la trame, qui est relayé aux pairs JSON et enregistré (les pairs binaires
+                # reçoivent alors un lot encodé par codec.encode_batch).
+                raw = message if isinstance(message, str) or record.encoding == "binary" else message.decode("utf-8")
+                for data in messages:
+                    result = apply_message(record, data, now)
+                    if result != DROP:
+                        relayed.append(data)
+                    if result != RELAY:
+                        raw = None
+                if not relayed:
                     continue
-
-                if client_type == "raspberry":
-                    stats["raspberry_messages"] += 1
-                    if action not in {"battery", "gps", "altitude", "speed"}:
-                        await websocket.send(json.dumps({"status": "error", "message": "Action not allowed for raspberry"}))
-                        continue
-                    if action == "battery":
-                        stats["last_battery"] = data.get("value")
-                        stats["last_battery_time"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                    if action == "gps":
-                        stats["last_latitude"] = data.get("latitude")
-                        stats["last_longitude"] = data.get("longitude")
-                        stats["last_gps_time"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                        if stats["start_latitude"] is None and stats["start_longitude"] is None:
-                            stats["start_latitude"] = data.get("latitude")
-                            stats["start_longitude"] = data.get("longitude")
-                            stats["start_gps_time"] = stats["last_gps_time"]
-                    if action == "altitude":
-                        stats["last_altitude"] = data.get("value")
-                        stats["last_altitude_time"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                    if action == "speed":
-                        stats["last_speed"] = data.get("value")
-                        stats["last_speed_time"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                    if action == "flight_mode":
-                        stats["last_flight_mode"] = data.get("value")
-                        stats["last_flight_mode_time"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                    data["received_at"] = datetime.datetime.now().isoformat()
-                    save_stats()
-
-                elif client_type == "flutter":
-                    stats["flutter_messages"] += 1
-                    if action not in {"command", "gps"}:
-                        await websocket.send(json.dumps({"status": "error", "message": "Action not allowed for flutter"}))
-                        continue
-                    if action == "command":
-                        command = data.get("command")
-                        if command == "set_signal_loss_mode":
-                            mode = data.get("mode", "return_home")
-                            stats["signal_loss_mode"] = mode
-                            save_stats()
-                            print(f"Mode de perte de signal changé: {mode}")
-                            continue
-                        stats["last_command"] = command
-                        if command == "pause":
-                            stats["mission_state"] = "paused"
-                        elif command == "resume":
-                            stats["mission_state"] = "running"
-                        elif command == "stop":
-                            stats["mission_state"] = "stopped"
-                        elif command == "return_home":
-                            stats["mission_state"] = "returning_home"
-                        elif command == "hover":
-                            stats["mission_state"] = "hovering"
-                        save_stats()
-                        print(f"Commande reçue: {command}, nouvel état: {stats['mission_state']}")
-                    if action == "gps":
-                        stats["last_flutter_latitude"] = data.get("latitude")
-                        stats["last_flutter_longitude"] = data.get("longitude")
-                        stats["last_flutter_gps_time"] = datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-                        data["handled_by"] = "server"
-                    save_stats()
+                if raw is not None:
+                    recorder.record(drone.drone_id, client_type, raw, now)
+                else:
+                    for data in relayed:
+                        recorder.record(drone.drone_id, client_type, json.dumps(data), now)
 
                 target = "flutter" if client_type == "raspberry" else "raspberry"
-                if target in clients:
-                    entry = {
-                        "timestamp": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                        "data": data
-                    }
-                    if client_type == "raspberry":
-                        stats["raspberry_to_flutter"].append(entry)
-                        stats["raspberry_to_flutter"] = stats["raspberry_to_flutter"][-10:]
-                    else:
-                        stats["flutter_to_raspberry"].append(entry)
-                        stats["flutter_to_raspberry"] = stats["flutter_to_raspberry"][-10:]
-                    save_stats()
-                    await clients[target].send(json.dumps(data))
+                peer = drone.peer(client_type)
+                # La télémétrie part vers toutes les applications du drone, les commandes vers la Raspberry.
+                peers = drone.subscribers() if client_type == "raspberry" else [peer] if peer is not None else []
+                if peers:
+                    clock.stamp_forward(relayed)
+                    send_messages(peers, relayed, raw)
+                if peer is not None:
+                    history = "raspberry_to_flutter" if client_type == "raspberry" else "flutter_to_raspberry"
+                    for data in relayed:
+                        drone.add_history(history, {
+                            "timestamp": now,
+                            "data": data
+                        })
+                    persistence.mark_dirty()
                 else:
-                    await websocket.send(json.dumps({"status": "error", "message": f"{target} not connected"}))
+                    # Gardé pour le pair (voir outbox.py) et envoyé quand il se reconnecte.
+                    outbox = drone.outboxes[target]
+                    received_at = time.monotonic()
+                    for data in relayed:
+                        outbox.add(data, received_at)
+                    if client_type == "flutter":
+                        reply(record, {"status": "queued", "message": f"{target} not connected, message queued"})
             except json.JSONDecodeError:
-                await websocket.send(json.dumps({"status": "error", "message": "Invalid JSON"}))
+                reply(record, {"status": "error", "message": "Invalid JSON"})
+            except ValueError as e:
+                reply(record, {"status": "error", "message": str(e)})
+            finally:
+                fleet.commit(drone)
+                HANDLER_SECONDS.observe(time.perf_counter() - start, client_type)
+    finally:
+        fleet.unregister(websocket)
+        monitor.disconnected(record, websocket.close_code in CLEAN_CLOSE_CODES)
+        if drone.peers["raspberry"] is None and drone.peers["flutter"] is None:
+            recorder.end(drone.drone_id)
+        await record.sender.close()
+        log_connection.info("Client déconnecté", extra={"fields": {
+            "drone": drone.drone_id, "client_type": client_type, "send_queue": record.sender.counters()}})
+
+async def replay(websocket, request):
+    """
+    Rejoue une session enregistrée au client (voir recording.py). Les trames partent
+    telles qu'elles ont été relayées ; le client peut changer de vitesse, se
+    déplacer ou mettre en pause pendant la lecture.
+    """
+    try:
+        player = recording.Player.from_request(request)
+    except (ValueError, OSError) as e:
+        await websocket.send(json.dumps({"status": "error", "message": str(e)}))
+        return
+    wakeup = asyncio.Event()
+
+    async def controls():
+        try:
+            async for message in websocket:
+                try:
+                    player.control(json.loads(message))
+                except (ValueError, AttributeError) as e:
+                    await websocket.send(json.dumps({"status": "error", "message": str(e)}))
+                wakeup.set()
+        finally:
+            wakeup.set()
+
+    reader = asyncio.ensure_future(controls())
+    try:
+        await websocket.send(json.dumps(dict(player.describe(), status="ok", message="replay")))
+        ended = False
+        while not reader.done():
+            wakeup.clear()
+            frames, delay = player.due()
+            for binary, frame in frames:
+                await websocket.send(frame)
+            # "replay_end" une fois par arrivée en fin d'enregistrement (un seek peut relancer la lecture).
+            at_end = delay is None and player.finished()
+            if at_end and not ended:
+                await websocket.send(json.dumps({"action": "replay_end"}))
+            ended = at_end
+            try:
+                await asyncio.wait_for(wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    except websockets.ConnectionClosed:
+        pass
     finally:
-        if client_type in clients and clients[client_type] == websocket:
-            del clients[client_type]
-        print(f"{client_type} déconnecté. Statistiques actuelles: {stats}")
+        reader.cancel()
+        player.close()
+
+async def retransmit_commands():
+    """Renvoie les commandes non acquittées à temps et signale à Flutter celles qui ont échoué."""
+    while True:
+        await asyncio.sleep(COMMAND_TICK)
+        now = time.monotonic()
+        for drone in list(fleet.drones.values()):
+            if not drone.commands.pending:
+                continue
+            retry, failed = drone.commands.due(now)
+            raspberry = drone.peers["raspberry"]
+            flutter = drone.peers["flutter"]
+            for command in retry:
+                if raspberry is not None:
+                    raspberry.sender.send(command.frame, priority=True)
+            for command in failed:
+                log_command.warning("Commande non acquittée", extra={"fields": {
+                    "drone": drone.drone_id, "command": command.data.get("command"), "seq": command.seq}})
+                if flutter is not None:
+                    reply(flutter, {"action": "command_failed", "seq": command.seq, "command": command.data.get("command")})
+
+async def watch_signal():
+    """Détecte les drones et applications silencieux (voir core.SignalMonitor)."""
+    while True:
+        await asyncio.sleep(core.LIVENESS_TICK)
+        for drone in monitor.tick(time.monotonic()):
+            fleet.commit(drone)
+
+async def ping_clients():
+    """Pings d'horloge des clients tracés (voir clock.py)."""
+    while True:
+        await asyncio.sleep(clock.CLOCK_PING_INTERVAL)
+        for record in list(fleet.by_conn.values()):
+            if record.trace:
+                reply(record, clock.ping())
+
+async def release_held():
+    """Envoie les messages retenus par les limites de débit des applications (voir fanout.py)."""
+    while True:
+        await asyncio.sleep(fanout.FANOUT_TICK)
+        now = time.monotonic()
+        for record in list(fleet.by_conn.values()):
+            if record.limiter is not None and record.limiter.held:
+                held = record.limiter.due(now)
+                if held:
+                    send_messages([record], held)
+
+def compression_extensions():
+    if WS_COMPRESSION == "none":
+        return None
+    return [ServerPerMessageDeflateFactory(
+        server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        compress_settings={"level": WS_DEFLATE_LEVEL, "memLevel": WS_DEFLATE_MEM_LEVEL},
+    )]
 
 async def main():
     port = int(os.environ.get("PORT", 8765))  # Utilisé par Render
-    async with websockets.serve(handler, "0.0.0.0", port):
-        print(f"Serveur WebSocket démarré sur ws://0.0.0.0:{port}")
-        await asyncio.Future()
+    worker = WORKER_INDEX
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    # Render arrête le service avec SIGTERM : on sort proprement pour écrire les stats.
+    # Un second signal pendant l'arrêt est ignoré.
+    loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+    logs.setup()
+    loop.add_signal_handler(signal.SIGUSR1, logs.toggle_verbose)
+    # Un worker ne journalise que ses drones : un dossier par worker. Changer WORKERS
+    # redistribue les drones, l'état d'un drone n'est alors relu que par son ancien worker.
+    journal = Journal(JOURNAL_DIR if worker is None else os.path.join(JOURNAL_DIR, f"worker-{worker}"))
+    replayed = fleet.restore(journal)
+    log_server.info("État rechargé", extra={"fields": {"journal": journal.directory, "drones": len(fleet.drones), "replayed": replayed}})
+    journal.start()
+    persistence.start()
+    recorder.start()
+    retransmit = asyncio.create_task(retransmit_commands())
+    watcher = asyncio.create_task(watch_signal())
+    pinger = asyncio.create_task(ping_clients())
+    releaser = asyncio.create_task(release_held())
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_port = METRICS_PORT + (worker or 0)  # un port par worker
+        metrics_server = await metrics.serve("0.0.0.0", metrics_port)
+        log_server.info(f"Métriques disponibles sur http://0.0.0.0:{metrics_port}/metrics")
+    node = None
+    accept = handler
+    if worker is not None:
+        node = cluster.Cluster(cluster.UnixBus(worker, WORKERS, BUS_DIR), handler, SEND_QUEUE_SIZE)
+        await node.start()
+        accept = node.accept
+    try:
+        async with websockets.serve(accept, "0.0.0.0", port, reuse_port=worker is not None,
+                                    compression=None, extensions=compression_extensions()):
+            log_server.info(f"Serveur WebSocket démarré sur ws://0.0.0.0:{port}", extra={"fields": {"worker": worker}})
+            await stop
+    finally:
+        retransmit.cancel()
+        watcher.cancel()
+        pinger.cancel()
+        releaser.cancel()
+        if node is not None:
+            await node.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        journal.close(fleet.snapshot_json)
+        recorder.close()
+        persistence.close()
+        logs.shutdown()
+
+def run_workers():
+    """
+    Processus principal du mode multi-worker (WORKERS > 1) : lance les workers
+    (ce script, avec WORKER_INDEX), relance ceux qui s'arrêtent et leur transmet
+    SIGTERM/SIGUSR1.
+    """
+    logs.setup()
+    bus_dir = tempfile.mkdtemp(prefix="drone-bus-")
+    script = os.path.abspath(__file__)
+
+    def spawn(index):
+        return subprocess.Popen([sys.executable, script], env=dict(os.environ, BUS_DIR=bus_dir, WORKER_INDEX=str(index)))
+
+    workers = [spawn(index) for index in range(WORKERS)]
+    stopping = []
+
+    def forward(signum, frame):
+        if signum != signal.SIGUSR1:
+            stopping.append(signum)
+            signum = signal.SIGTERM
+        for process in workers:
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
+        signal.signal(signum, forward)
+    log_server.info("Workers démarrés", extra={"fields": {"workers": WORKERS, "bus": bus_dir}})
+    try:
+        while not stopping:
+            time.sleep(WORKER_CHECK_INTERVAL)
+            for index, process in enumerate(workers):
+                if process.poll() is not None and not stopping:
+                    log_server.warning("Worker arrêté, relancé", extra={"fields": {"worker": index, "code": process.returncode}})
+                    workers[index] = spawn(index)
+        for process in workers:
+            process.wait()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+        logs.shutdown()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if WORKERS > 1 and WORKER_INDEX is None:
+        run_workers()
+    else:
+        asyncio.run(main())
\ No newline at end of file